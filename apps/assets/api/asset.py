@@ -7,6 +7,7 @@ from django.shortcuts import get_object_or_404
 
 from common.utils import get_logger, get_object_or_none
 from common.permissions import IsOrgAdmin, IsOrgAdminOrAppUser, IsSuperUser
+from common.mixins import BulkImportMixin
 from orgs.mixins.api import OrgBulkModelViewSet
 from orgs.mixins import generics
 from ..models import Asset, Node, Platform
@@ -15,6 +16,7 @@ from ..tasks import (
     update_asset_hardware_info_manual, test_asset_connectivity_manual
 )
 from ..filters import AssetByNodeFilterBackend, LabelFilterBackend, IpInFilterBackend
+from ..importers import AssetBulkImporter
 
 
 logger = get_logger(__file__)
@@ -25,7 +27,7 @@ __all__ = [
 ]
 
 
-class AssetViewSet(OrgBulkModelViewSet):
+class AssetViewSet(BulkImportMixin, OrgBulkModelViewSet):
     """
     API endpoint that allows Asset to be viewed or edited.
     """
@@ -42,6 +44,7 @@ class AssetViewSet(OrgBulkModelViewSet):
     }
     permission_classes = (IsOrgAdminOrAppUser,)
     extra_filter_backends = [AssetByNodeFilterBackend, LabelFilterBackend, IpInFilterBackend]
+    bulk_importer_class = AssetBulkImporter
 
     def set_assets_node(self, assets):
         if not isinstance(assets, list):
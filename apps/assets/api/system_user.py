@@ -4,12 +4,14 @@ from rest_framework.response import Response
 
 from common.utils import get_logger
 from common.permissions import IsOrgAdmin, IsOrgAdminOrAppUser, IsAppUser
+from common.mixins import BulkImportMixin
 from orgs.mixins.api import OrgBulkModelViewSet
 from orgs.mixins import generics
 from orgs.utils import tmp_to_org
 from ..models import SystemUser, Asset
 from .. import serializers
 from ..serializers import SystemUserWithAuthInfoSerializer
+from ..importers import SystemUserBulkImporter
 from ..tasks import (
     push_system_user_to_assets_manual, test_system_user_connectivity_manual,
     push_system_user_a_asset_manual,
@@ -20,10 +22,11 @@ logger = get_logger(__file__)
 __all__ = [
     'SystemUserViewSet', 'SystemUserAuthInfoApi', 'SystemUserAssetAuthInfoApi',
     'SystemUserCommandFilterRuleListApi', 'SystemUserTaskApi',
+    'SystemUserCommandFilterRuleSetApi',
 ]
 
 
-class SystemUserViewSet(OrgBulkModelViewSet):
+class SystemUserViewSet(BulkImportMixin, OrgBulkModelViewSet):
     """
     System user api set, for add,delete,update,list,retrieve resource
     """
@@ -36,6 +39,7 @@ class SystemUserViewSet(OrgBulkModelViewSet):
         'list': serializers.SystemUserListSerializer,
     }
     permission_classes = (IsOrgAdminOrAppUser,)
+    bulk_importer_class = SystemUserBulkImporter
 
 
 class SystemUserAuthInfoApi(generics.RetrieveUpdateDestroyAPIView):
@@ -125,3 +129,16 @@ class SystemUserCommandFilterRuleListApi(generics.ListAPIView):
         pk = self.kwargs.get('pk', None)
         system_user = get_object_or_404(SystemUser, pk=pk)
         return system_user.cmd_filter_rules
+
+
+class SystemUserCommandFilterRuleSetApi(generics.RetrieveAPIView):
+    """
+    编译好的命令过滤规则集, 终端可以按版本号缓存, 在本地匹配
+    """
+    permission_classes = (IsOrgAdminOrAppUser,)
+    model = SystemUser
+
+    def retrieve(self, request, *args, **kwargs):
+        system_user = self.get_object()
+        rule_set = system_user.cmd_filter_rule_set
+        return Response(rule_set.to_dict())
@@ -44,8 +44,15 @@ class AssetByNodeFilterBackend(filters.BaseFilterBackend):
         return node, True
 
     @staticmethod
-    def perform_query(pattern, queryset):
-        return queryset.filter(nodes__key__regex=pattern).distinct()
+    def perform_query(node, query_all, queryset):
+        if query_all:
+            q = node.get_node_all_children_key_q(
+                node.key, with_self=True, field='nodes__key'
+            )
+        else:
+            # 只显示当前节点下资产
+            q = Q(nodes__key=node.key)
+        return queryset.filter(q).distinct()
 
     def filter_queryset(self, request, queryset, view):
         node, has_query_arg = self.get_query_node(request)
@@ -55,13 +62,7 @@ class AssetByNodeFilterBackend(filters.BaseFilterBackend):
         if node is None:
             return queryset
         query_all = self.is_query_all(request)
-        if query_all:
-            pattern = node.get_all_children_pattern(with_self=True)
-        else:
-            # pattern = node.get_children_key_pattern(with_self=True)
-            # 只显示当前节点下资产
-            pattern = r"^{}$".format(node.key)
-        return self.perform_query(pattern, queryset)
+        return self.perform_query(node, query_all, queryset)
 
 
 class LabelFilterBackend(filters.BaseFilterBackend):
@@ -114,8 +115,14 @@ class LabelFilterBackend(filters.BaseFilterBackend):
 
 class AssetRelatedByNodeFilterBackend(AssetByNodeFilterBackend):
     @staticmethod
-    def perform_query(pattern, queryset):
-        return queryset.filter(asset__nodes__key__regex=pattern).distinct()
+    def perform_query(node, query_all, queryset):
+        if query_all:
+            q = node.get_node_all_children_key_q(
+                node.key, with_self=True, field='asset__nodes__key'
+            )
+        else:
+            q = Q(asset__nodes__key=node.key)
+        return queryset.filter(q).distinct()
 
 
 class IpInFilterBackend(filters.BaseFilterBackend):
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+from collections import defaultdict
+
+from common.drf.importer import BulkImporter
+from common.utils import get_logger, get_object_or_none, lazyproperty
+from .models import Node, SystemUser, CommandFilterRuleSet
+from .tasks import (
+    update_assets_hardware_info_util, test_asset_connectivity_util,
+    push_system_user_to_assets,
+)
+
+logger = get_logger(__file__)
+
+__all__ = ['AssetBulkImporter', 'SystemUserBulkImporter']
+
+
+class AssetBulkImporter(BulkImporter):
+    """
+    资产导入, 原来每个资产都要处理一遍的信号合并为整次导入处理一次:
+    - 节点树的变更只发布一次
+    - 新加到节点的资产一次关联到节点及祖先节点关联的系统用户, 每个系统用户只推送一次
+    - 新建的资产只起一个更新硬件信息和一个测试可连接性的任务
+    """
+    @lazyproperty
+    def request_node(self):
+        node_id = self.request.query_params.get('node_id')
+        if not node_id:
+            return None
+        return get_object_or_none(Node, pk=node_id)
+
+    @lazyproperty
+    def root_node(self):
+        return Node.org_root()
+
+    def prepare_data(self, serializer, data, instance=None):
+        serializer.compatible_with_old_protocol(data)
+        # 和 AssetViewSet.set_assets_node 一致, 新建的资产添加到参数中的节点
+        if instance is None:
+            nodes = list(data.get('nodes') or [])
+            node = self.request_node
+            if node and node not in nodes:
+                nodes.append(node)
+            data['nodes'] = nodes
+        # 确保资产至少属于一个节点
+        if 'nodes' in data and not data['nodes']:
+            data['nodes'] = [self.root_node]
+        return data
+
+    def get_nodes_key(self):
+        nodes_id = {
+            node_id for changes in (self.m2m_added, self.m2m_removed)
+            for asset_id, node_id in changes.get('nodes', [])
+        }
+        if not nodes_id:
+            return {}
+        return dict(Node.objects.filter(id__in=nodes_id).values_list('id', 'key'))
+
+    def publish_tree_changes(self, nodes_key):
+        changes = []
+        for tp, pairs in (('assets_add', self.m2m_added.get('nodes')),
+                          ('assets_remove', self.m2m_removed.get('nodes'))):
+            node_assets = defaultdict(list)
+            for asset_id, node_id in pairs or []:
+                node_assets[node_id].append(asset_id)
+            changes.extend(
+                (tp, nodes_key[node_id], assets_id)
+                for node_id, assets_id in node_assets.items()
+                if node_id in nodes_key
+            )
+        if changes:
+            Node.publish_tree_changes(changes)
+
+    def add_assets_to_system_users(self, nodes_key):
+        """
+        和 on_asset_nodes_add 一致, 资产关联到新节点及其祖先节点关联的系统用户
+        """
+        assets_keys = defaultdict(set)
+        for asset_id, node_id in self.m2m_added.get('nodes', []):
+            key = nodes_key.get(node_id)
+            if key:
+                assets_keys[asset_id].update(Node.get_node_ancestor_keys(key, with_self=True))
+        if not assets_keys:
+            return
+        all_keys = set().union(*assets_keys.values())
+        system_users_keys = defaultdict(set)
+        queryset = SystemUser.objects.filter(nodes__key__in=all_keys)\
+            .values_list('id', 'nodes__key')
+        for system_user_id, key in queryset:
+            system_users_keys[system_user_id].add(key)
+
+        system_users = SystemUser.objects.filter(id__in=system_users_keys.keys())
+        for system_user in system_users:
+            keys = system_users_keys[system_user.id]
+            assets_id = [
+                asset_id for asset_id, asset_keys in assets_keys.items()
+                if asset_keys & keys
+            ]
+            # 触发一次 m2m_changed, 每个系统用户推送一次
+            system_user.assets.add(*assets_id)
+
+    def after_import(self):
+        nodes_key = self.get_nodes_key()
+        self.publish_tree_changes(nodes_key)
+        self.add_assets_to_system_users(nodes_key)
+        if self.created:
+            update_assets_hardware_info_util.delay(self.created)
+            test_asset_connectivity_util.delay(self.created)
+
+
+class SystemUserBulkImporter(BulkImporter):
+    """
+    系统用户导入, 更新的系统用户推送一次, 命令过滤器变化时规则缓存只失效一次
+    """
+    def prepare_data(self, serializer, data, instance=None):
+        serializer.clean_auth_fields(data)
+        return data
+
+    def after_import(self):
+        if self.m2m_added.get('cmd_filters') or self.m2m_removed.get('cmd_filters'):
+            CommandFilterRuleSet.expire()
+        for system_user in self.updated:
+            assets = system_user.assets.all().valid()
+            push_system_user_to_assets.delay(system_user, assets)
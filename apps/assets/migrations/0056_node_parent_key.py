@@ -0,0 +1,36 @@
+# Generated by Django 2.2.13 on 2020-08-21 08:20
+
+from django.db import migrations, models
+
+
+def migrate_nodes_parent_key(apps, schema_editor):
+    node_model = apps.get_model("assets", "Node")
+    db_alias = schema_editor.connection.alias
+    nodes = node_model.objects.using(db_alias).all().only('id', 'key')
+
+    batch_size = 1000
+    batch = []
+    for node in nodes.iterator():
+        node.parent_key = ':'.join(node.key.split(':')[:-1])
+        batch.append(node)
+        if len(batch) >= batch_size:
+            node_model.objects.using(db_alias).bulk_update(batch, ['parent_key'])
+            batch = []
+    if batch:
+        node_model.objects.using(db_alias).bulk_update(batch, ['parent_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0055_auto_20200811_1845'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='node',
+            name='parent_key',
+            field=models.CharField(db_index=True, default='', max_length=64, verbose_name='Parent key'),
+        ),
+        migrations.RunPython(migrate_nodes_parent_key),
+    ]
@@ -4,6 +4,7 @@ import io
 import os
 import uuid
 from hashlib import md5
+from itertools import islice
 
 import sshpubkeys
 from django.core.cache import cache
@@ -42,13 +43,16 @@ class ConnectivityMixin:
         assets = self.get_related_assets()
         if not isinstance(assets, list):
             assets = assets.only('id', 'hostname', 'admin_user__id')
+        data = {}
         for asset in assets:
             if asset.hostname in unreachable:
-                self.set_asset_connectivity(asset, Connectivity.unreachable())
+                c = Connectivity.unreachable()
             elif asset.hostname in reachable:
-                self.set_asset_connectivity(asset, Connectivity.reachable())
+                c = Connectivity.reachable()
             else:
-                self.set_asset_connectivity(asset, Connectivity.unknown())
+                c = Connectivity.unknown()
+            data[self.get_asset_connectivity_key(asset)] = c
+        Connectivity.set_many(data)
         cache_key = self.CONNECTIVITY_AMOUNT_CACHE_KEY.format(self.username, self.part_id)
         cache.delete(cache_key)
 
@@ -62,8 +66,8 @@ class ConnectivityMixin:
             'reachable': [],
             'unknown': [],
         }
-        for asset in assets:
-            connectivity = self.get_asset_connectivity(asset)
+        assets_connectivity = self.get_assets_connectivity(assets)
+        for asset, connectivity in assets_connectivity:
             if connectivity.is_reachable():
                 data["reachable"].append(asset.hostname)
             elif connectivity.is_unreachable():
@@ -97,6 +101,32 @@ class ConnectivityMixin:
         key = self.get_asset_connectivity_key(asset)
         Connectivity.set(key, c)
 
+    def get_assets_connectivity(self, assets, batch_size=1000):
+        """
+        批量获取资产的可连接性, 每批一次缓存请求
+        :return: [(asset, connectivity), ]
+        """
+        assets = iter(assets)
+        while True:
+            batch = list(islice(assets, batch_size))
+            if not batch:
+                break
+            keys = [self.get_asset_connectivity_key(asset) for asset in batch]
+            values = Connectivity.get_many(keys)
+            for asset, key in zip(batch, keys):
+                yield asset, values[key]
+
+    @classmethod
+    def set_assets_username_connectivity(cls, data):
+        """
+        :param data: [(asset, username, connectivity), ]
+        """
+        data = {
+            cls.CONNECTIVITY_ASSET_CACHE_KEY.format(username, asset.id): c
+            for asset, username, c in data
+        }
+        Connectivity.set_many(data)
+
 
 class AuthMixin:
     private_key = ''
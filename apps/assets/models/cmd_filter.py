@@ -4,15 +4,17 @@ import uuid
 import re
 
 from django.db import models
+from django.core.cache import cache
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.utils.translation import ugettext_lazy as _
 
 from common.utils import lazyproperty
 from orgs.mixins.models import OrgModelMixin
+from orgs.utils import tmp_to_org
 
 
 __all__ = [
-    'CommandFilter', 'CommandFilterRule'
+    'CommandFilter', 'CommandFilterRule', 'CommandFilterRuleSet',
 ]
 
 
@@ -63,11 +65,11 @@ class CommandFilterRule(OrgModelMixin):
         ordering = ('-priority', 'action')
         verbose_name = _("Command filter rule")
 
-    @lazyproperty
-    def _pattern(self):
-        if self.type == 'command':
+    @staticmethod
+    def get_pattern_source(tp, content):
+        if tp == 'command':
             regex = []
-            content = self.content.replace('\r\n', '\n')
+            content = content.replace('\r\n', '\n')
             for cmd in content.split('\n'):
                 cmd = re.escape(cmd)
                 cmd = cmd.replace('\\ ', '\s+')
@@ -77,9 +79,17 @@ class CommandFilterRule(OrgModelMixin):
                     regex.append(r'\b{0}'.format(cmd))
             s = r'{}'.format('|'.join(regex))
         else:
-            s = r'{0}'.format(self.content)
+            s = r'{0}'.format(content)
+        return s
+
+    @lazyproperty
+    def pattern_source(self):
+        return self.get_pattern_source(self.type, self.content)
+
+    @lazyproperty
+    def _pattern(self):
         try:
-            _pattern = re.compile(s)
+            _pattern = re.compile(self.pattern_source)
         except:
             _pattern = ''
         return _pattern
@@ -96,3 +106,133 @@ class CommandFilterRule(OrgModelMixin):
 
     def __str__(self):
         return '{} % {}'.format(self.type, self.content)
+
+
+class CommandFilterRuleSet:
+    """
+    系统用户编译好的命令过滤规则集
+    - 规则按优先级排序, 所有规则合并成一个正则做预检, 绝大部分命令一次匹配就能放行
+    - 预检命中后再按优先级找第一个匹配的规则, 返回它的动作
+    - 有反向引用等不能合并的规则, 每次单独检查
+    规则集按系统用户缓存, 规则或过滤器变化时更新全局版本号, 各进程再重新编译
+    """
+    cache_key = 'CMD_FILTER_RULE_SET_{}_{}'
+    version_cache_key = 'CMD_FILTER_RULE_SET_VERSION'
+    cache_ttl = 3600 * 24
+    local_max_size = 5000
+    # 进程内只保留当前版本的规则集
+    _local = {}
+    _local_version = None
+
+    def __init__(self, rules, version=''):
+        # rules: [{'id', 'pattern', 'action', 'priority'}], 已按优先级排序
+        self.version = version
+        self.rules = rules
+        self.compiled = []
+        combinable = []
+        self.standalone = []
+        for rule in rules:
+            try:
+                pattern = re.compile(rule['pattern'])
+            except re.error:
+                continue
+            self.compiled.append((pattern, rule['action']))
+            if self.is_combinable(rule['pattern']):
+                combinable.append(rule['pattern'])
+            else:
+                self.standalone.append((pattern, rule['action']))
+        self.combined = None
+        if combinable:
+            source = '|'.join('(?:{})'.format(p) for p in combinable)
+            try:
+                self.combined = re.compile(source)
+            except re.error:
+                self.standalone = list(self.compiled)
+        self.combined_source = self.combined.pattern if self.combined else None
+
+    @staticmethod
+    def is_combinable(source):
+        # 反向引用合并后编号会变, 内联全局标志只能放在开头
+        if re.search(r'\\[1-9]|\(\?P=|\(\?[aiLmsux]+\)', source):
+            return False
+        try:
+            re.compile('(?:{})|(?:x)'.format(source))
+        except re.error:
+            return False
+        return True
+
+    def match(self, command):
+        """
+        :return: (action, matched_command)
+        """
+        if self.combined is not None and self.combined.search(command):
+            candidates = self.compiled
+        else:
+            candidates = self.standalone
+        for pattern, action in candidates:
+            found = pattern.search(command)
+            if not found:
+                continue
+            return action, found.group()
+        return CommandFilterRule.ACTION_UNKNOWN, ''
+
+    def to_dict(self):
+        return {
+            'version': self.version,
+            'pattern': self.combined_source,
+            'rules': self.rules,
+        }
+
+    @classmethod
+    def get_version(cls):
+        version = cache.get(cls.version_cache_key)
+        if not version:
+            version = uuid.uuid4().hex[:8]
+            if not cache.add(cls.version_cache_key, version, None):
+                version = cache.get(cls.version_cache_key)
+        return version
+
+    @classmethod
+    def expire(cls):
+        cache.set(cls.version_cache_key, uuid.uuid4().hex[:8], None)
+
+    @classmethod
+    def get_rules_from_db(cls, system_user):
+        # 规则集是全局缓存的, 和当前组织无关, 在系统用户所在组织中查询
+        with tmp_to_org(system_user.org_id):
+            rules = CommandFilterRule.objects.filter(
+                filter__in=system_user.cmd_filters.all()
+            ).distinct().values_list('id', 'type', 'content', 'action', 'priority')
+            rules = list(rules)
+        return [
+            {
+                'id': str(rule_id), 'action': action, 'priority': priority,
+                'pattern': CommandFilterRule.get_pattern_source(tp, content),
+            }
+            for rule_id, tp, content, action, priority in rules
+        ]
+
+    @classmethod
+    def get(cls, system_user):
+        """
+        进程内缓存编译好的规则集, 只要版本号没变, 只需要访问一次缓存
+        """
+        version = cls.get_version()
+        if cls._local_version != version:
+            cls._local = {}
+            cls._local_version = version
+        system_user_id = str(system_user.id)
+        rule_set = cls._local.get(system_user_id)
+        if rule_set:
+            return rule_set
+
+        key = cls.cache_key.format(system_user_id, version)
+        rules = cache.get(key)
+        if rules is None:
+            rules = cls.get_rules_from_db(system_user)
+            cache.set(key, rules, cls.cache_ttl)
+        rule_set = cls(rules, version=version)
+        if len(cls._local) >= cls.local_max_size:
+            cls._local = {}
+        cls._local[system_user_id] = rule_set
+        return rule_set
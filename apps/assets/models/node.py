@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 #
 import uuid
-import re
 import time
+import threading
+from functools import reduce
 
 from django.db import models, transaction
 from django.db.models import Q
@@ -30,21 +31,44 @@ class TreeCache:
     updated_time_cache_key = 'NODE_TREE_UPDATED_AT_{}'
     cache_time = 3600
     assets_updated_time_cache_key = 'NODE_TREE_ASSETS_UPDATED_AT_{}'
-
-    def __init__(self, tree, org_id):
+    # 树的变更日志, 每个 worker 记录自己已应用到的序号, 增量应用变更, 不再整棵树重建
+    changes_seq_cache_key = 'NODE_TREE_CHANGES_SEQ_{}'
+    change_cache_key = 'NODE_TREE_CHANGE_{}_{}'
+    # 落后太多时, 直接重建比逐条应用更快
+    changes_apply_limit = 1000
+    # 序号先递增再写入变更, 后面的变更暂时读不到时先应用前面连续的部分,
+    # 超过这个时间还读不到 (已经过期) 才重建
+    changes_wait_time = 10
+    # 树的快照, 由一个进程构建, 其他进程直接加载, 从数据库建树只需要一次
+    # compact 引擎直接读取映射到内存的快照文件, 同一台机器上的 worker 共用一份,
+    # 每个进程只保存之后增量应用的修改; treelib 引擎加载后每个进程仍然持有自己的一份树
+    snapshot_cache_key = 'NODE_TREE_SNAPSHOT_{}'
+    snapshot_lock_key = 'NODE_TREE_SNAPSHOT_LOCK_{}'
+    snapshot_lock_time = 60
+    # 没有树可用时, 最多等待其他进程构建快照的时间, 超时自己构建
+    snapshot_wait_time = 5
+
+    def __init__(self, tree, org_id, seq=0):
         now = time.time()
         self.created_time = now
         self.assets_created_time = now
         self.tree = tree
         self.org_id = org_id
+        self.seq = seq
+        self.changes_missing_since = None
+        # 多个线程共用一个 TreeCache, 更新时加锁, 更新在树的副本上进行, 完成后整体替换,
+        # 正在读旧树的线程不受影响
+        self.lock = threading.Lock()
 
     def _has_changed(self, tp="tree"):
         if tp == "assets":
             key = self.assets_updated_time_cache_key.format(self.org_id)
+            created_time = self.assets_created_time
         else:
             key = self.updated_time_cache_key.format(self.org_id)
+            created_time = self.created_time
         updated_time = cache.get(key, 0)
-        if updated_time > self.created_time:
+        if updated_time > created_time:
             return True
         else:
             return False
@@ -62,6 +86,46 @@ class TreeCache:
             t = time.time()
         cache.set(key, t, ttl)
 
+    @classmethod
+    def get_latest_seq(cls, org_id):
+        key = cls.changes_seq_cache_key.format(org_id)
+        return cache.get(key, 0)
+
+    @classmethod
+    def publish_changes(cls, changes, org_id=None):
+        """
+        发布树的变更
+        :param changes: [('node_add', key, value), ('assets_add', key, assets_id), ...]
+        具体的变更类型见 TreeChangesMixin.apply_changes
+        """
+        if not changes:
+            return
+        if org_id is None:
+            org_id = current_org.id
+        seq_key = cls.changes_seq_cache_key.format(org_id)
+        cache.add(seq_key, 0, None)
+        end = cache.incr(seq_key, len(changes))
+        start = end - len(changes) + 1
+        data = {
+            cls.change_cache_key.format(org_id, seq): change
+            for seq, change in zip(range(start, end + 1), changes)
+        }
+        cache.set_many(data, cls.cache_time)
+
+    def get_changes(self, latest_seq):
+        keys = [
+            self.change_cache_key.format(self.org_id, seq)
+            for seq in range(self.seq + 1, latest_seq + 1)
+        ]
+        data = cache.get_many(keys)
+        # 有的变更已经过期，或者还没有写入, 只返回前面连续的部分
+        changes = []
+        for k in keys:
+            if k not in data:
+                break
+            changes.append(data[k])
+        return changes
+
     def tree_has_changed(self):
         return self._has_changed("tree")
 
@@ -76,31 +140,174 @@ class TreeCache:
         logger.debug("Set tree assets changed")
         self.__class__.set_changed(t=t, tp="assets")
 
-    def get(self):
+    def apply_changes(self, latest_seq):
+        if latest_seq == self.seq:
+            return
+        # 序号被重置 (如 redis 被清空)，或者落后太多
+        if latest_seq < self.seq or latest_seq - self.seq > self.changes_apply_limit:
+            self.renew()
+            return
+        changes = self.get_changes(latest_seq)
+        if changes:
+            tree = self.tree.copy()
+            try:
+                tree.apply_changes(changes)
+            except Exception as e:
+                logger.error("Apply node tree changes error: {}".format(e))
+                self.renew(from_db=True)
+                return
+            self.tree = tree
+            self.seq += len(changes)
+        if self.seq == latest_seq:
+            self.changes_missing_since = None
+            return
+        now = time.time()
+        if changes or self.changes_missing_since is None:
+            self.changes_missing_since = now
+        elif now - self.changes_missing_since > self.changes_wait_time:
+            logger.warning("Node tree changes missing after seq {}, renew".format(self.seq))
+            self.renew(from_db=True)
+
+    def update(self):
         if self.tree_has_changed():
             self.renew()
-            return self.tree
+            return
         if self.assets_has_changed():
-            self.tree.init_assets()
+            if getattr(self.tree, 'snapshot_shared', False):
+                # 重新加载资产会把共享的快照全部复制到进程内, 改为加载新的快照,
+                # 只由一个进程从数据库构建
+                self.renew()
+                return
+            tree = self.tree.copy()
+            tree.init_assets()
+            self.tree = tree
+            self.assets_created_time = time.time()
+        self.apply_changes(self.get_latest_seq(self.org_id))
+
+    def get(self):
+        has_changed = self.tree_has_changed() or self.assets_has_changed() \
+            or self.get_latest_seq(self.org_id) != self.seq
+        if has_changed:
+            with self.lock:
+                # 拿到锁时可能已经被其他线程更新过了, update 中会重新判断
+                self.update()
         return self.tree
 
-    def renew(self):
-        new_obj = self.__class__.new(self.org_id)
+    def renew(self, from_db=False):
+        new_obj = self.__class__.new(self.org_id, from_db=from_db, wait=False)
+        if new_obj is None:
+            # 其他进程正在构建, 先继续使用旧的树, 构建完成后下次请求再加载快照
+            return
         self.tree = new_obj.tree
         self.created_time = new_obj.created_time
         self.assets_created_time = new_obj.assets_created_time
+        self.seq = new_obj.seq
+        self.changes_missing_since = None
+
+    @classmethod
+    def get_snapshot(cls, org_id):
+        key = cls.snapshot_cache_key.format(org_id)
+        return cache.get(key)
+
+    @classmethod
+    def set_snapshot(cls, org_id, tree, seq, created_time):
+        key = cls.snapshot_cache_key.format(org_id)
+        snapshot = {
+            'seq': seq,
+            'created_time': created_time,
+            'data': tree.dump_snapshot(),
+        }
+        cache.set(key, snapshot, cls.cache_time)
+        return snapshot['data']
+
+    @classmethod
+    def is_snapshot_valid(cls, org_id, snapshot):
+        if not snapshot or not isinstance(snapshot, dict):
+            return False
+        created_time = snapshot.get('created_time', 0)
+        for key in [cls.updated_time_cache_key, cls.assets_updated_time_cache_key]:
+            if cache.get(key.format(org_id), 0) > created_time:
+                return False
+        # 快照之后的变更要能增量应用上
+        latest_seq = cls.get_latest_seq(org_id)
+        seq = snapshot.get('seq', 0)
+        if latest_seq < seq or latest_seq - seq > cls.changes_apply_limit:
+            return False
+        return True
 
     @classmethod
-    def new(cls, org_id=None):
-        from ..utils import TreeService
+    def new_from_snapshot(cls, org_id):
+        from ..utils import get_tree_service_class
+        snapshot = cls.get_snapshot(org_id)
+        if not cls.is_snapshot_valid(org_id, snapshot):
+            return None
+        tree = get_tree_service_class().load_snapshot(snapshot['data'])
+        if tree is None:
+            return None
+        logger.debug("Load node tree from snapshot")
+        obj = cls(tree, org_id, seq=snapshot['seq'])
+        obj.created_time = snapshot['created_time']
+        obj.assets_created_time = snapshot['created_time']
+        return obj
+
+    @classmethod
+    def wait_snapshot(cls, org_id):
+        # 其他进程正在构建，短暂等待它构建完直接加载快照, 间隔逐渐加长
+        lock_key = cls.snapshot_lock_key.format(org_id)
+        deadline = time.time() + cls.snapshot_wait_time
+        interval = 0.05
+        while time.time() < deadline and cache.get(lock_key):
+            time.sleep(interval)
+            interval = min(interval * 2, 1)
+        return cls.new_from_snapshot(org_id)
+
+    @classmethod
+    def new_from_db(cls, org_id):
+        from ..utils import get_tree_service_class
         logger.debug("Create node tree")
+        # 先取序号再建树, 建树过程中发生的变更会被再次应用, 变更的应用是幂等的
+        seq = cls.get_latest_seq(org_id)
+        created_time = time.time()
+        with tmp_to_org(org_id):
+            tree = get_tree_service_class().new()
+        data = cls.set_snapshot(org_id, tree, seq, created_time)
+        if tree.snapshot_shared:
+            # 构建的进程也使用共享的快照, 释放刚构建的树
+            tree = tree.load_snapshot(data) or tree
+        obj = cls(tree, org_id, seq=seq)
+        obj.created_time = created_time
+        obj.assets_created_time = created_time
+        return obj
+
+    @classmethod
+    def new(cls, org_id=None, from_db=False, wait=True):
+        """
+        :param wait: 其他进程正在构建时是否等待, 不等待直接返回 None
+        """
         if not org_id:
             org_id = current_org.id
-        with tmp_to_org(org_id):
-            tree = TreeService.new()
-            obj = cls(tree, org_id)
-            obj.tree = tree
-            return obj
+        lock_key = cls.snapshot_lock_key.format(org_id)
+        if not from_db:
+            if not wait and cache.get(lock_key):
+                return None
+            obj = cls.new_from_snapshot(org_id)
+            if obj is not None:
+                return obj
+
+        locked = cache.add(lock_key, 1, cls.snapshot_lock_time)
+        if not locked:
+            # 其他进程正在从数据库构建, 不再每个进程都构建一次
+            if not wait:
+                return None
+            if not from_db:
+                obj = cls.wait_snapshot(org_id)
+                if obj is not None:
+                    return obj
+        try:
+            return cls.new_from_db(org_id)
+        finally:
+            if locked:
+                cache.delete(lock_key)
 
 
 class TreeMixin:
@@ -113,7 +320,7 @@ class TreeMixin:
 
         if t is None:
             t = TreeCache.new()
-            cls._org_tree_map[org_id] = t
+            t = cls._org_tree_map.setdefault(org_id, t)
         return t.get()
 
     @classmethod
@@ -129,6 +336,20 @@ class TreeMixin:
     def refresh_node_assets(cls, t=None):
         TreeCache.set_changed(tp="assets", t=t, org_id=current_org.id)
 
+    @classmethod
+    def publish_tree_changes(cls, changes):
+        """
+        事务提交后发布到当前组织和 ROOT 组织, ROOT 组织的树包含所有组织的节点
+        回滚了的变更不会发布
+        """
+        org_id = current_org.id
+
+        def publish():
+            TreeCache.publish_changes(changes, org_id=org_id)
+            if org_id != Organization.ROOT_ID:
+                TreeCache.publish_changes(changes, org_id=Organization.ROOT_ID)
+        transaction.on_commit(publish)
+
 
 class FamilyMixin:
     __parents = None
@@ -164,6 +385,40 @@ class FamilyMixin:
             pattern += r'|^{0}$'.format(key)
         return pattern
 
+    @classmethod
+    def get_node_all_children_key_range(cls, key):
+        """
+        子孙节点的 key 都以 `key:` 开头，按字典序都落在 [`key:`, `key;`) 区间内，
+        (`;` 是 ASCII 中 `:` 的下一个字符)，这样就可以利用 key 上的唯一索引做范围扫描
+        """
+        return '{}:'.format(key), '{};'.format(key)
+
+    @classmethod
+    def get_node_all_children_key_q(cls, key, with_self=True, field='key'):
+        start, end = cls.get_node_all_children_key_range(key)
+        q = Q(**{'{}__gt'.format(field): start, '{}__lt'.format(field): end})
+        if with_self:
+            q |= Q(**{field: key})
+        return q
+
+    @classmethod
+    def get_nodes_all_children_key_q(cls, nodes_keys, with_self=True, field='key'):
+        nodes_keys = cls.clean_children_keys(nodes_keys)
+        if not nodes_keys:
+            return None
+        q_list = [
+            cls.get_node_all_children_key_q(key, with_self=with_self, field=field)
+            for key in nodes_keys
+        ]
+        return reduce(lambda x, y: x | y, q_list)
+
+    @classmethod
+    def get_node_children_key_q(cls, key, with_self=True):
+        q = Q(parent_key=key)
+        if with_self:
+            q |= Q(key=key)
+        return q
+
     def get_children_key_pattern(self, with_self=False):
         return self.get_node_children_key_pattern(self.key, with_self=with_self)
 
@@ -171,16 +426,15 @@ class FamilyMixin:
         return self.get_node_all_children_key_pattern(self.key, with_self=with_self)
 
     def is_children(self, other):
-        children_pattern = other.get_children_key_pattern(with_self=False)
-        return re.match(children_pattern, self.key)
+        return self.compute_parent_key(self.key) == other.key
 
     def get_children(self, with_self=False):
-        pattern = self.get_children_key_pattern(with_self=with_self)
-        return Node.objects.filter(key__regex=pattern)
+        q = self.get_node_children_key_q(self.key, with_self=with_self)
+        return Node.objects.filter(q)
 
     def get_all_children(self, with_self=False):
-        pattern = self.get_all_children_pattern(with_self=with_self)
-        children = Node.objects.filter(key__regex=pattern)
+        q = self.get_node_all_children_key_q(self.key, with_self=with_self)
+        children = Node.objects.filter(q)
         return children
 
     @property
@@ -255,10 +509,9 @@ class FamilyMixin:
         ancestor_keys = self.get_ancestor_keys(with_self=with_self)
         return self.__class__.objects.filter(key__in=ancestor_keys)
 
-    @property
-    def parent_key(self):
-        parent_key = ":".join(self.key.split(":")[:-1])
-        return parent_key
+    @staticmethod
+    def compute_parent_key(key):
+        return ":".join(key.split(":")[:-1])
 
     def is_parent(self, other):
         return other.is_children(self)
@@ -267,7 +520,7 @@ class FamilyMixin:
     def parent(self):
         if self.is_org_root():
             return self
-        parent_key = self.parent_key
+        parent_key = self.compute_parent_key(self.key)
         return Node.objects.get(key=parent_key)
 
     @parent.setter
@@ -285,11 +538,8 @@ class FamilyMixin:
                 child.save()
 
     def get_siblings(self, with_self=False):
-        key = ':'.join(self.key.split(':')[:-1])
-        pattern = r'^{}:[0-9]+$'.format(key)
-        sibling = Node.objects.filter(
-            key__regex=pattern.format(self.key)
-        )
+        parent_key = self.compute_parent_key(self.key)
+        sibling = Node.objects.filter(parent_key=parent_key)
         if not with_self:
             sibling = sibling.exclude(key=self.key)
         return sibling
@@ -324,8 +574,8 @@ class NodeAssetsMixin:
         from .asset import Asset
         if self.is_org_root():
             return Asset.objects.filter(org_id=self.org_id)
-        pattern = '^{0}$|^{0}:'.format(self.key)
-        return Asset.objects.filter(nodes__key__regex=pattern).distinct()
+        q = self.get_node_all_children_key_q(self.key, field='nodes__key')
+        return Asset.objects.filter(q).distinct()
 
     def get_assets(self):
         from .asset import Asset
@@ -344,18 +594,15 @@ class NodeAssetsMixin:
     @classmethod
     def _get_nodes_all_assets(cls, nodes_keys):
         """
-        当节点比较多的时候，这种正则方式性能差极了
+        使用 key 的范围查询代替正则，可以走索引
         :param nodes_keys:
         :return:
         """
         from .asset import Asset
-        nodes_keys = cls.clean_children_keys(nodes_keys)
-        nodes_children_pattern = set()
-        for key in nodes_keys:
-            children_pattern = cls.get_node_all_children_key_pattern(key)
-            nodes_children_pattern.add(children_pattern)
-        pattern = '|'.join(nodes_children_pattern)
-        return Asset.objects.filter(nodes__key__regex=pattern).distinct()
+        q = cls.get_nodes_all_children_key_q(nodes_keys, field='nodes__key')
+        if q is None:
+            return Asset.objects.none()
+        return Asset.objects.filter(q).distinct()
 
     @classmethod
     def get_nodes_all_assets_ids(cls, nodes_keys):
@@ -399,7 +646,7 @@ class SomeNodesMixin:
     @classmethod
     def get_next_org_root_node_key(cls):
         with tmp_to_org(Organization.root()):
-            org_nodes_roots = cls.objects.filter(key__regex=r'^[0-9]+$')
+            org_nodes_roots = cls.objects.filter(parent_key='', key__regex=r'^[0-9]+$')
             org_nodes_roots_keys = org_nodes_roots.values_list('key', flat=True)
             if not org_nodes_roots_keys:
                 org_nodes_roots_keys = ['1']
@@ -420,7 +667,7 @@ class SomeNodesMixin:
 
     @classmethod
     def org_root(cls):
-        root = cls.objects.filter(key__regex=r'^[0-9]+$')
+        root = cls.objects.filter(parent_key='', key__regex=r'^[0-9]+$')
         if root:
             return root[0]
         else:
@@ -499,6 +746,7 @@ class SomeNodesMixin:
 class Node(OrgModelMixin, SomeNodesMixin, TreeMixin, FamilyMixin, FullValueMixin, NodeAssetsMixin):
     id = models.UUIDField(default=uuid.uuid4, primary_key=True)
     key = models.CharField(unique=True, max_length=64, verbose_name=_("Key"))  # '1:1:1:1'
+    parent_key = models.CharField(max_length=64, default='', db_index=True, verbose_name=_("Parent key"))  # '1:1:1'
     value = models.CharField(max_length=128, verbose_name=_("Value"))
     child_mark = models.IntegerField(default=0)
     date_create = models.DateTimeField(auto_now_add=True)
@@ -506,6 +754,7 @@ class Node(OrgModelMixin, SomeNodesMixin, TreeMixin, FamilyMixin, FullValueMixin
     objects = OrgManager.from_queryset(NodeQuerySet)()
     is_node = True
     _parents = None
+    _original_key = None
 
     class Meta:
         verbose_name = _("Node")
@@ -536,6 +785,20 @@ class Node(OrgModelMixin, SomeNodesMixin, TreeMixin, FamilyMixin, FullValueMixin
     def name(self):
         return self.value
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 记录原始 key, post_save 时据此判断节点是否被移动了
+        instance._original_key = instance.__dict__.get('key')
+        return instance
+
+    def save(self, *args, **kwargs):
+        # parent_key 冗余存储并建立索引，查询直接子节点时不用再做正则匹配
+        self.parent_key = self.compute_parent_key(self.key)
+        result = super().save(*args, **kwargs)
+        self._original_key = self.key
+        return result
+
     @property
     def level(self):
         return len(self.key.split(':'))
@@ -177,13 +177,16 @@ class SystemUser(BaseUser):
         ).distinct()
         return rules
 
+    @property
+    def cmd_filter_rule_set(self):
+        from .cmd_filter import CommandFilterRuleSet
+        return CommandFilterRuleSet.get(self)
+
     def is_command_can_run(self, command):
-        for rule in self.cmd_filter_rules:
-            action, matched_cmd = rule.match(command)
-            if action == rule.ACTION_ALLOW:
-                return True, None
-            elif action == rule.ACTION_DENY:
-                return False, matched_cmd
+        from .cmd_filter import CommandFilterRule
+        action, matched_cmd = self.cmd_filter_rule_set.match(command)
+        if action == CommandFilterRule.ACTION_DENY:
+            return False, matched_cmd
         return True, None
 
     def get_all_assets(self):
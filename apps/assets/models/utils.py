@@ -87,6 +87,25 @@ class Connectivity:
             value = cls.unknown()
         return value
 
+    @classmethod
+    def set_many(cls, data, ttl=None):
+        if data:
+            cache.set_many(data, ttl)
+
+    @classmethod
+    def get_many(cls, keys):
+        """
+        一次从缓存中取多个, 没有的返回 unknown
+        """
+        values = cache.get_many(keys)
+        data = {}
+        for key in keys:
+            value = values.get(key)
+            if not isinstance(value, cls):
+                value = cls.unknown()
+            data[key] = value
+        return data
+
     @classmethod
     def set_unreachable(cls, key, ttl=0):
         cls.set(key, cls.unreachable(), ttl)
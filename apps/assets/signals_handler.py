@@ -9,9 +9,10 @@ from django.dispatch import receiver
 
 from common.utils import get_logger
 from common.decorator import on_transaction_commit
-from orgs.utils import tmp_to_root_org
-from .models import Asset, SystemUser, Node, AuthBook
-from .utils import TreeService
+from .models import (
+    Asset, SystemUser, Node, AuthBook, CommandFilter, CommandFilterRule,
+    CommandFilterRuleSet,
+)
 from .tasks import (
     update_assets_hardware_info_util,
     test_asset_connectivity_util,
@@ -60,7 +61,7 @@ def on_asset_delete(sender, instance=None, **kwargs):
     当资产删除时，刷新节点，节点中存在节点和资产的关系
     """
     logger.debug("Asset delete signal recv: {}".format(instance))
-    Node.refresh_assets()
+    Node.publish_tree_changes([('assets_delete', [instance.id])])
 
 
 @receiver(post_save, sender=SystemUser, dispatch_uid="jms")
@@ -77,6 +78,21 @@ def on_system_user_update(sender, instance=None, created=True, **kwargs):
         push_system_user_to_assets.delay(instance, assets)
 
 
+@receiver(post_save, sender=CommandFilter)
+@receiver(post_delete, sender=CommandFilter)
+@receiver(post_save, sender=CommandFilterRule)
+@receiver(post_delete, sender=CommandFilterRule)
+@on_transaction_commit
+def on_cmd_filter_change(sender, instance=None, **kwargs):
+    CommandFilterRuleSet.expire()
+
+
+@receiver(m2m_changed, sender=SystemUser.cmd_filters.through)
+def on_system_user_cmd_filters_change(sender, action='', **kwargs):
+    if action.startswith('post'):
+        CommandFilterRuleSet.expire()
+
+
 @receiver(m2m_changed, sender=SystemUser.assets.through)
 def on_system_user_assets_change(sender, instance=None, action='', model=None, pk_set=None, **kwargs):
     """
@@ -149,15 +165,36 @@ def on_system_user_groups_change(sender, instance=None, action=None, model=None,
 
 
 @receiver(m2m_changed, sender=Asset.nodes.through)
-def on_asset_nodes_change(sender, instance=None, action='', **kwargs):
+def on_asset_nodes_change(sender, instance=None, action='', model=None,
+                          pk_set=None, **kwargs):
     """
-    资产节点发生变化时，刷新节点
+    资产节点发生变化时，发布节点树的变更
     """
-    if action.startswith('post'):
-        logger.debug("Asset nodes change signal recv: {}".format(instance))
-        Node.refresh_assets()
-        with tmp_to_root_org():
-            Node.refresh_assets()
+    if action == "pre_clear":
+        # 清空后就拿不到关系了，先记录下来
+        if model == Node:
+            instance._tree_nodes_keys = list(instance.nodes.values_list('key', flat=True))
+        else:
+            instance._tree_assets_id = list(instance.assets.values_list('id', flat=True))
+        return
+    if action not in ["post_add", "post_remove", "post_clear"]:
+        return
+    logger.debug("Asset nodes change signal recv: {}".format(instance))
+
+    tp = "assets_add" if action == "post_add" else "assets_remove"
+    if model == Node:
+        if action == "post_clear":
+            nodes_keys = instance.__dict__.pop('_tree_nodes_keys', [])
+        else:
+            nodes_keys = model.objects.filter(pk__in=pk_set).values_list('key', flat=True)
+        changes = [(tp, key, [instance.id]) for key in nodes_keys]
+    else:
+        if action == "post_clear":
+            assets_id = instance.__dict__.pop('_tree_assets_id', [])
+        else:
+            assets_id = list(pk_set)
+        changes = [(tp, instance.key, assets_id)]
+    Node.publish_tree_changes(changes)
 
 
 @receiver(m2m_changed, sender=Asset.nodes.through)
@@ -177,9 +214,8 @@ def on_asset_nodes_add(sender, instance=None, action='', model=None, pk_set=None
         assets = model.objects.filter(pk__in=pk_set).values_list('id', flat=True)
     # 节点资产发生变化时，将资产关联到节点及祖先节点关联的系统用户, 只关注新增的
     nodes_ancestors_keys = set()
-    node_tree = TreeService.new()
     for node in nodes:
-        ancestors_keys = node_tree.ancestors_ids(nid=node)
+        ancestors_keys = Node.get_node_ancestor_keys(node, with_self=True)
         nodes_ancestors_keys.update(ancestors_keys)
     system_users = SystemUser.objects.filter(nodes__key__in=nodes_ancestors_keys)
 
@@ -230,9 +266,19 @@ def on_asset_nodes_remove(sender, instance=None, action='', model=None,
     Node.org_root().assets.add(*tuple(assets_not_has_node))
 
 
-@receiver([post_save, post_delete], sender=Node)
-def on_node_update_or_created(sender, **kwargs):
-    # 刷新节点
-    Node.refresh_nodes()
-    with tmp_to_root_org():
-        Node.refresh_nodes()
+@receiver(post_save, sender=Node)
+def on_node_update_or_created(sender, instance=None, created=False, **kwargs):
+    # 发布节点树的变更, 各个 worker 增量更新自己的树
+    original_key = instance._original_key
+    if created or not original_key:
+        change = ('node_add', instance.key, instance.value)
+    elif original_key != instance.key:
+        change = ('node_move', original_key, instance.key, instance.value)
+    else:
+        change = ('node_update', instance.key, instance.value)
+    Node.publish_tree_changes([change])
+
+
+@receiver(post_delete, sender=Node)
+def on_node_delete(sender, instance=None, **kwargs):
+    Node.publish_tree_changes([('node_remove', instance.key)])
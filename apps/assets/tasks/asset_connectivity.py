@@ -9,6 +9,7 @@ from orgs.utils import org_aware_func
 from ..models.utils import Connectivity
 from . import const
 from .utils import clean_ansible_task_hosts, group_asset_by_platform
+from .common import run_ansible_task_sharded
 
 
 logger = get_logger(__file__)
@@ -21,8 +22,6 @@ __all__ = [
 @shared_task(queue="ansible")
 @org_aware_func("assets")
 def test_asset_connectivity_util(assets, task_name=None):
-    from ops.utils import update_or_create_ansible_task
-
     if task_name is None:
         task_name = _("Test assets connectivity")
 
@@ -47,11 +46,11 @@ def test_asset_connectivity_util(assets, task_name=None):
             continue
         logger.debug("System user not has special auth")
         tasks = platform_tasks_map.get(platform)
-        task, created = update_or_create_ansible_task(
-            task_name=task_name, hosts=_hosts, tasks=tasks,
-            pattern='all', options=const.TASK_OPTIONS, run_as_admin=True,
+        # 主机多时会拆成多个分片并行执行, 每个分片执行完就更新可连接性
+        summary = run_ansible_task_sharded(
+            task_name, _hosts, tasks, options=const.TASK_OPTIONS,
+            run_as_admin=True, shard_callback=set_assets_connectivity_by_result,
         )
-        raw, summary = task.run()
         success = summary.get('success', False)
         contacted = summary.get('contacted', {})
         dark = summary.get('dark', {})
@@ -59,16 +58,44 @@ def test_asset_connectivity_util(assets, task_name=None):
         results_summary['success'] &= success
         results_summary['contacted'].update(contacted)
         results_summary['dark'].update(dark)
-        continue
 
+    # 不能执行 ansible 的资产, 可连接性未知
+    hosts_id = {host.id for host in hosts}
+    skipped = [asset for asset in assets if asset.id not in hosts_id]
+    set_assets_connectivity(skipped, {})
+    return results_summary
+
+
+def set_assets_connectivity_by_result(assets, result):
+    raw, summary = result
+    set_assets_connectivity(assets, summary)
+
+
+def set_assets_connectivity(assets, summary):
+    """
+    批量写入资产 (管理用户) 的可连接性, 管理用户名一次查出来, 缓存一次写入
+    """
+    from ..models import AdminUser, ConnectivityMixin
+
+    admin_users_id = {asset.admin_user_id for asset in assets if asset.admin_user_id}
+    admin_users_username = dict(
+        AdminUser.objects.filter(id__in=admin_users_id).values_list('id', 'username')
+    )
+    dark = summary.get('dark', {}).keys()
+    contacted = summary.get('contacted', {}).keys()
+    data = []
     for asset in assets:
-        if asset.hostname in results_summary.get('dark', {}).keys():
-            asset.connectivity = Connectivity.unreachable()
-        elif asset.hostname in results_summary.get('contacted', {}).keys():
-            asset.connectivity = Connectivity.reachable()
+        username = admin_users_username.get(asset.admin_user_id)
+        if not username:
+            continue
+        if asset.hostname in dark:
+            c = Connectivity.unreachable()
+        elif asset.hostname in contacted:
+            c = Connectivity.reachable()
         else:
-            asset.connectivity = Connectivity.unknown()
-    return results_summary
+            c = Connectivity.unknown()
+        data.append((asset, username, c))
+    ConnectivityMixin.set_assets_username_connectivity(data)
 
 
 @shared_task(queue="ansible")
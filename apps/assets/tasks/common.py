@@ -1,9 +1,25 @@
 # -*- coding: utf-8 -*-
 #
 
+import time
+import uuid
+
 from celery import shared_task
+from celery.result import allow_join_result
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import ugettext as _
+
+from orgs.utils import org_aware_func
+from . import const
+
+__all__ = [
+    'add_nodes_assets_to_system_users', 'run_ansible_task_shard',
+    'run_ansible_task_sharded',
+]
 
-__all__ = ['add_nodes_assets_to_system_users']
+SHARD_CLAIM_TIMEOUT = 3600 * 6
+SHARD_POLL_INTERVAL = 1
 
 
 @shared_task
@@ -12,3 +28,140 @@ def add_nodes_assets_to_system_users(nodes_keys, system_users):
     assets = Node.get_nodes_all_assets(nodes_keys).values_list('id', flat=True)
     for system_user in system_users:
         system_user.assets.add(*tuple(assets))
+
+
+def merge_ansible_summaries(summaries):
+    merged = dict(contacted={}, dark={}, success=True)
+    for summary in summaries:
+        if not summary:
+            continue
+        merged['success'] &= summary.get('success', False)
+        merged['contacted'].update(summary.get('contacted', {}))
+        merged['dark'].update(summary.get('dark', {}))
+    return merged
+
+
+@shared_task(queue="ansible")
+@org_aware_func("hosts")
+def run_ansible_task_shard(task_name, hosts, tasks, options=None,
+                           run_as_admin=False, run_as=None,
+                           shard_callback=None, shard=(1, 1), claim_key=None):
+    """
+    执行一个分片, 分片有自己的任务名, 避免并行的分片互相覆盖 adhoc
+    :param shard_callback: 分片执行完的回调 callback(hosts, (raw, summary))
+    :param shard: (第几个分片, 分片总数)
+    :param claim_key: 分片可能已经被等待的父任务领取执行了, 领取不到直接返回 None
+    """
+    from ops.utils import update_or_create_ansible_task
+
+    if claim_key is not None and not claim_ansible_task_shard(claim_key):
+        return None
+    index, total = shard
+    if total > 1:
+        task_name = '{} ({}/{})'.format(task_name, index, total)
+    print(_("Start shard {}/{}, hosts count: {}").format(index, total, len(hosts)))
+    task, created = update_or_create_ansible_task(
+        task_name=task_name, hosts=hosts, tasks=tasks, pattern='all',
+        options=options, run_as_admin=run_as_admin, run_as=run_as,
+    )
+    result = task.run()
+    raw, summary = result
+    if shard_callback is not None:
+        shard_callback(hosts, result)
+    print_shard_finished(shard, summary)
+    return summary
+
+
+def claim_ansible_task_shard(claim_key):
+    return cache.add(claim_key, 1, SHARD_CLAIM_TIMEOUT)
+
+
+def print_shard_finished(shard, summary):
+    index, total = shard
+    print(_("Shard {}/{} finished, contacted: {}, dark: {}").format(
+        index, total, len(summary.get('contacted', {})), len(summary.get('dark', {}))
+    ))
+
+
+def wait_ansible_task_shards(task_name, shards, tasks, results, claim_keys, **kwargs):
+    """
+    等待所有分片执行完, 每个分片完成时在当前任务的日志中输出进度, 返回各分片的 summary
+    还没有 worker 领取的分片在当前任务中执行, 避免 ansible 队列的 worker 都在等待分片时死锁
+    """
+    total = len(shards)
+    summaries = {}
+    while len(summaries) < total:
+        progress = False
+        for i, hosts in enumerate(shards):
+            if i in summaries or not claim_ansible_task_shard(claim_keys[i]):
+                continue
+            summaries[i] = run_ansible_task_shard(
+                task_name, hosts, tasks, shard=(i + 1, total), **kwargs
+            )
+            progress = True
+
+        for i, result in enumerate(results):
+            if i in summaries or not result.ready():
+                continue
+            with allow_join_result():
+                summary = result.get(propagate=False)
+            if result.failed():
+                print(_("Shard {}/{} failed: {}").format(i + 1, total, summary))
+                summary = dict(contacted={}, dark={}, success=False)
+            else:
+                print_shard_finished((i + 1, total), summary)
+            summaries[i] = summary
+            progress = True
+
+        if progress:
+            print(_("Shards finished: {}/{}").format(len(summaries), total))
+        else:
+            time.sleep(SHARD_POLL_INTERVAL)
+    return [summaries[i] for i in range(total)]
+
+
+def run_ansible_task_sharded(task_name, hosts, tasks, options=None,
+                             run_as_admin=False, run_as=None,
+                             shard_callback=None, callback=None):
+    """
+    主机按分片拆分成多个 celery 子任务, 在 ansible 队列上并行执行, 等待所有分片完成后合并 summary
+    主机数不超过一个分片时, 直接在当前进程执行
+    """
+    options = dict(options or const.TASK_OPTIONS)
+    options['forks'] = settings.ANSIBLE_TASK_FORKS
+    shard_size = settings.ANSIBLE_TASK_SHARD_SIZE
+    kwargs = dict(
+        options=options, run_as_admin=run_as_admin, run_as=run_as,
+        shard_callback=shard_callback,
+    )
+    hosts = list(hosts)
+    if len(hosts) <= shard_size:
+        summary = run_ansible_task_shard(task_name, hosts, tasks, **kwargs)
+        if callback is not None:
+            callback(summary)
+        return summary
+
+    shards = [hosts[i:i + shard_size] for i in range(0, len(hosts), shard_size)]
+    total = len(shards)
+    print(_("Hosts count: {}, split to {} shards").format(len(hosts), total))
+    prefix = 'ANSIBLE_TASK_SHARD_{}'.format(uuid.uuid4().hex)
+    claim_keys = ['{}_{}'.format(prefix, i) for i in range(total)]
+    results = []
+    for i, _hosts in enumerate(shards):
+        result = run_ansible_task_shard.apply_async(
+            args=(task_name, _hosts, tasks),
+            kwargs=dict(shard=(i + 1, total), claim_key=claim_keys[i], **kwargs),
+        )
+        print(_("Shard {}/{} task: {}").format(i + 1, total, result.id))
+        results.append(result)
+
+    summaries = wait_ansible_task_shards(
+        task_name, shards, tasks, results, claim_keys, **kwargs
+    )
+    summary = merge_ansible_summaries(summaries)
+    print(_("Task {} all shards finished, contacted: {}, dark: {}").format(
+        task_name, len(summary['contacted']), len(summary['dark'])
+    ))
+    if callback is not None:
+        callback(summary)
+    return summary
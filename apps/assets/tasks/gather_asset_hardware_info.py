@@ -12,6 +12,7 @@ from common.utils import (
 from orgs.utils import org_aware_func
 from . import const
 from .utils import clean_ansible_task_hosts
+from .common import run_ansible_task_sharded
 
 
 logger = get_logger(__file__)
@@ -91,20 +92,16 @@ def update_assets_hardware_info_util(assets, task_name=None):
     :param task_name: task_name running
     :return: result summary ['contacted': {}, 'dark': {}]
     """
-    from ops.utils import update_or_create_ansible_task
     if task_name is None:
         task_name = _("Update some assets hardware info")
     tasks = const.UPDATE_ASSETS_HARDWARE_TASKS
     hosts = clean_ansible_task_hosts(assets)
     if not hosts:
         return {}
-    task, created = update_or_create_ansible_task(
-        task_name, hosts=hosts, tasks=tasks,
-        pattern='all', options=const.TASK_OPTIONS,
-        run_as_admin=True,
+    run_ansible_task_sharded(
+        task_name, hosts, tasks, options=const.TASK_OPTIONS,
+        run_as_admin=True, shard_callback=set_assets_hardware_info,
     )
-    result = task.run()
-    set_assets_hardware_info(assets, result)
     return True
 
 
@@ -9,6 +9,7 @@ from common.utils import encrypt_password, get_logger
 from orgs.utils import org_aware_func
 from . import const
 from .utils import clean_ansible_task_hosts, group_asset_by_platform
+from .common import run_ansible_task_sharded
 
 
 logger = get_logger(__file__)
@@ -181,7 +182,6 @@ def get_push_system_user_tasks(system_user, platform="unixlike", username=None):
 
 @org_aware_func("system_user")
 def push_system_user_util(system_user, assets, task_name, username=None):
-    from ops.utils import update_or_create_ansible_task
     hosts = clean_ansible_task_hosts(assets, system_user=system_user)
     if not hosts:
         return {}
@@ -195,11 +195,10 @@ def push_system_user_util(system_user, assets, task_name, username=None):
     def run_task(_tasks, _hosts):
         if not _tasks:
             return
-        task, created = update_or_create_ansible_task(
-            task_name=task_name, hosts=_hosts, tasks=_tasks, pattern='all',
-            options=const.TASK_OPTIONS, run_as_admin=True,
+        run_ansible_task_sharded(
+            task_name, _hosts, _tasks, options=const.TASK_OPTIONS,
+            run_as_admin=True,
         )
-        task.run()
 
     for platform, _hosts in platform_hosts_map.items():
         if not _hosts:
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+#
+import os
+import random
+import shutil
+import tempfile
+import uuid
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from assets.utils import TreeService, CompactTreeService, OverlaySequence
+
+
+def make_nodes(rnd, depth=3, width=3, assets_count=30):
+    """
+    生成 [(key, value, assets)], 父节点在前
+    """
+    assets = [uuid.uuid4() for _ in range(assets_count)]
+    nodes = []
+    parents = ['1']
+    nodes.append(('1', 'Default', set(rnd.sample(assets, 3))))
+    for __ in range(depth):
+        children = []
+        for parent in parents:
+            for i in range(1, width + 1):
+                key = '{}:{}'.format(parent, i)
+                node_assets = set(rnd.sample(assets, rnd.randint(0, 3)))
+                nodes.append((key, 'node-{}'.format(key), node_assets))
+                children.append(key)
+        parents = children
+    return nodes, assets
+
+
+def build_tree(cls, nodes):
+    tree = cls()
+    tree.create_node(tag='', identifier='', data={"assets": set(), "all_assets": None})
+    for key, value, assets in nodes:
+        parent = ':'.join(key.split(':')[:-1])
+        tree.safe_create_node(
+            tag=value, identifier=key, parent=parent,
+            data={"assets": set(assets), "all_assets": None}
+        )
+    return tree
+
+
+class CompactTreeServiceTestCase(SimpleTestCase):
+    """
+    CompactTreeService 和 TreeService 的结果要一致
+    """
+    def setUp(self):
+        self.rnd = random.Random(0)
+        self.nodes, self.assets = make_nodes(self.rnd)
+        self.tree = build_tree(TreeService, self.nodes)
+        self.compact = build_tree(CompactTreeService, self.nodes)
+
+    def assertTreeEqual(self, tree, compact):
+        nodes_id = tree.all_children_ids(tree.root)
+        self.assertEqual(set(nodes_id), set(compact.all_children_ids(compact.root)))
+        self.assertEqual(len(tree), len(compact))
+        for nid in nodes_id:
+            self.assertEqual(tree.ancestors_ids(nid), compact.ancestors_ids(nid))
+            self.assertEqual(tree.get_node_full_tag(nid), compact.get_node_full_tag(nid))
+            self.assertEqual(
+                sorted(n.identifier for n in tree.children(nid)),
+                sorted(n.identifier for n in compact.children(nid))
+            )
+            self.assertEqual(set(tree.assets(nid)), compact.assets(nid))
+            self.assertEqual(set(tree.all_assets(nid)), compact.all_assets(nid))
+            self.assertEqual(tree.assets_amount(nid), compact.assets_amount(nid))
+
+    def test_build(self):
+        self.assertTreeEqual(self.tree, self.compact)
+
+    def test_valid_assets(self):
+        invalid = set(self.rnd.sample(self.assets, 10))
+        for tree in (self.tree, self.compact):
+            tree.invalid_assets = invalid
+        for nid in self.tree.all_children_ids(self.tree.root):
+            self.assertEqual(
+                self.tree.all_valid_assets(nid), self.compact.all_valid_assets(nid)
+            )
+            self.assertEqual(
+                self.tree.valid_assets_amount(nid), self.compact.valid_assets_amount(nid)
+            )
+
+    def test_init_assets_reset_invalid_assets(self):
+        invalid = {self.compact._assets[0]}
+        self.compact.invalid_assets = invalid
+        self.tree.invalid_assets = invalid
+        self.compact.valid_assets_amount('1')
+        # 重新加载资产后资产重新编号, 根节点的新资产排在最前面
+        nodes_assets_map = {key: assets for key, value, assets in self.nodes}
+        nodes_assets_map[''] = {uuid.uuid4()}
+        with mock.patch.object(TreeService, 'get_nodes_assets_map', return_value=nodes_assets_map):
+            self.compact.init_assets()
+        self.compact.invalid_assets = invalid
+        for nid in self.tree.all_children_ids('1'):
+            self.assertEqual(
+                self.tree.all_valid_assets(nid), self.compact.all_valid_assets(nid)
+            )
+            self.assertEqual(
+                self.tree.valid_assets_amount(nid), self.compact.valid_assets_amount(nid)
+            )
+
+    def test_subtree_paste(self):
+        for tree in (self.tree, self.compact):
+            subtree = tree.subtree('1:1')
+            tree.remove_node('1:1')
+            tree.paste('1:2:1', subtree)
+        self.assertTreeEqual(self.tree, self.compact)
+        self.assertEqual(self.compact.ancestors_ids('1:1:1'), ['1:1:1', '1:1', '1:2:1', '1:2', '1'])
+
+    def random_changes(self, tree, count=300):
+        changes = []
+        seq = 100
+        for __ in range(count):
+            nodes_id = [n for n in tree.all_children_ids(tree.root)]
+            key = self.rnd.choice(nodes_id[1:]) if len(nodes_id) > 1 else None
+            action = self.rnd.choice([
+                'node_add', 'node_update', 'node_move', 'node_remove',
+                'assets_add', 'assets_remove', 'assets_delete',
+            ])
+            if action == 'node_add' or key is None:
+                seq += 1
+                parent = self.rnd.choice(nodes_id[1:] or ['1'])
+                change = ('node_add', '{}:{}'.format(parent, seq), 'new-{}'.format(seq))
+            elif action == 'node_update':
+                change = ('node_update', key, 'update-{}'.format(seq))
+            elif action == 'node_move':
+                subtree = set(tree.all_children_ids(key))
+                parents = [n for n in nodes_id[1:] if n not in subtree]
+                if not parents:
+                    continue
+                seq += 1
+                new_key = '{}:{}'.format(self.rnd.choice(parents), seq)
+                change = ('node_move', key, new_key, 'move-{}'.format(seq))
+            elif action == 'node_remove':
+                change = ('node_remove', key)
+            elif action == 'assets_add':
+                change = ('assets_add', key, self.rnd.sample(self.assets, 3))
+            elif action == 'assets_remove':
+                change = ('assets_remove', key, self.rnd.sample(self.assets, 3))
+            else:
+                change = ('assets_delete', self.rnd.sample(self.assets, 1))
+            tree.apply_changes([change])
+            changes.append(change)
+        return changes
+
+    def test_apply_changes(self):
+        changes = self.random_changes(self.tree)
+        self.compact.apply_changes(changes)
+        self.assertTreeEqual(self.tree, self.compact)
+        # 每个变更都是幂等的
+        for change in changes[-20:]:
+            self.tree.apply_changes([change])
+            self.compact.apply_changes([change, change])
+            self.assertTreeEqual(self.tree, self.compact)
+
+    def test_copy(self):
+        compact = self.compact.copy()
+        compact.apply_changes([('node_remove', '1:1'), ('assets_add', '1:2', [self.assets[0]])])
+        self.assertTreeEqual(self.tree, self.compact)
+        self.assertNotIn('1:1', compact)
+
+    def test_compact_removed_nodes(self):
+        self.compact.compact_threshold = 5
+        for key in ('1:1', '1:2'):
+            self.tree.remove_node(key)
+            self.compact.remove_node(key)
+        # 空位比有效节点多, 已经重新编号
+        self.assertEqual(len(self.compact._keys), len(self.compact))
+        self.assertTreeEqual(self.tree, self.compact)
+        changes = self.random_changes(self.tree)
+        self.compact.apply_changes(changes)
+        self.assertTreeEqual(self.tree, self.compact)
+
+    def test_snapshot(self):
+        self.tree.apply_changes([('node_remove', '1:1')])
+        self.compact.apply_changes([('node_remove', '1:1')])
+        tree = TreeService.load_snapshot(self.compact.dump_snapshot())
+        self.assertTreeEqual(tree, self.compact)
+        tree = TreeService.load_snapshot(self.tree.dump_snapshot())
+        self.assertTreeEqual(tree, self.compact)
+
+
+class SharedCompactTreeServiceTestCase(CompactTreeServiceTestCase):
+    """
+    从映射的快照文件加载的树, 修改只记录在进程内, 结果和 TreeService 一致
+    """
+    def setUp(self):
+        super().setUp()
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.snapshot_dir)
+        with override_settings(ASSETS_TREE_SNAPSHOT_DIR=self.snapshot_dir):
+            self.compact = CompactTreeService.load_snapshot(self.compact.dump_snapshot())
+
+    def test_mapped(self):
+        self.assertIsInstance(self.compact._keys, OverlaySequence)
+        self.assertEqual(len(os.listdir(self.snapshot_dir)), 1)
+        # 同一个快照再次加载, 映射同一个文件
+        with override_settings(ASSETS_TREE_SNAPSHOT_DIR=self.snapshot_dir):
+            CompactTreeService.load_snapshot(self.compact.dump_snapshot())
+            CompactTreeService.load_snapshot(self.compact.dump_snapshot())
+        self.assertEqual(len(os.listdir(self.snapshot_dir)), 1)
+
+    def test_copy_not_change_snapshot(self):
+        compact = self.compact.copy()
+        changes = self.random_changes(self.tree)
+        compact.apply_changes(changes)
+        self.assertTreeEqual(self.tree, compact)
+        # 原来的树没有变化
+        origin = build_tree(TreeService, self.nodes)
+        self.assertTreeEqual(origin, self.compact)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from assets.models.node import TreeCache
+from assets.utils import CompactTreeService
+
+
+class FakeCache:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def get_many(self, keys):
+        return {k: self.data[k] for k in keys if k in self.data}
+
+    def set(self, key, value, timeout=None):
+        self.data[key] = value
+
+    def set_many(self, data, timeout=None):
+        self.data.update(data)
+
+    def add(self, key, value, timeout=None):
+        if key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+    def incr(self, key, delta=1):
+        self.data[key] += delta
+        return self.data[key]
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class TreeCacheChangesTestCase(SimpleTestCase):
+    org_id = 'org'
+
+    def setUp(self):
+        self.cache = FakeCache()
+        patcher = mock.patch('assets.models.node.cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        tree = CompactTreeService()
+        tree.create_node(tag='', identifier='', data={"assets": set(), "all_assets": None})
+        tree.create_node(tag='Default', identifier='1', parent='',
+                         data={"assets": set(), "all_assets": None})
+        self.tree_cache = TreeCache(tree, self.org_id)
+        renew = mock.patch.object(TreeCache, 'renew')
+        self.renew = renew.start()
+        self.addCleanup(renew.stop)
+
+    def publish(self, changes, written=True):
+        # written=False 模拟序号已经递增, 变更还没有写入
+        with mock.patch.object(self.cache, 'set_many') as set_many:
+            TreeCache.publish_changes(changes, org_id=self.org_id)
+        if written:
+            self.cache.set_many(*set_many.call_args[0])
+        return set_many.call_args[0][0]
+
+    def test_changes_not_written_yet(self):
+        self.publish([('node_add', '1:1', 'a')])
+        pending = self.publish([('node_add', '1:2', 'b')], written=False)
+
+        tree = self.tree_cache.get()
+        # 先应用已经写入的部分, 不从数据库重建
+        self.renew.assert_not_called()
+        self.assertIn('1:1', tree)
+        self.assertNotIn('1:2', tree)
+        self.assertEqual(self.tree_cache.seq, 1)
+
+        self.cache.set_many(pending)
+        tree = self.tree_cache.get()
+        self.renew.assert_not_called()
+        self.assertIn('1:2', tree)
+        self.assertEqual(self.tree_cache.seq, 2)
+        self.assertIsNone(self.tree_cache.changes_missing_since)
+
+    def test_changes_missing_renew(self):
+        self.publish([('node_add', '1:1', 'a')], written=False)
+        self.tree_cache.get()
+        self.renew.assert_not_called()
+
+        self.tree_cache.changes_missing_since -= TreeCache.changes_wait_time + 1
+        self.tree_cache.get()
+        self.renew.assert_called_once_with(from_db=True)
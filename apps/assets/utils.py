@@ -1,9 +1,20 @@
 # ~*~ coding: utf-8 ~*~
 #
+import os
+import mmap
+import time
+import uuid
+import zlib
+import struct
+import hashlib
+from array import array
 from treelib import Tree
-from treelib.exceptions import NodeIDAbsentError
-from collections import defaultdict
-from copy import deepcopy
+from treelib.node import Node as TreelibNode
+from treelib.exceptions import NodeIDAbsentError, LoopError
+from collections import defaultdict, deque
+from copy import copy, deepcopy
+from functools import partial
+from django.conf import settings
 
 from common.utils import get_logger, timeit, lazyproperty
 from .models import Asset, Node
@@ -12,8 +23,374 @@ from .models import Asset, Node
 logger = get_logger(__file__)
 
 
-class TreeService(Tree):
+TREE_SNAPSHOT_VERSION = 2
+# 本机快照文件保留的时间, 超过缓存中快照的有效期后删除
+TREE_SNAPSHOT_FILE_TTL = 3600 * 2
+
+
+def asset_id_to_bytes(asset_id):
+    if not isinstance(asset_id, uuid.UUID):
+        asset_id = uuid.UUID(str(asset_id))
+    return asset_id.bytes
+
+
+class TreeSnapshot:
+    """
+    树快照的二进制格式, 用于在各个进程间共享, 避免每个 worker 都从数据库重建
+    所有数据都是定长的数组, 可以不经反序列化直接在 mmap 上读取,
+    同一台机器上的 worker 映射同一个文件, 共用一份系统页缓存, 内存不随 worker 数量增长
+    - 节点按层次顺序排列 (父节点在前), 父节点、子节点都用下标表示, 子节点是 CSR 格式
+    - 资产 id 以 16 字节存放, 每个节点的资产用资产下标数组 + 偏移量表示
+    - key 和资产 id 另外存一份排序后的下标, 用二分查找代替进程中的字典
+    """
+    magic = b'JTRS'
+    header_format = '<4sIII'
+    # (名称, 数组类型)
+    sections = (
+        ('parents', 'i'), ('children_offsets', 'I'), ('children', 'i'),
+        ('assets_offsets', 'I'), ('assets_indexes', 'I'),
+        ('assets', 'B'), ('assets_order', 'I'),
+        ('keys_offsets', 'I'), ('keys', 'B'), ('keys_order', 'I'),
+        ('tags_offsets', 'I'), ('tags', 'B'),
+    )
+
+    def __init__(self, buffer):
+        header_size = struct.calcsize(self.header_format)
+        magic, version, self.count, self.assets_count = struct.unpack(
+            self.header_format, buffer[:header_size]
+        )
+        if magic != self.magic or version != TREE_SNAPSHOT_VERSION:
+            raise ValueError('Invalid tree snapshot')
+        table_format = '<' + 'QQ' * len(self.sections)
+        table = struct.unpack(
+            table_format,
+            buffer[header_size:header_size + struct.calcsize(table_format)]
+        )
+        view = memoryview(buffer)
+        for i, (name, typecode) in enumerate(self.sections):
+            offset, size = table[i * 2], table[i * 2 + 1]
+            setattr(self, '_' + name, view[offset:offset + size].cast(typecode))
+
+    @classmethod
+    def pack(cls, keys, tags, parents, offsets, assets_indexes, assets):
+        count = len(keys)
+        children_count = [0] * count
+        for parent in parents:
+            if parent >= 0:
+                children_count[parent] += 1
+        children_offsets = array('I', [0])
+        for n in children_count:
+            children_offsets.append(children_offsets[-1] + n)
+        children = array('i', [0] * children_offsets[-1])
+        position = list(children_offsets[:-1])
+        for i, parent in enumerate(parents):
+            if parent >= 0:
+                children[position[parent]] = i
+                position[parent] += 1
+
+        assets = [asset_id_to_bytes(i) for i in assets]
+        keys = [k.encode() for k in keys]
+        tags = [str(t).encode() for t in tags]
+
+        def strings(values):
+            _offsets = array('I', [0])
+            for v in values:
+                _offsets.append(_offsets[-1] + len(v))
+            return _offsets, b''.join(values)
+
+        keys_offsets, keys_data = strings(keys)
+        tags_offsets, tags_data = strings(tags)
+        data = {
+            'parents': parents, 'children_offsets': children_offsets,
+            'children': children, 'assets_offsets': offsets,
+            'assets_indexes': assets_indexes, 'assets': b''.join(assets),
+            'assets_order': array('I', sorted(range(len(assets)), key=assets.__getitem__)),
+            'keys_offsets': keys_offsets, 'keys': keys_data,
+            'keys_order': array('I', sorted(range(count), key=keys.__getitem__)),
+            'tags_offsets': tags_offsets, 'tags': tags_data,
+        }
+        header = struct.pack(cls.header_format, cls.magic, TREE_SNAPSHOT_VERSION, count, len(assets))
+        table_size = struct.calcsize('<' + 'QQ' * len(cls.sections))
+        offset = len(header) + table_size
+        table, body = [], []
+        for name, typecode in cls.sections:
+            value = data[name]
+            value = value if isinstance(value, bytes) else array(typecode, value).tobytes()
+            # 按 8 字节对齐, 直接在 mmap 上按数组读取
+            padding = -offset % 8
+            body.append(b'\0' * padding + value)
+            offset += padding
+            table.extend([offset, len(value)])
+            offset += len(value)
+        return header + struct.pack('<' + 'QQ' * len(cls.sections), *table) + b''.join(body)
+
+    @staticmethod
+    def _string(offsets, data, i):
+        return bytes(data[offsets[i]:offsets[i + 1]])
+
+    def key(self, i):
+        return self._string(self._keys_offsets, self._keys, i).decode()
+
+    def tag(self, i):
+        return self._string(self._tags_offsets, self._tags, i).decode()
+
+    def parent(self, i):
+        return self._parents[i]
+
+    def children(self, i):
+        start, end = self._children_offsets[i], self._children_offsets[i + 1]
+        return self._children[start:end] if end > start else None
+
+    def node_assets(self, i):
+        start, end = self._assets_offsets[i], self._assets_offsets[i + 1]
+        return self._assets_indexes[start:end] if end > start else None
+
+    def asset_bytes(self, i):
+        return bytes(self._assets[i * 16:i * 16 + 16])
+
+    def asset(self, i):
+        return uuid.UUID(bytes=self.asset_bytes(i))
+
+    @staticmethod
+    def _search(order, get, value):
+        lo, hi = 0, len(order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if get(order[mid]) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(order) and get(order[lo]) == value:
+            return order[lo]
+        return None
+
+    def find_key(self, key):
+        if not isinstance(key, str):
+            return None
+        get = partial(self._string, self._keys_offsets, self._keys)
+        return self._search(self._keys_order, get, key.encode())
+
+    def find_asset(self, asset_id):
+        try:
+            value = asset_id_to_bytes(asset_id)
+        except (TypeError, ValueError, AttributeError):
+            return None
+        return self._search(self._assets_order, self.asset_bytes, value)
+
+    def iter_keys(self):
+        for i in range(self.count):
+            yield self.key(i), i
+
+    def iter_assets(self):
+        for i in range(self.assets_count):
+            yield self.asset(i), i
+
+
+def pack_tree_snapshot(keys, values, parents, offsets, assets_indexes, assets):
+    data = TreeSnapshot.pack(keys, values, parents, offsets, assets_indexes, assets)
+    return zlib.compress(data)
+
+
+def unpack_tree_snapshot(snapshot):
+    try:
+        return TreeSnapshot(zlib.decompress(snapshot))
+    except (zlib.error, struct.error, TypeError, ValueError) as e:
+        logger.error("Load node tree snapshot error: {}".format(e))
+        return None
+
+
+def map_tree_snapshot(snapshot):
+    """
+    快照解压后写到本机的文件中再映射到内存, 同一个快照每台机器只写一次,
+    其他 worker 直接映射这个文件; 写不了文件时退回到进程内的数据
+    """
+    snapshot_dir = settings.ASSETS_TREE_SNAPSHOT_DIR
+    name = hashlib.sha1(snapshot).hexdigest()
+    path = os.path.join(snapshot_dir, '{}.tree'.format(name))
+    try:
+        if not os.path.exists(path):
+            os.makedirs(snapshot_dir, exist_ok=True)
+            data = zlib.decompress(snapshot)
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            clean_tree_snapshot_files(snapshot_dir, exclude=path)
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return TreeSnapshot(buffer)
+    except OSError as e:
+        logger.warning("Map node tree snapshot error, load into memory: {}".format(e))
+    except (zlib.error, struct.error, ValueError) as e:
+        logger.error("Load node tree snapshot error: {}".format(e))
+        return None
+    return unpack_tree_snapshot(snapshot)
+
+
+def clean_tree_snapshot_files(snapshot_dir, exclude=None):
+    # 已经映射的文件删除后, 映射依然有效, 不影响正在使用它的进程
+    expired = time.time() - TREE_SNAPSHOT_FILE_TTL
+    for name in os.listdir(snapshot_dir):
+        path = os.path.join(snapshot_dir, name)
+        try:
+            if path != exclude and os.path.getmtime(path) < expired:
+                os.remove(path)
+        except OSError:
+            continue
+
+
+class OverlaySequence:
+    """
+    在只读的快照数组上记录本进程的修改, 修改和追加的元素放在进程内, 没有修改的直接读快照
+    """
+    def __init__(self, get, length, copy_item=None):
+        self._get = get
+        self._base_length = length
+        self._copy_item = copy_item
+        self._changed = {}
+        self._appended = []
+
+    def __len__(self):
+        return self._base_length + len(self._appended)
+
+    def __getitem__(self, i):
+        if i >= self._base_length:
+            return self._appended[i - self._base_length]
+        if i < 0:
+            raise IndexError(i)
+        if i in self._changed:
+            return self._changed[i]
+        return self._get(i)
+
+    def __setitem__(self, i, value):
+        if i >= self._base_length:
+            self._appended[i - self._base_length] = value
+        else:
+            self._changed[i] = value
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, value):
+        self._appended.append(value)
+
+    def copy(self):
+        other = copy(self)
+        copy_item = self._copy_item or (lambda x: x)
+        other._changed = {i: copy_item(v) for i, v in self._changed.items()}
+        other._appended = [copy_item(v) for v in self._appended]
+        return other
+
+
+class OverlayMapping:
+    """
+    在快照的二分查找上记录本进程的修改, 和 OverlaySequence 一样只保存修改的部分
+    """
+    _missing = object()
+
+    def __init__(self, find, items, length):
+        self._find = find
+        self._items = items
+        self._length = length
+        self._changed = {}
+        self._removed = set()
+
+    def get(self, key, default=None):
+        if key in self._changed:
+            return self._changed[key]
+        if key in self._removed:
+            return default
+        value = self._find(key)
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return self.get(key, self._missing) is not self._missing
+
+    def __getitem__(self, key):
+        value = self.get(key, self._missing)
+        if value is self._missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._length += 1
+        self._changed[key] = value
+
+    def pop(self, key, *default):
+        value = self.get(key, self._missing)
+        if value is self._missing:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        self._changed.pop(key, None)
+        if self._find(key) is not None:
+            self._removed.add(key)
+        self._length -= 1
+        return value
+
+    def __len__(self):
+        return self._length
+
+    def items(self):
+        for key, value in self._items():
+            if key in self._changed or key in self._removed:
+                continue
+            yield key, value
+        yield from list(self._changed.items())
+
+    def keys(self):
+        return (key for key, value in self.items())
+
+    def values(self):
+        return (value for key, value in self.items())
+
+    def __iter__(self):
+        return self.keys()
+
+    def copy(self):
+        other = copy(self)
+        other._changed = dict(self._changed)
+        other._removed = set(self._removed)
+        return other
+
+
+def copy_sequence(seq):
+    if isinstance(seq, (OverlaySequence, OverlayMapping)):
+        return seq.copy()
+    if isinstance(seq, array):
+        return array(seq.typecode, seq)
+    if isinstance(seq, dict):
+        return dict(seq)
+    return list(seq)
+
+
+class TreeChangesMixin:
+    def apply_changes(self, changes):
+        """
+        增量应用树的变更, 变更由 TreeCache.publish_changes 发布
+        每个变更都是幂等的, 重复应用不会出错
+        ('node_add', key, value)
+        ('node_update', key, value)
+        ('node_move', old_key, new_key, value)
+        ('node_remove', key)
+        ('assets_add', key, assets_id)
+        ('assets_remove', key, assets_id)
+        ('assets_delete', assets_id)
+        """
+        for change in changes:
+            action, args = change[0], change[1:]
+            handler = getattr(self, 'apply_{}'.format(action), None)
+            if handler is None:
+                logger.error("Unknown node tree change: {}".format(action))
+                continue
+            handler(*args)
+
+
+class TreeService(TreeChangesMixin, Tree):
     tag_sep = ' / '
+    snapshot_shared = False
 
     @staticmethod
     @timeit
@@ -53,6 +430,128 @@ class TreeService(Tree):
             data = {"assets": assets, "all_assets": None}
             node.data = data
 
+    def copy(self):
+        """
+        复制树用于增量更新, 节点的 data 浅复制,
+        资产集合更新时都是整体替换, 不会原地修改, 可以和原来的树共用
+        """
+        tree = self.__class__()
+        tree.root = self.root
+        for nid, node in self._nodes.items():
+            new_node = copy(node)
+            new_node.fpointer = list(node.fpointer)
+            if node.data:
+                new_node.data = dict(node.data)
+            tree._nodes[nid] = new_node
+        return tree
+
+    def dump_snapshot(self):
+        keys, values = [], []
+        parents = array('i')
+        offsets = array('I', [0])
+        assets_indexes = array('I')
+        nodes_index = {}
+        assets_index = {}
+
+        for nid in self.expand_tree(mode=Tree.WIDTH):
+            node = self[nid]
+            nodes_index[nid] = len(keys)
+            keys.append(nid)
+            values.append(node.tag)
+            parents.append(nodes_index.get(node.bpointer, -1))
+            for asset_id in self.assets(nid):
+                index = assets_index.setdefault(asset_id, len(assets_index))
+                assets_indexes.append(index)
+            offsets.append(len(assets_indexes))
+        return pack_tree_snapshot(
+            keys, values, parents, offsets, assets_indexes, list(assets_index)
+        )
+
+    @classmethod
+    @timeit
+    def load_snapshot(cls, snapshot):
+        data = unpack_tree_snapshot(snapshot)
+        if data is None:
+            return None
+        assets = [data.asset(i) for i in range(data.assets_count)]
+        keys = [data.key(i) for i in range(data.count)]
+
+        tree = cls()
+        for i, key in enumerate(keys):
+            parent_index = data.parent(i)
+            parent = keys[parent_index] if parent_index >= 0 else None
+            node_assets = {assets[j] for j in data.node_assets(i) or ()}
+            tree.create_node(
+                tag=data.tag(i), identifier=key, parent=parent,
+                data={"assets": node_assets, "all_assets": None}
+            )
+        return tree
+
+    def expire_all_assets(self, nid):
+        # 节点及其祖先节点缓存的 all_assets 失效
+        for node_id in self.rsearch(nid):
+            node = self.get_node(node_id)
+            if node.data:
+                node.data["all_assets"] = None
+
+    def apply_node_add(self, key, value):
+        if self.contains(key):
+            self.update_node(key, tag=value)
+            return
+        parent_key = Node.compute_parent_key(key)
+        self.safe_create_node(
+            tag=value, identifier=key, parent=parent_key,
+            data={"assets": set(), "all_assets": None}
+        )
+
+    def apply_node_update(self, key, value):
+        self.apply_node_add(key, value)
+
+    def apply_node_move(self, old_key, new_key, value):
+        if not self.contains(old_key):
+            self.apply_node_add(new_key, value)
+            return
+        self.expire_all_assets(old_key)
+        if self.contains(new_key):
+            self.remove_node(old_key)
+        else:
+            self.update_node(old_key, identifier=new_key, tag=value)
+
+        parent_key = Node.compute_parent_key(new_key)
+        if not self.contains(parent_key):
+            parent_key = self.root
+        if self.parent(new_key).identifier != parent_key:
+            self.move_node(new_key, parent_key)
+        self.expire_all_assets(new_key)
+
+    def apply_node_remove(self, key):
+        if not self.contains(key):
+            return
+        self.expire_all_assets(key)
+        self.remove_node(key)
+
+    def apply_assets_add(self, key, assets_id):
+        if not self.contains(key):
+            return
+        assets = set(self.assets(key))
+        assets.update(assets_id)
+        self.set_assets(key, assets)
+        self.expire_all_assets(key)
+
+    def apply_assets_remove(self, key, assets_id):
+        if not self.contains(key):
+            return
+        assets = set(self.assets(key)) - set(assets_id)
+        self.set_assets(key, assets)
+        self.expire_all_assets(key)
+
+    def apply_assets_delete(self, assets_id):
+        assets_id = set(assets_id)
+        for node in self.all_nodes():
+            if not node.data or not assets_id & set(node.data.get("assets", ())):
+                continue
+            self.apply_assets_remove(node.identifier, assets_id)
+
     def safe_create_node(self, **kwargs):
         parent = kwargs.get("parent")
         if not self.contains(parent):
@@ -193,3 +692,556 @@ class TreeService(Tree):
 
     # def __setstate__(self, state):
     #     self.__dict__ = state
+
+
+class CompactTreeService(TreeChangesMixin):
+    """
+    TreeService 的紧凑实现, 对外接口保持一致
+    节点以数组存放: 下标 -> key, tag, 父节点下标, 子节点下标数组
+    资产 id 映射成整数下标, 每个节点直接关联的资产存放为有序的整数数组,
+    all_assets 通过整数集合的并集计算, 结果按节点缓存, 节点或资产变化时沿祖先节点失效
+    get_node 等返回的是 treelib Node 的只读视图, 可以直接添加到 TreeService 中
+    从快照加载时直接读取映射到内存的快照文件, 各个 worker 共用, 本进程只保存之后的增量修改
+    """
+    tag_sep = ' / '
+    # 从数据库构建后也改为使用映射的快照, 构建的进程不再单独持有一份树
+    snapshot_shared = True
+    # 删除节点留下的空位超过这个数量, 并且比有效节点还多时, 重新编号去掉空位
+    compact_threshold = 1000
+
+    def __init__(self):
+        self.root = None
+        self._keys = []
+        self._tags = []
+        self._parents = array('i')
+        self._children = []
+        self._nodes_assets = []
+        self._index = {}
+        self._assets = []
+        self._assets_index = {}
+        self._all_assets_cache = {}
+
+    @classmethod
+    @timeit
+    def new(cls):
+        all_nodes = list(Node.objects.all().values_list("key", "value"))
+        all_nodes.sort(key=lambda x: len(x[0].split(":")))
+        tree = cls()
+        tree.create_node(tag='', identifier='')
+        for key, value in all_nodes:
+            tree.safe_create_node(
+                tag=value, identifier=key,
+                parent=Node.compute_parent_key(key),
+            )
+        tree.init_assets()
+        return tree
+
+    def init_assets(self):
+        node_assets_map = TreeService.get_nodes_assets_map()
+        self._assets = []
+        self._assets_index = {}
+        self._all_assets_cache = {}
+        # 资产重新编号了, 按下标缓存的无效资产也要重新计算
+        self.__dict__.pop('invalid_assets', None)
+        self.__dict__.pop('invalid_assets_indexes', None)
+        for index, key in enumerate(self._keys):
+            assets = node_assets_map.get(key)
+            if key is None or not assets:
+                self._nodes_assets[index] = None
+                continue
+            self._nodes_assets[index] = self._to_assets_array(assets)
+
+    # 节点
+    def _get_index(self, nid):
+        index = self._index.get(nid)
+        if index is None:
+            raise NodeIDAbsentError("Node '%s' is not in the tree" % nid)
+        return index
+
+    def _make_node(self, index, data=None):
+        node = TreelibNode(
+            tag=self._tags[index], identifier=self._keys[index], data=data
+        )
+        parent_index = self._parents[index]
+        if parent_index >= 0:
+            node.bpointer = self._keys[parent_index]
+        return node
+
+    def _iter_subtree(self, index):
+        stack = [index]
+        while stack:
+            i = stack.pop()
+            yield i
+            children = self._children[i]
+            if children:
+                stack.extend(reversed(children))
+
+    def _iter_ancestors(self, index):
+        while index >= 0:
+            yield index
+            index = self._parents[index]
+
+    def _add_node(self, key, tag, parent_index):
+        index = len(self._keys)
+        self._keys.append(key)
+        self._tags.append(tag)
+        self._parents.append(parent_index)
+        self._children.append(None)
+        self._nodes_assets.append(None)
+        self._index[key] = index
+        if parent_index >= 0:
+            self._link_child(parent_index, index)
+        return index
+
+    def _get_children_array(self, index):
+        # 快照中的子节点是只读的, 修改前复制到进程内
+        children = self._children[index]
+        if not isinstance(children, array):
+            children = array('i', children or ())
+            self._children[index] = children
+        return children
+
+    def _link_child(self, parent_index, index):
+        children = self._get_children_array(parent_index)
+        children.append(index)
+        self._parents[index] = parent_index
+
+    def _unlink_child(self, index):
+        parent_index = self._parents[index]
+        if parent_index < 0:
+            return
+        children = self._get_children_array(parent_index)
+        children.remove(index)
+        if not children:
+            self._children[parent_index] = None
+
+    def __contains__(self, nid):
+        return nid in self._index
+
+    def __getitem__(self, nid):
+        return self._make_node(self._get_index(nid))
+
+    def __len__(self):
+        return len(self._index)
+
+    def size(self):
+        return len(self)
+
+    def contains(self, nid):
+        return nid in self
+
+    def create_node(self, tag=None, identifier=None, parent=None, data=None):
+        if identifier in self._index:
+            raise ValueError("Node '%s' already exists" % identifier)
+        if tag is None:
+            tag = identifier
+        if parent is None:
+            if self.root is not None:
+                raise ValueError("A tree takes one root merely.")
+            parent_index = -1
+            self.root = identifier
+        else:
+            parent_index = self._get_index(parent)
+        index = self._add_node(identifier, tag, parent_index)
+        if data and data.get("assets"):
+            self._nodes_assets[index] = self._to_assets_array(data["assets"])
+            self._expire_all_assets(index)
+        return self._make_node(index)
+
+    def safe_create_node(self, **kwargs):
+        parent = kwargs.get("parent")
+        if not self.contains(parent):
+            kwargs['parent'] = self.root
+        return self.create_node(**kwargs)
+
+    def get_node(self, nid, deep=False):
+        index = self._index.get(nid)
+        if index is None:
+            return None
+        data = {} if deep else None
+        return self._make_node(index, data=data)
+
+    def root_node(self):
+        return self.get_node(self.root)
+
+    def parent(self, nid, deep=False):
+        parent_index = self._parents[self._get_index(nid)]
+        if parent_index < 0:
+            return None
+        return self.get_node(self._keys[parent_index], deep=deep)
+
+    def children(self, nid):
+        children = self._children[self._get_index(nid)] or ()
+        return [self._make_node(i) for i in children]
+
+    def all_nodes_itr(self):
+        for index in self._index.values():
+            yield self._make_node(index)
+
+    def all_nodes(self):
+        return list(self.all_nodes_itr())
+
+    def expand_tree(self, nid=None):
+        if nid is None:
+            nid = self.root
+        for index in self._iter_subtree(self._get_index(nid)):
+            yield self._keys[index]
+
+    def rsearch(self, nid):
+        for index in self._iter_ancestors(self._get_index(nid)):
+            yield self._keys[index]
+
+    def all_children_ids(self, nid, with_self=True):
+        children_ids = self.expand_tree(nid)
+        if not with_self:
+            next(children_ids)
+        return list(children_ids)
+
+    def all_children(self, nid, with_self=True, deep=False):
+        children_ids = self.all_children_ids(nid, with_self=with_self)
+        return [self.get_node(i, deep=deep) for i in children_ids]
+
+    def ancestors_ids(self, nid, with_self=True):
+        ancestor_ids = list(self.rsearch(nid))
+        ancestor_ids.pop()
+        if not with_self:
+            ancestor_ids.pop(0)
+        return ancestor_ids
+
+    def ancestors(self, nid, with_self=False, deep=False):
+        ancestor_ids = self.ancestors_ids(nid, with_self=with_self)
+        ancestors = [self.get_node(i, deep=deep) for i in ancestor_ids]
+        return ancestors
+
+    def get_node_full_tag(self, nid):
+        ancestors = self.ancestors(nid, with_self=True)
+        ancestors.reverse()
+        return self.tag_sep.join([n.tag for n in ancestors])
+
+    def get_family(self, nid, deep=False):
+        ancestors = self.ancestors(nid, with_self=False, deep=deep)
+        children = self.all_children(nid, with_self=False)
+        return ancestors + [self[nid]] + children
+
+    @staticmethod
+    def is_parent(child, parent):
+        parent_id = child.bpointer
+        return parent_id == parent.identifier
+
+    def subtree(self, nid):
+        """
+        返回 treelib 的 TreeService, 可以直接 paste 到用户的树中
+        """
+        tree = TreeService()
+        index = self._get_index(nid)
+        for i in self._iter_subtree(index):
+            parent = None if i == index else self._keys[self._parents[i]]
+            data = {"assets": self._to_assets_ids(self._nodes_assets[i]), "all_assets": None}
+            tree.create_node(
+                tag=self._tags[i], identifier=self._keys[i],
+                parent=parent, data=data
+            )
+        return tree
+
+    def paste(self, nid, new_tree, deep=False):
+        joint = [n for n in new_tree.expand_tree() if n in self._index]
+        if joint:
+            raise ValueError('Duplicated nodes %s exists.' % joint)
+        parent_index = self._get_index(nid)
+        for node_id in new_tree.expand_tree(mode=Tree.WIDTH):
+            node = new_tree[node_id]
+            if node_id == new_tree.root:
+                _parent_index = parent_index
+            else:
+                _parent_index = self._index[node.bpointer]
+            index = self._add_node(node_id, node.tag, _parent_index)
+            if node.data and node.data.get("assets"):
+                self._nodes_assets[index] = self._to_assets_array(node.data["assets"])
+        self._expire_all_assets(parent_index)
+
+    def remove_node(self, nid):
+        index = self._get_index(nid)
+        self._expire_all_assets(index)
+        self._unlink_child(index)
+        removed = list(self._iter_subtree(index))
+        for i in removed:
+            self._index.pop(self._keys[i], None)
+            self._all_assets_cache.pop(i, None)
+            self._keys[i] = None
+            self._children[i] = None
+            self._nodes_assets[i] = None
+        holes = len(self._keys) - len(self._index)
+        if holes >= max(self.compact_threshold, len(self._index)):
+            self._compact()
+        return len(removed)
+
+    def _compact(self):
+        """
+        去掉已删除节点留下的空位, 节点重新编号, 避免长时间运行的进程中数组一直增长
+        """
+        new_indexes = {}
+        for index, key in enumerate(self._keys):
+            if key is not None:
+                new_indexes[index] = len(new_indexes)
+
+        self._keys = [self._keys[i] for i in new_indexes]
+        self._tags = [self._tags[i] for i in new_indexes]
+        self._nodes_assets = [self._nodes_assets[i] for i in new_indexes]
+        self._parents = array('i', (
+            new_indexes.get(self._parents[i], -1) for i in new_indexes
+        ))
+        children = []
+        for i in new_indexes:
+            _children = self._children[i]
+            if _children:
+                _children = array('i', (new_indexes[c] for c in _children))
+            children.append(_children or None)
+        self._children = children
+        self._index = {key: i for i, key in enumerate(self._keys)}
+        self._all_assets_cache = {
+            new_indexes[i]: v for i, v in self._all_assets_cache.items()
+            if i in new_indexes
+        }
+
+    def move_node(self, source, destination):
+        index = self._get_index(source)
+        parent_index = self._get_index(destination)
+        if index in self._iter_ancestors(parent_index):
+            raise LoopError
+        self._expire_all_assets(index)
+        self._unlink_child(index)
+        self._link_child(parent_index, index)
+        self._expire_all_assets(index)
+
+    # 资产
+    def _get_asset_index(self, asset_id):
+        index = self._assets_index.get(asset_id)
+        if index is None:
+            index = len(self._assets)
+            self._assets.append(asset_id)
+            self._assets_index[asset_id] = index
+        return index
+
+    def _to_assets_array(self, assets_id):
+        indexes = {self._get_asset_index(i) for i in assets_id}
+        return array('I', sorted(indexes))
+
+    def _to_assets_ids(self, indexes):
+        if not indexes:
+            return set()
+        return {self._assets[i] for i in indexes}
+
+    def _expire_all_assets(self, index):
+        for i in self._iter_ancestors(index):
+            self._all_assets_cache.pop(i, None)
+
+    def _all_assets_indexes(self, index):
+        indexes = self._all_assets_cache.get(index)
+        if indexes is not None:
+            return indexes
+        indexes = set()
+        stack = [index]
+        while stack:
+            i = stack.pop()
+            # 子孙节点已经算过的，直接合并，不再遍历它的子树
+            cached = self._all_assets_cache.get(i)
+            if cached is not None:
+                indexes.update(cached)
+                continue
+            assets = self._nodes_assets[i]
+            if assets:
+                indexes.update(assets)
+            children = self._children[i]
+            if children:
+                stack.extend(children)
+        self._all_assets_cache[index] = indexes
+        return indexes
+
+    @lazyproperty
+    def invalid_assets(self):
+        assets = Asset.objects.filter(is_active=False).values_list('id', flat=True)
+        return assets
+
+    @lazyproperty
+    def invalid_assets_indexes(self):
+        return {
+            self._assets_index[i] for i in self.invalid_assets
+            if i in self._assets_index
+        }
+
+    def set_assets(self, nid, assets):
+        index = self._get_index(nid)
+        self._nodes_assets[index] = self._to_assets_array(assets) if assets else None
+        self._expire_all_assets(index)
+
+    def assets(self, nid):
+        return self._to_assets_ids(self._nodes_assets[self._get_index(nid)])
+
+    def valid_assets(self, nid):
+        return set(self.assets(nid)) - set(self.invalid_assets)
+
+    def all_assets(self, nid):
+        indexes = self._all_assets_indexes(self._get_index(nid))
+        return self._to_assets_ids(indexes)
+
+    def all_valid_assets(self, nid):
+        indexes = self._all_assets_indexes(self._get_index(nid))
+        return self._to_assets_ids(indexes - self.invalid_assets_indexes)
+
+    def assets_amount(self, nid):
+        return len(self._all_assets_indexes(self._get_index(nid)))
+
+    def valid_assets_amount(self, nid):
+        indexes = self._all_assets_indexes(self._get_index(nid))
+        return len(indexes - self.invalid_assets_indexes)
+
+    # 增量变更
+    def apply_node_add(self, key, value):
+        index = self._index.get(key)
+        if index is not None:
+            self._tags[index] = value
+            return
+        parent_key = Node.compute_parent_key(key)
+        if parent_key not in self._index:
+            parent_key = self.root
+        self._add_node(key, value, self._index[parent_key])
+
+    def apply_node_update(self, key, value):
+        self.apply_node_add(key, value)
+
+    def apply_node_move(self, old_key, new_key, value):
+        if old_key not in self._index:
+            self.apply_node_add(new_key, value)
+            return
+        if new_key in self._index:
+            self.remove_node(old_key)
+        else:
+            index = self._index.pop(old_key)
+            self._index[new_key] = index
+            self._keys[index] = new_key
+            self._tags[index] = value
+
+        parent_key = Node.compute_parent_key(new_key)
+        if parent_key not in self._index:
+            parent_key = self.root
+        if self.parent(new_key).identifier != parent_key:
+            self.move_node(new_key, parent_key)
+
+    def apply_node_remove(self, key):
+        if key not in self._index:
+            return
+        self.remove_node(key)
+
+    def apply_assets_add(self, key, assets_id):
+        if key not in self._index:
+            return
+        assets = set(self.assets(key))
+        assets.update(assets_id)
+        self.set_assets(key, assets)
+
+    def apply_assets_remove(self, key, assets_id):
+        if key not in self._index:
+            return
+        assets = set(self.assets(key)) - set(assets_id)
+        self.set_assets(key, assets)
+
+    def apply_assets_delete(self, assets_id):
+        indexes = {
+            self._assets_index[i] for i in assets_id if i in self._assets_index
+        }
+        if not indexes:
+            return
+        for index, assets in enumerate(self._nodes_assets):
+            if not assets or not indexes.intersection(assets):
+                continue
+            remain = [i for i in assets if i not in indexes]
+            self._nodes_assets[index] = array('I', remain) if remain else None
+            self._expire_all_assets(index)
+
+    def copy(self):
+        """
+        复制树用于增量更新, 节点资产数组更新时都是整体替换, 不会原地修改, 可以共用
+        """
+        tree = self.__class__()
+        tree.root = self.root
+        tree._keys = copy_sequence(self._keys)
+        tree._tags = copy_sequence(self._tags)
+        tree._parents = copy_sequence(self._parents)
+        if isinstance(self._children, OverlaySequence):
+            tree._children = self._children.copy()
+        else:
+            tree._children = [
+                array('i', children) if children else None
+                for children in self._children
+            ]
+        tree._nodes_assets = copy_sequence(self._nodes_assets)
+        tree._index = copy_sequence(self._index)
+        tree._assets = copy_sequence(self._assets)
+        tree._assets_index = copy_sequence(self._assets_index)
+        tree._all_assets_cache = dict(self._all_assets_cache)
+        return tree
+
+    # 快照
+    def dump_snapshot(self):
+        keys, values = [], []
+        parents = array('i')
+        offsets = array('I', [0])
+        assets_indexes = array('I')
+        new_indexes = {}
+
+        # 按层次顺序重新编号, 去掉已删除节点留下的空位
+        queue = deque([self._index[self.root]]) if self.root in self._index else deque()
+        while queue:
+            index = queue.popleft()
+            new_indexes[index] = len(keys)
+            keys.append(self._keys[index])
+            values.append(self._tags[index])
+            parents.append(new_indexes.get(self._parents[index], -1))
+            assets = self._nodes_assets[index]
+            if assets:
+                assets_indexes.extend(assets)
+            offsets.append(len(assets_indexes))
+            queue.extend(self._children[index] or ())
+        return pack_tree_snapshot(
+            keys, values, parents, offsets, assets_indexes, self._assets
+        )
+
+    @classmethod
+    @timeit
+    def load_snapshot(cls, snapshot):
+        data = map_tree_snapshot(snapshot)
+        if data is None:
+            return None
+        return cls.from_snapshot(data)
+
+    @classmethod
+    def from_snapshot(cls, data):
+        tree = cls()
+        count = data.count
+        tree._keys = OverlaySequence(data.key, count)
+        tree._tags = OverlaySequence(data.tag, count)
+        tree._parents = OverlaySequence(data.parent, count)
+        tree._children = OverlaySequence(
+            data.children, count, copy_item=lambda c: array('i', c) if c else None
+        )
+        tree._nodes_assets = OverlaySequence(data.node_assets, count)
+        tree._index = OverlayMapping(data.find_key, data.iter_keys, count)
+        tree._assets = OverlaySequence(data.asset, data.assets_count)
+        tree._assets_index = OverlayMapping(
+            data.find_asset, data.iter_assets, data.assets_count
+        )
+        tree.root = data.key(0) if count else None
+        return tree
+
+    def __getstate__(self):
+        return {'snapshot': self.dump_snapshot()}
+
+    def __setstate__(self, state):
+        tree = self.load_snapshot(state['snapshot'])
+        self.__dict__.update(tree.__dict__)
+
+
+def get_tree_service_class():
+    if settings.ASSETS_TREE_ENGINE == 'compact':
+        return CompactTreeService
+    return TreeService
@@ -3,23 +3,21 @@
 
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from django.db import transaction
 from django.utils import timezone
 from rest_framework.renderers import JSONRenderer
 from rest_framework.request import Request
 
 from jumpserver.utils import current_request
-from common.utils import get_request_ip, get_logger, get_syslogger
+from common.utils import get_request_ip, get_logger
+from common.signals import post_bulk_import
 from users.models import User
-from users.signals import post_user_change_password
+from users.signals import post_user_change_password, post_user_bulk_import
 from authentication.signals import post_auth_failed, post_auth_success
-from terminal.models import Session, Command
-from common.utils.encode import model_to_json
 from .utils import write_login_log
+from .writer import AuditLogWriter, get_log_category
 from . import models
 
 logger = get_logger(__name__)
-sys_logger = get_syslogger(__name__)
 json_render = JSONRenderer()
 
 
@@ -44,13 +42,9 @@ def create_operate_log(action, sender, resource):
 
     data = {
         "user": str(user), 'action': action, 'resource_type': resource_type,
-        'resource': str(resource), 'remote_addr': remote_addr,
+        'resource': str(resource)[:128], 'remote_addr': remote_addr,
     }
-    with transaction.atomic():
-        try:
-            models.OperateLog.objects.create(**data)
-        except Exception as e:
-            logger.error("Create operate log error: {}".format(e))
+    AuditLogWriter.get_instance().add_log(models.OperateLog, data)
 
 
 @receiver(post_save)
@@ -70,6 +64,34 @@ def on_object_delete(sender, instance=None, **kwargs):
     create_operate_log(models.OperateLog.ACTION_DELETE, sender, instance)
 
 
+@receiver(post_user_bulk_import, sender=User)
+def on_user_bulk_import(sender, created=0, updated=0, unchanged=0, **kwargs):
+    """
+    批量导入用户不会触发 post_save, 整次导入只记录一条操作日志
+    """
+    if created and not updated:
+        action = models.OperateLog.ACTION_CREATE
+    else:
+        action = models.OperateLog.ACTION_UPDATE
+    resource = 'Bulk import: created {}, updated {}, unchanged {}'.format(
+        created, updated, unchanged
+    )
+    create_operate_log(action, sender, resource)
+
+
+@receiver(post_bulk_import)
+def on_bulk_import(sender, created=0, updated=0, **kwargs):
+    """
+    CSV 批量导入时整次导入只记录一条操作日志
+    """
+    if created and not updated:
+        action = models.OperateLog.ACTION_CREATE
+    else:
+        action = models.OperateLog.ACTION_UPDATE
+    resource = 'Bulk import: created {}, updated {}'.format(created, updated)
+    create_operate_log(action, sender, resource)
+
+
 @receiver(post_user_change_password, sender=User)
 def on_user_change_password(sender, user=None, **kwargs):
     if not current_request:
@@ -81,32 +103,19 @@ def on_user_change_password(sender, user=None, **kwargs):
             change_by = str(user)
         else:
             change_by = str(current_request.user)
-    with transaction.atomic():
-        models.PasswordChangeLog.objects.create(
-            user=str(user), change_by=change_by,
-            remote_addr=remote_addr,
-        )
+    data = {
+        'user': str(user), 'change_by': change_by,
+        'remote_addr': remote_addr,
+    }
+    AuditLogWriter.get_instance().add_log(models.PasswordChangeLog, data)
 
 
 def on_audits_log_create(sender, instance=None, **kwargs):
-    if sender == models.UserLoginLog:
-        category = "login_log"
-    elif sender == models.FTPLog:
-        category = "ftp_log"
-    elif sender == models.OperateLog:
-        category = "operation_log"
-    elif sender == models.PasswordChangeLog:
-        category = "password_change_log"
-    elif sender == Session:
-        category = "host_session_log"
-    elif sender == Command:
-        category = "session_command_log"
-    else:
+    category = get_log_category(sender)
+    if not category:
         return
-
-    data = model_to_json(instance, indent=None)
-    msg = "{} - {}".format(category, data)
-    sys_logger.info(msg)
+    # 序列化和输出在后台线程中进行
+    AuditLogWriter.get_instance().add_syslog(category, instance)
 
 
 def generate_data(username, request):
@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
 #
 import datetime
+from collections import defaultdict
+
+from django.db.models import Q
 from django.utils import timezone
+from django.utils.translation import ugettext as _
 from django.conf import settings
 from celery import shared_task
 
 from ops.celery.decorator import register_as_period_task
+from common.utils import validate_ip, get_ips_city
 from .models import UserLoginLog, OperateLog
 
 
@@ -31,3 +36,35 @@ def clean_operation_log_period():
         days = 9999
     expired_day = now - datetime.timedelta(days=days)
     OperateLog.objects.filter(datetime__lt=expired_day).delete()
+
+
+@shared_task
+def backfill_login_log_city(days=None, batch_size=1000):
+    """
+    补全历史登录日志的城市, 一批日志中相同的 IP 只查一次, 相同城市的一次更新
+    补全后城市不再为空, 每次取剩下的前一批即可
+    """
+    logs = UserLoginLog.objects.filter(Q(city__isnull=True) | Q(city=''))
+    if days:
+        date_from = timezone.now() - datetime.timedelta(days=days)
+        logs = logs.filter(datetime__gte=date_from)
+    total = logs.count()
+    print("Backfill login log city: {}".format(total))
+
+    default_city = _("Unknown")
+    finished = 0
+    while finished < total:
+        batch = list(logs.values_list('id', 'ip')[:batch_size])
+        if not batch:
+            break
+        ips = {ip for __, ip in batch if ip and validate_ip(ip)}
+        ips_city = get_ips_city(ips)
+        city_logs = defaultdict(list)
+        for log_id, ip in batch:
+            city = ips_city.get(ip) or default_city
+            city_logs[city].append(log_id)
+        for city, logs_id in city_logs.items():
+            UserLoginLog.objects.filter(id__in=logs_id).update(city=city)
+        finished += len(batch)
+        print("Progress: {}/{}".format(finished, total))
+    return finished
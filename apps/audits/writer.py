@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#
+import os
+import copy
+import queue
+import atexit
+import threading
+from collections import defaultdict
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction, close_old_connections
+
+from common.utils import get_logger, get_syslogger
+from common.utils.encode import model_to_json
+from orgs.mixins.models import OrgModelMixin
+from orgs.utils import get_current_org
+from terminal.models import Session, Command
+from . import models
+
+logger = get_logger(__name__)
+sys_logger = get_syslogger(__name__)
+
+__all__ = ['AuditLogWriter', 'get_log_category']
+
+
+def get_log_category(sender):
+    if sender == models.UserLoginLog:
+        category = "login_log"
+    elif sender == models.FTPLog:
+        category = "ftp_log"
+    elif sender == models.OperateLog:
+        category = "operation_log"
+    elif sender == models.PasswordChangeLog:
+        category = "password_change_log"
+    elif sender == Session:
+        category = "host_session_log"
+    elif sender == Command:
+        category = "session_command_log"
+    else:
+        category = None
+    return category
+
+
+class AuditLogWriter:
+    """
+    审计日志写入
+    请求中只是在事务提交后把日志放到队列里, 回滚了的操作不会记录,
+    后台线程把队列中的日志一批一批地 bulk_create, syslog 也在后台线程中序列化输出,
+    批量操作时接口的耗时不再随审计日志的数量增长
+    """
+    flush_size = 500
+    flush_interval = 1
+    max_queue_size = 100000
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.queue = queue.Queue(maxsize=self.max_queue_size)
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        # 进程退出时写入还在队列中的日志
+        atexit.register(self.flush)
+
+    @classmethod
+    def get_instance(cls):
+        with cls._lock:
+            # fork 出来的子进程中没有父进程的后台线程, 重新创建
+            if cls._instance is None or cls._instance.pid != os.getpid():
+                cls._instance = cls()
+        return cls._instance
+
+    @staticmethod
+    def get_org_id():
+        # 和 OrgModelMixin.save 一致, 后台线程中拿不到请求的当前组织, 先在这里取
+        org = get_current_org()
+        if org and (org.is_real() or org.is_system()):
+            return org.id
+        return ''
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            # 一直写入失败导致队列满了, 直接写入, 不丢日志
+            logger.warning('Audit log queue is full, write directly')
+            self.write([item])
+
+    def add_log(self, model, data):
+        if issubclass(model, OrgModelMixin) and 'org_id' not in data:
+            data['org_id'] = self.get_org_id()
+        transaction.on_commit(partial(self.put, ('log', model, data)))
+
+    def add_syslog(self, category, instance):
+        instance = copy.copy(instance)
+        transaction.on_commit(partial(self.put, ('syslog', category, instance)))
+
+    def get_items(self):
+        items = []
+        try:
+            items.append(self.queue.get(timeout=self.flush_interval))
+            while len(items) < self.flush_size:
+                items.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return items
+
+    @staticmethod
+    def bulk_create(model, objs):
+        try:
+            return model.objects.bulk_create(objs)
+        except Exception as e:
+            # 有一条出错整批都会失败, 逐条写入
+            logger.error('Bulk create audit logs error, retry one by one: {}'.format(e))
+        created = []
+        for obj in objs:
+            try:
+                created.extend(model.objects.bulk_create([obj]))
+            except Exception as e:
+                logger.error('Create audit log error: {}'.format(e))
+        return created
+
+    def write(self, items):
+        logs = defaultdict(list)
+        syslogs = []
+        for item in items:
+            if item[0] == 'log':
+                __, model, data = item
+                logs[model].append(model(**data))
+            else:
+                syslogs.append(item[1:])
+
+        for model, objs in logs.items():
+            objs = self.bulk_create(model, objs)
+            # bulk_create 不会触发 post_save, 在这里输出 syslog
+            category = get_log_category(model)
+            if settings.SYSLOG_ENABLE and category:
+                syslogs.extend((category, obj) for obj in objs)
+
+        for category, instance in syslogs:
+            data = model_to_json(instance, indent=None)
+            sys_logger.info("{} - {}".format(category, data))
+
+    def run(self):
+        while True:
+            items = self.get_items()
+            if not items:
+                continue
+            try:
+                self.write(items)
+            except Exception as e:
+                logger.error('Write audit logs error: {}'.format(e))
+            finally:
+                close_old_connections()
+
+    def flush(self):
+        if self.pid != os.getpid():
+            return
+        items = []
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if items:
+            self.write(items)
@@ -3,7 +3,7 @@ from rest_framework_bulk import BulkModelViewSet
 
 from ..mixins.api import (
     SerializerMixin2, QuerySetMixin, ExtraFilterFieldsMixin, PaginatedResponseMixin,
-    RelationMixin, AllowBulkDestoryMixin
+    RelationMixin, AllowBulkDestoryMixin, StreamingExportMixin
 )
 
 
@@ -15,7 +15,8 @@ class JmsGenericViewSet(SerializerMixin2,
     pass
 
 
-class JMSModelViewSet(SerializerMixin2,
+class JMSModelViewSet(StreamingExportMixin,
+                      SerializerMixin2,
                       QuerySetMixin,
                       ExtraFilterFieldsMixin,
                       PaginatedResponseMixin,
@@ -23,7 +24,8 @@ class JMSModelViewSet(SerializerMixin2,
     pass
 
 
-class JMSBulkModelViewSet(SerializerMixin2,
+class JMSBulkModelViewSet(StreamingExportMixin,
+                          SerializerMixin2,
                           QuerySetMixin,
                           ExtraFilterFieldsMixin,
                           PaginatedResponseMixin,
@@ -32,7 +34,8 @@ class JMSBulkModelViewSet(SerializerMixin2,
     pass
 
 
-class JMSBulkRelationModelViewSet(SerializerMixin2,
+class JMSBulkRelationModelViewSet(StreamingExportMixin,
+                                  SerializerMixin2,
                                   QuerySetMixin,
                                   ExtraFilterFieldsMixin,
                                   PaginatedResponseMixin,
@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+#
+from collections import defaultdict
+from itertools import islice
+
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction, IntegrityError
+from django.db.models import Q, Model
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+from rest_framework.exceptions import ValidationError
+from rest_framework.relations import (
+    ManyRelatedField, PrimaryKeyRelatedField, SlugRelatedField
+)
+from rest_framework.settings import api_settings
+from rest_framework.validators import UniqueValidator, UniqueTogetherValidator
+
+from common.signals import post_bulk_import
+from common.utils import get_logger
+
+logger = get_logger(__file__)
+
+__all__ = ['BulkImporter']
+
+
+class BulkImporter:
+    """
+    CSV 批量导入, 按 chunk_size 一批一批地校验和写入
+    - 关联字段 (外键, 多对多) 每批查询一次, 不再每行每个字段查一次
+    - 唯一性每批查询一次, 同时检查导入的数据之间是否重复
+    - 使用 bulk_create/bulk_update 写入, 多对多关系直接批量写中间表
+
+    批量写入不会触发 post_save/m2m_changed, 信号中的副作用 (刷新节点树, 推送系统用户,
+    测试可连接性等) 由子类在 after_import 中对整次导入统一处理一次
+    所有数据在一个事务中写入, 有一行校验失败就都不写入, 和原来的批量创建一致
+    只支持主键在 Python 中生成 (UUID) 的模型, 否则 bulk_create 后拿不到主键写中间表
+    rows 可以是任意可迭代对象, 按批取出; 但 JMSCSVParser 解析后的 request.data 仍是完整的列表,
+    省下的是每行的查询和校验时的中间对象, 不是解析出来的行数据本身
+    """
+    chunk_size = None
+
+    def __init__(self, view, rows, partial=False):
+        self.view = view
+        self.request = view.request
+        self.rows = rows
+        self.partial = partial
+        self.is_update = self.request.method in ('PUT', 'PATCH')
+        self.model = view.get_serializer_class().Meta.model
+        self.chunk_size = self.chunk_size or settings.CSV_IMPORT_CHUNK_SIZE
+        self.errors = []
+        self.created = []
+        self.updated = []
+        # {field_name: [(obj_id, related_id), ...]}
+        self.m2m_added = defaultdict(list)
+        self.m2m_removed = defaultdict(list)
+        self._unique_seen = defaultdict(dict)
+
+    @property
+    def summary(self):
+        return {'created': len(self.created), 'updated': len(self.updated)}
+
+    def has_errors(self):
+        return any(self.errors)
+
+    def add_error(self, index, error):
+        if not isinstance(error, dict):
+            error = {api_settings.NON_FIELD_ERRORS_KEY: [error]}
+        self.errors[index] = error
+
+    def get_serializer(self):
+        return self.view.get_serializer(partial=self.partial)
+
+    @staticmethod
+    def get_related_fields(serializer):
+        fields = {}
+        for name, field in serializer.fields.items():
+            if field.read_only:
+                continue
+            relation = field
+            if isinstance(field, ManyRelatedField):
+                relation = field.child_relation
+            if isinstance(relation, (PrimaryKeyRelatedField, SlugRelatedField)):
+                fields[name] = relation
+        return fields
+
+    @staticmethod
+    def get_lookup_normalizer(model, lookup):
+        if lookup == 'pk':
+            model_field = model._meta.pk
+        else:
+            model_field = model._meta.get_field(lookup)
+
+        def normalize(value):
+            if isinstance(value, Model):
+                value = getattr(value, lookup)
+            return str(model_field.to_python(value))
+        return normalize
+
+    def preload_related_objects(self, serializer, rows):
+        """
+        一次查出这批数据用到的关联对象, 字段校验时从中取, 不再每个值查一次
+        """
+        for name, relation in self.get_related_fields(serializer).items():
+            values = set()
+            for row in rows:
+                value = row.get(name)
+                for v in (value if isinstance(value, list) else [value]):
+                    if isinstance(v, (str, int)) and v != '':
+                        values.add(v)
+
+            queryset = relation.get_queryset()
+            lookup = getattr(relation, 'slug_field', 'pk')
+            normalize = self.get_lookup_normalizer(queryset.model, lookup)
+            keys = set()
+            for v in values:
+                try:
+                    keys.add(normalize(v))
+                except DjangoValidationError:
+                    continue
+            objects = {}
+            if keys:
+                queryset = queryset.filter(**{'{}__in'.format(lookup): keys})
+                objects = {normalize(obj): obj for obj in queryset}
+            self.patch_related_field(relation, normalize, objects)
+
+    @staticmethod
+    def patch_related_field(relation, normalize, objects):
+        # 没有预先查到的 (如大小写不同, 或者不存在) 还用原来的方法, 保证校验结果一致
+        origin_to_internal_value = relation.to_internal_value
+
+        def to_internal_value(data):
+            try:
+                obj = objects.get(normalize(data))
+            except (TypeError, ValueError, DjangoValidationError):
+                obj = None
+            if obj is None:
+                obj = origin_to_internal_value(data)
+            return obj
+        relation.to_internal_value = to_internal_value
+
+    @staticmethod
+    def pop_unique_validators(serializer):
+        """
+        去掉每行都要查一次数据库的唯一性校验, 改为 check_unique 中每批查一次
+        返回 [(fields, queryset), ...]
+        """
+        constraints = []
+        validators = []
+        for validator in serializer.validators:
+            if isinstance(validator, UniqueTogetherValidator):
+                fields = tuple(f for f in validator.fields if f != 'org_id')
+                constraints.append((fields, validator.queryset))
+            else:
+                validators.append(validator)
+        serializer.validators = validators
+
+        for name, field in serializer.fields.items():
+            if field.read_only:
+                continue
+            unique_validators = [v for v in field.validators if isinstance(v, UniqueValidator)]
+            if not unique_validators:
+                continue
+            field.validators = [v for v in field.validators if v not in unique_validators]
+            constraints.extend(((field.source,), v.queryset) for v in unique_validators)
+        return constraints
+
+    @staticmethod
+    def get_unique_key(fields, instance, data):
+        key = []
+        for field in fields:
+            if field in data:
+                value = data[field]
+            elif instance is not None:
+                value = getattr(instance, field, None)
+            else:
+                return None
+            if value is None:
+                return None
+            if isinstance(value, Model):
+                value = value.pk
+            key.append(value)
+        return tuple(key)
+
+    @staticmethod
+    def get_existing_keys(queryset, fields, keys):
+        if len(fields) == 1:
+            q = Q(**{'{}__in'.format(fields[0]): [key[0] for key in keys]})
+        else:
+            q = Q()
+            for key in keys:
+                q |= Q(**dict(zip(fields, key)))
+        existing = defaultdict(set)
+        for values in queryset.filter(q).values_list('pk', *fields):
+            existing[tuple(values[1:])].add(values[0])
+        return existing
+
+    def check_unique(self, constraints, items):
+        msg = _('This field must be unique.')
+        for fields, queryset in constraints:
+            keys = {}
+            for index, instance, data in items:
+                key = self.get_unique_key(fields, instance, data)
+                if key is not None:
+                    keys[index] = key
+            if not keys:
+                continue
+            existing = self.get_existing_keys(queryset, fields, set(keys.values()))
+            seen = self._unique_seen[fields]
+            for index, instance, data in items:
+                key = keys.get(index)
+                if key is None:
+                    continue
+                pk = instance.pk if instance is not None else None
+                duplicated = seen.setdefault(key, index) != index
+                if duplicated or existing.get(key, set()) - {pk}:
+                    error = self.errors[index]
+                    for field in fields:
+                        error.setdefault(field, []).append(msg)
+
+    def get_row_pk(self, row):
+        return row.get('id') or row.get('pk')
+
+    def get_instances(self, rows):
+        normalize = self.get_lookup_normalizer(self.model, 'pk')
+        pks = set()
+        for row in rows:
+            try:
+                pks.add(normalize(self.get_row_pk(row)))
+            except DjangoValidationError:
+                continue
+        if not pks:
+            return normalize, {}
+        queryset = self.view.filter_queryset(self.view.get_queryset())
+        instances = {normalize(obj.pk): obj for obj in queryset.filter(pk__in=pks)}
+        return normalize, instances
+
+    def get_instance(self, row, normalize, instances):
+        pk = self.get_row_pk(row)
+        if not pk:
+            raise ValidationError({'id': [_('This field is required.')]})
+        try:
+            instance = instances.get(normalize(pk))
+        except DjangoValidationError:
+            instance = None
+        if instance is None:
+            raise ValidationError({'id': [_('Object does not exist')]})
+        self.view.check_object_permissions(self.request, instance)
+        return instance
+
+    def validate_chunk(self, serializer, rows):
+        self.preload_related_objects(serializer, rows)
+        constraints = self.pop_unique_validators(serializer)
+        if self.is_update:
+            normalize, instances = self.get_instances(rows)
+
+        items = []
+        for row in rows:
+            index = len(self.errors)
+            self.errors.append({})
+            try:
+                instance = None
+                if self.is_update:
+                    instance = self.get_instance(row, normalize, instances)
+                serializer.instance = instance
+                serializer.initial_data = row
+                data = serializer.run_validation(row)
+            except ValidationError as e:
+                self.add_error(index, e.detail)
+                continue
+            items.append((index, instance, data))
+        self.check_unique(constraints, items)
+        return items
+
+    def prepare_data(self, serializer, data, instance=None):
+        """
+        对应序列化器 create/update 中对数据的处理
+        """
+        return data
+
+    def prepare_instance(self, obj, created):
+        """
+        对应 Model.save 和 pre_save 信号中对实例的处理
+        """
+        if created and hasattr(obj, 'created_by') and not obj.created_by:
+            user = self.request.user
+            if user.is_authenticated and isinstance(user.name, str):
+                obj.created_by = user.name[:30]
+        if created and hasattr(obj, 'org_id'):
+            self.set_org_id(obj)
+
+    @staticmethod
+    def set_org_id(obj):
+        # 和 OrgModelMixin.save 一致
+        from orgs.utils import get_current_org
+        org = get_current_org()
+        if org is None:
+            return
+        if org.is_real() or org.is_system():
+            obj.org_id = org.id
+        elif org.is_default():
+            obj.org_id = ''
+
+    def pop_m2m_data(self, data):
+        m2m_data = {}
+        for name in list(data.keys()):
+            try:
+                field = self.model._meta.get_field(name)
+            except Exception:
+                continue
+            if field.many_to_many and not field.auto_created:
+                m2m_data[name] = data.pop(name)
+        return m2m_data
+
+    def update_instance(self, instance, data):
+        """
+        返回有变化的字段, 只更新这些字段
+        """
+        fields = self.model._meta.concrete_fields
+        before = {f.attname: getattr(instance, f.attname) for f in fields}
+        for attr, value in data.items():
+            setattr(instance, attr, value)
+        self.prepare_instance(instance, False)
+        changed = [f for f in fields if getattr(instance, f.attname) != before[f.attname]]
+        if changed:
+            # bulk_update 不会更新 auto_now 字段
+            now = timezone.now()
+            for f in fields:
+                if getattr(f, 'auto_now', False):
+                    setattr(instance, f.attname, now)
+                    changed.append(f)
+        return {f.name for f in changed}
+
+    def bulk_create(self, items):
+        objs = [obj for index, obj in items]
+        try:
+            with transaction.atomic():
+                self.model.objects.bulk_create(objs)
+        except IntegrityError as e:
+            # 有一行出错整批都会失败, 逐行写入找出出错的行
+            logger.error('Bulk import create error, retry one by one: {}'.format(e))
+            for index, obj in items:
+                try:
+                    with transaction.atomic():
+                        self.model.objects.bulk_create([obj])
+                except IntegrityError as e:
+                    self.add_error(index, str(e))
+
+    def bulk_update(self, items, fields):
+        if not fields:
+            return
+        objs = [obj for index, obj in items]
+        try:
+            with transaction.atomic():
+                self.model.objects.bulk_update(objs, fields)
+        except IntegrityError as e:
+            logger.error('Bulk import update error, retry one by one: {}'.format(e))
+            for index, obj in items:
+                try:
+                    with transaction.atomic():
+                        self.model.objects.bulk_update([obj], fields)
+                except IntegrityError as e:
+                    self.add_error(index, str(e))
+
+    def save_m2m(self, m2m_items):
+        """
+        直接写中间表, 更新时和序列化器一样是替换 (set) 原有的关系
+        """
+        names = {name for obj, m2m_data in m2m_items for name in m2m_data}
+        for name in names:
+            field = self.model._meta.get_field(name)
+            through = field.remote_field.through
+            source = '{}_id'.format(field.m2m_field_name())
+            target = '{}_id'.format(field.m2m_reverse_field_name())
+            objs_values = [
+                (obj, {v.pk for v in m2m_data[name]})
+                for obj, m2m_data in m2m_items if name in m2m_data
+            ]
+
+            existing = defaultdict(set)
+            if self.is_update:
+                queryset = through.objects.filter(**{
+                    '{}__in'.format(source): [obj.pk for obj, values in objs_values]
+                }).values_list(source, target)
+                for source_id, target_id in queryset:
+                    existing[source_id].add(target_id)
+
+            to_add, to_remove = [], []
+            for obj, values in objs_values:
+                old = existing.get(obj.pk, set())
+                to_add.extend((obj.pk, v) for v in values - old)
+                to_remove.extend((obj.pk, v) for v in old - values)
+
+            # 按源对象分组删除, 不再每个关系一个 OR 条件
+            removed = defaultdict(list)
+            for source_id, target_id in to_remove:
+                removed[source_id].append(target_id)
+            for source_id, targets_id in removed.items():
+                through.objects.filter(**{
+                    source: source_id, '{}__in'.format(target): targets_id
+                }).delete()
+            if to_add:
+                through.objects.bulk_create([
+                    through(**{source: source_id, target: target_id})
+                    for source_id, target_id in to_add
+                ])
+            self.m2m_added[name].extend(to_add)
+            self.m2m_removed[name].extend(to_remove)
+
+    def save_chunk(self, serializer, items):
+        to_create, to_update = [], []
+        update_fields = set()
+        m2m_items = []
+        for index, instance, data in items:
+            data = self.prepare_data(serializer, data, instance)
+            m2m_data = self.pop_m2m_data(data)
+            if instance is None:
+                obj = self.model(**data)
+                self.prepare_instance(obj, True)
+                to_create.append((index, obj))
+            else:
+                obj = instance
+                update_fields |= self.update_instance(obj, data)
+                to_update.append((index, obj))
+            m2m_items.append((obj, m2m_data))
+
+        if to_create:
+            self.bulk_create(to_create)
+        if to_update:
+            self.bulk_update(to_update, sorted(update_fields))
+        if self.has_errors():
+            return
+        self.save_m2m(m2m_items)
+        self.created.extend(obj for index, obj in to_create)
+        self.updated.extend(obj for index, obj in to_update)
+
+    def import_chunk(self, rows):
+        serializer = self.get_serializer()
+        items = self.validate_chunk(serializer, rows)
+        # 有错误时继续校验剩下的数据, 一次返回所有的错误, 但不再写入
+        if self.has_errors():
+            return
+        self.save_chunk(serializer, items)
+
+    def after_import(self):
+        """
+        导入的事务提交后, 统一处理原来信号中的副作用
+        """
+        pass
+
+    def send_import_signal(self):
+        if self.created or self.updated:
+            post_bulk_import.send(self.model, **self.summary)
+
+    def iter_chunks(self):
+        rows = iter(self.rows)
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                break
+            yield chunk
+
+    def run(self):
+        with transaction.atomic():
+            for rows in self.iter_chunks():
+                self.import_chunk(rows)
+            if self.has_errors():
+                transaction.set_rollback(True)
+        if self.has_errors():
+            raise ValidationError(self.errors)
+        logger.info('Bulk import {}: {}'.format(self.model._meta.object_name, self.summary))
+        transaction.on_commit(self.after_import)
+        self.send_import_signal()
+        return self.summary
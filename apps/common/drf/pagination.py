@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+import json
+import base64
+import binascii
+
+from django.db.models import Q, QuerySet
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from rest_framework.compat import coreapi, coreschema
+
+__all__ = ['KeysetPagination']
+
+
+class KeysetPagination(LimitOffsetPagination):
+    """
+    传了 cursor 参数时使用游标 (keyset) 分页, 否则和 LimitOffsetPagination 一样
+    按 view.keyset_fields (如 ('timestamp', 'id')) 倒序, 下一页从上一页最后一条之后开始,
+    不用 OFFSET 扫描, 翻到多深每页的代价都一样
+    不是 QuerySet 的结果需要实现 after(values) 方法, 返回游标之后的结果
+    """
+    cursor_query_param = 'cursor'
+    cursor_default_limit = 100
+    cursor_max_limit = 5000
+    invalid_cursor_message = 'Invalid cursor'
+
+    def is_keyset(self, request):
+        return self.cursor_query_param in request.query_params
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self.is_keyset(request):
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.keyset_mode = True
+        self.keyset_fields = view.keyset_fields
+        self.limit = self.get_keyset_limit(request)
+        cursor = self.decode_cursor(request)
+        queryset = self.keyset_queryset(queryset, cursor)
+        items = list(queryset[:self.limit + 1])
+        self.has_next = len(items) > self.limit
+        items = items[:self.limit]
+        self.last_item = items[-1] if items else None
+        return items
+
+    def get_keyset_limit(self, request):
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except (KeyError, ValueError):
+            return self.cursor_default_limit
+        if limit <= 0:
+            return self.cursor_default_limit
+        return min(limit, self.cursor_max_limit)
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.keyset_fields):
+            raise NotFound(self.invalid_cursor_message)
+        return values
+
+    def encode_cursor(self, item):
+        values = [getattr(item, field) for field in self.keyset_fields]
+        data = json.dumps(values, default=str, separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    def keyset_queryset(self, queryset, cursor):
+        if not isinstance(queryset, QuerySet):
+            return queryset.after(cursor)
+
+        ordering = ['-' + field for field in self.keyset_fields]
+        queryset = queryset.order_by(*ordering)
+        if cursor is None:
+            return queryset
+        opts = queryset.model._meta
+        try:
+            values = [
+                opts.get_field(field).to_python(value)
+                for field, value in zip(self.keyset_fields, cursor)
+            ]
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+        # (a, b) < (x, y) => a < x or (a = x and b < y)
+        q = Q()
+        for i, field in enumerate(self.keyset_fields):
+            kwargs = dict(zip(self.keyset_fields[:i], values[:i]))
+            kwargs[field + '__lt'] = values[i]
+            q |= Q(**kwargs)
+        return queryset.filter(q)
+
+    def get_next_link(self):
+        if not getattr(self, 'keyset_mode', False):
+            return super().get_next_link()
+        if not self.has_next or self.last_item is None:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        cursor = self.encode_cursor(self.last_item)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        if not getattr(self, 'keyset_mode', False):
+            return super().get_paginated_response(data)
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_schema_fields(self, view):
+        fields = super().get_schema_fields(view)
+        fields.append(
+            coreapi.Field(
+                name=self.cursor_query_param, required=False, location='query',
+                schema=coreschema.String(
+                    title='Cursor',
+                    description='Keyset pagination cursor, empty for the first page'
+                )
+            )
+        )
+        return fields
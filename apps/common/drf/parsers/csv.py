@@ -1,11 +1,13 @@
 # ~*~ coding: utf-8 ~*~
 #
 
+import csv
 import json
 import chardet
 import codecs
-import unicodecsv
+from itertools import chain
 
+from django.conf import settings
 from django.utils.translation import ugettext as _
 from rest_framework.parsers import BaseParser
 from rest_framework.exceptions import ParseError, APIException
@@ -26,21 +28,85 @@ class JMSCSVParser(BaseParser):
     """
     Parses CSV file to serializer data
     """
-    CSV_UPLOAD_MAX_SIZE = 1024 * 1024 * 10
+    # 读取上传数据的块大小, 编码先用第一块来检测
+    READ_CHUNK_SIZE = 1024 * 64
 
     media_type = 'text/csv'
 
     @staticmethod
-    def _universal_newlines(stream):
+    def _iter_chunks(stream, chunk_size):
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    @staticmethod
+    def _universal_newlines(chunks):
         """
         保证在`通用换行模式`下打开文件
+        按块读取后再切分成行, 不需要把整个文件读到内存中
+        """
+        remain = b''
+        for chunk in chunks:
+            lines = (remain + chunk).splitlines()
+            remain = b''
+            if lines and not chunk.endswith((b'\r', b'\n')):
+                remain = lines.pop()
+            for line in lines:
+                yield line
+        if remain:
+            yield remain
+
+    @staticmethod
+    def _detect_encoding(data):
+        """
+        只检测开头的一块数据, chardet 检测整个文件非常慢
+        """
+        try:
+            # 块的末尾可能截断了多字节字符, 不能直接 decode
+            codecs.getincrementaldecoder('utf-8')().decode(data, final=False)
+            return 'utf-8'
+        except UnicodeDecodeError:
+            pass
+        detect_result = chardet.detect(data)
+        return detect_result.get("encoding") or "utf-8"
+
+    @staticmethod
+    def _detect_line_encoding(line):
+        """
+        中文的 CSV 一般是 GBK/GB2312, 先按它们的超集 GB18030 解码, 不行再用 chardet 检测
+        """
+        try:
+            line.decode('gb18030')
+            return 'gb18030'
+        except UnicodeDecodeError:
+            pass
+        detect_result = chardet.detect(line)
+        return detect_result.get("encoding") or "gb18030"
+
+    @classmethod
+    def _decode_lines(cls, lines, encoding):
+        """
+        编码只用开头的一块检测, 开头都是 ASCII 时会检测成 utf-8,
+        后面的行解码失败时按这一行重新检测, 前面只有 ASCII 的行用哪种编码解码都一样
         """
-        for line in stream.splitlines():
-            yield line
+        ascii_only = True
+        for line in lines:
+            try:
+                text = line.decode(encoding)
+            except UnicodeDecodeError:
+                if not ascii_only:
+                    raise
+                encoding = cls._detect_line_encoding(line)
+                logger.debug('CSV encoding changed to {}'.format(encoding))
+                text = line.decode(encoding)
+            ascii_only = ascii_only and len(text) == len(line)
+            yield text
 
     @staticmethod
-    def _gen_rows(csv_data, charset='utf-8', **kwargs):
-        csv_reader = unicodecsv.reader(csv_data, encoding=charset, **kwargs)
+    def _gen_rows(csv_data, **kwargs):
+        csv_reader = csv.reader(csv_data, **kwargs)
         for row in csv_reader:
             if not any(row):  # 空行
                 continue
@@ -106,24 +172,29 @@ class JMSCSVParser(BaseParser):
             logger.debug(e, exc_info=True)
             raise ParseError('The resource does not support imports!')
 
-        content_length = int(meta.get('CONTENT_LENGTH', meta.get('HTTP_CONTENT_LENGTH', 0)))
-        if content_length > self.CSV_UPLOAD_MAX_SIZE:
-            msg = CsvDataTooBig.default_detail % self.CSV_UPLOAD_MAX_SIZE
+        max_size = settings.CSV_IMPORT_MAX_SIZE
+        content_length = int(meta.get('CONTENT_LENGTH', meta.get('HTTP_CONTENT_LENGTH', 0)) or 0)
+        if max_size and content_length > max_size:
+            msg = CsvDataTooBig.default_detail % max_size
             logger.error(msg)
             raise CsvDataTooBig(msg)
 
         try:
-            stream_data = stream.read()
-            stream_data = stream_data.strip(codecs.BOM_UTF8)
-            detect_result = chardet.detect(stream_data)
-            encoding = detect_result.get("encoding", "utf-8")
-            binary = self._universal_newlines(stream_data)
-            rows = self._gen_rows(binary, charset=encoding)
+            head = stream.read(self.READ_CHUNK_SIZE)
+            if head.startswith(codecs.BOM_UTF8):
+                head = head[len(codecs.BOM_UTF8):]
+            encoding = self._detect_encoding(head)
+            chunks = chain([head], self._iter_chunks(stream, self.READ_CHUNK_SIZE))
+            binary = self._universal_newlines(chunks)
+            lines = self._decode_lines(binary, encoding)
+            rows = self._gen_rows(lines)
 
             header = next(rows)
             fields_map = self._get_fields_map(serializer_cls)
             header = [fields_map.get(name.strip('*'), '') for name in header]
 
+            # BulkImportMixin 按 request.data 是列表判断是否批量导入, 这里还是解析出所有行,
+            # 导入时再按批校验和写入
             data = []
             for row in rows:
                 row = self._process_row(row)
@@ -1,11 +1,13 @@
 # ~*~ coding: utf-8 ~*~
 #
 
+import csv
 import unicodecsv
 import codecs
 from datetime import datetime
 
 from six import BytesIO
+from django.http import HttpResponse, StreamingHttpResponse
 from rest_framework.renderers import BaseRenderer
 from rest_framework.utils import encoders, json
 
@@ -14,6 +16,11 @@ from common.utils import get_logger
 logger = get_logger(__file__)
 
 
+class Echo:
+    def write(self, value):
+        return value
+
+
 class JMSCSVRender(BaseRenderer):
 
     media_type = 'text/csv'
@@ -29,14 +36,19 @@ class JMSCSVRender(BaseRenderer):
             return [v for k, v in fields.items() if not v.write_only and k != "org_id"]
 
     @staticmethod
-    def _gen_table(data, fields):
-        data = data[:10000]
-        yield ['*{}'.format(f.label) if f.required else f.label for f in fields]
+    def _gen_header(fields):
+        return ['*{}'.format(f.label) if f.required else f.label for f in fields]
 
+    @staticmethod
+    def _gen_rows(data, fields):
         for item in data:
             row = [item.get(f.field_name) for f in fields]
             yield row
 
+    def _gen_table(self, data, fields):
+        yield self._gen_header(fields)
+        yield from self._gen_rows(data, fields)
+
     def set_response_disposition(self, serializer, context):
         response = context.get('response')
         if response and hasattr(serializer, 'Meta') and \
@@ -47,6 +59,57 @@ class JMSCSVRender(BaseRenderer):
             disposition = 'attachment; filename="{}"'.format(filename)
             response['Content-Disposition'] = disposition
 
+    @staticmethod
+    def iter_queryset_chunks(queryset, chunk_size):
+        """
+        用 iterator 分批取主键, 再按主键取出对象, 保持原来的排序,
+        每批对象的 prefetch_related 依然有效, 也不用 OFFSET 翻页
+        """
+        pks = queryset.values_list('pk', flat=True).iterator(chunk_size=chunk_size)
+        chunk = []
+        for pk in pks:
+            chunk.append(pk)
+            if len(chunk) < chunk_size:
+                continue
+            yield chunk
+            chunk = []
+        if chunk:
+            yield chunk
+
+    def stream(self, view, queryset, pks_queryset, fields, chunk_size):
+        writer = csv.writer(Echo())
+        yield codecs.BOM_UTF8
+        yield writer.writerow(self._gen_header(fields)).encode('utf-8')
+        for pks in self.iter_queryset_chunks(pks_queryset, chunk_size):
+            order = {pk: i for i, pk in enumerate(pks)}
+            objs = sorted(queryset.filter(pk__in=pks), key=lambda o: order.get(o.pk, 0))
+            data = view.get_serializer(objs, many=True).data
+            data = json.loads(json.dumps(data, cls=encoders.JSONEncoder))
+            for row in self._gen_rows(data, fields):
+                yield writer.writerow(row).encode('utf-8')
+
+    def render_streaming(self, view, queryset, pks_queryset=None, chunk_size=1000):
+        """
+        流式导出 CSV, 分批查询和序列化, 不限制行数, 内存占用固定
+        pks_queryset 决定导出哪些行 (可以是切片过的), 对象从 queryset 中按主键取
+        """
+        if pks_queryset is None:
+            pks_queryset = queryset
+        try:
+            serializer = view.get_serializer()
+            fields = self._get_show_fields(serializer.fields, 'export')
+        except Exception as e:
+            # 和 render 一致, 不返回 500
+            logger.debug(e, exc_info=True)
+            value = 'The resource not support export!'.encode('utf-8')
+            return HttpResponse(value, content_type=self.media_type)
+        response = StreamingHttpResponse(
+            self.stream(view, queryset, pks_queryset, fields, chunk_size),
+            content_type=self.media_type
+        )
+        self.set_response_disposition(serializer, {'response': response})
+        return response
+
     def render(self, data, media_type=None, renderer_context=None):
         renderer_context = renderer_context or {}
         request = renderer_context['request']
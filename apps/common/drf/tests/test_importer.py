@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+from types import SimpleNamespace
+
+from django.contrib.auth.models import AnonymousUser
+from django.test import TestCase
+from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+
+from users.models import User, UserGroup
+from common.drf.importer import BulkImporter
+
+
+class ImportUserSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = User
+        fields = ['id', 'name', 'username', 'email', 'groups']
+
+
+class FakeImportView:
+    def __init__(self, method='POST'):
+        self.request = SimpleNamespace(method=method, user=AnonymousUser())
+
+    @staticmethod
+    def get_serializer_class():
+        return ImportUserSerializer
+
+    @staticmethod
+    def get_serializer(partial=False):
+        return ImportUserSerializer(partial=partial)
+
+    @staticmethod
+    def get_queryset():
+        return User.objects.all()
+
+    @staticmethod
+    def filter_queryset(queryset):
+        return queryset
+
+    def check_object_permissions(self, request, obj):
+        pass
+
+
+class BulkImporterTestCase(TestCase):
+    def setUp(self):
+        self.groups = [UserGroup.objects.create(name='group-{}'.format(i)) for i in range(3)]
+
+    @staticmethod
+    def make_row(i, **kwargs):
+        row = {
+            'name': 'user-{}'.format(i), 'username': 'import-user-{}'.format(i),
+            'email': 'import-user-{}@example.com'.format(i),
+        }
+        row.update(kwargs)
+        return row
+
+    def run_import(self, rows, method='POST', chunk_size=2):
+        importer = BulkImporter(FakeImportView(method), rows)
+        importer.chunk_size = chunk_size
+        return importer, importer.run()
+
+    def test_create(self):
+        rows = [
+            self.make_row(i, groups=[str(self.groups[i % 3].id)])
+            for i in range(5)
+        ]
+        importer, summary = self.run_import(iter(rows))
+        self.assertEqual(summary, {'created': 5, 'updated': 0})
+        for i in range(5):
+            user = User.objects.get(username='import-user-{}'.format(i))
+            self.assertEqual(list(user.groups.all()), [self.groups[i % 3]])
+
+    def test_update_replace_m2m(self):
+        user = User.objects.create(**self.make_row(0))
+        user.groups.set(self.groups[:2])
+        row = self.make_row(0, id=str(user.id), name='updated', groups=[
+            str(self.groups[1].id), str(self.groups[2].id)
+        ])
+        importer, summary = self.run_import([row], method='PUT')
+        self.assertEqual(summary, {'created': 0, 'updated': 1})
+        user.refresh_from_db()
+        self.assertEqual(user.name, 'updated')
+        self.assertEqual(set(user.groups.all()), set(self.groups[1:]))
+        self.assertEqual(importer.m2m_added['groups'], [(user.id, self.groups[2].id)])
+        self.assertEqual(importer.m2m_removed['groups'], [(user.id, self.groups[0].id)])
+
+    def test_duplicate_in_file(self):
+        # 重复的行分在不同的批次中也要检查出来
+        rows = [self.make_row(0), self.make_row(1), self.make_row(0, name='dup')]
+        importer = BulkImporter(FakeImportView(), rows)
+        importer.chunk_size = 1
+        with self.assertRaises(ValidationError):
+            importer.run()
+        self.assertEqual(importer.errors[:2], [{}, {}])
+        self.assertIn('username', importer.errors[2])
+        self.assertIn('email', importer.errors[2])
+        self.assertFalse(User.objects.filter(username__startswith='import-user-').exists())
+
+    def test_row_errors(self):
+        User.objects.create(**self.make_row(9))
+        rows = [
+            self.make_row(0), self.make_row(1, email='invalid'),
+            self.make_row(2), self.make_row(9),
+        ]
+        importer = BulkImporter(FakeImportView(), rows)
+        with self.assertRaises(ValidationError):
+            importer.run()
+        self.assertEqual(len(importer.errors), 4)
+        self.assertEqual(importer.errors[0], {})
+        self.assertIn('email', importer.errors[1])
+        self.assertEqual(importer.errors[2], {})
+        self.assertIn('username', importer.errors[3])
+        self.assertEqual(
+            User.objects.filter(username__startswith='import-user-').count(), 1
+        )
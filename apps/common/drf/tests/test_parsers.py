@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+#
+import io
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase
+from rest_framework import serializers
+
+from common.drf.parsers import JMSCSVParser
+
+
+class CSVSerializer(serializers.Serializer):
+    name = serializers.CharField(label='名称')
+    comment = serializers.CharField(label='备注', required=False)
+
+
+class JMSCSVParserTestCase(SimpleTestCase):
+    def parse(self, content):
+        view = SimpleNamespace(
+            request=SimpleNamespace(META={'CONTENT_LENGTH': len(content)}),
+            get_serializer_class=lambda: CSVSerializer,
+        )
+        return JMSCSVParser().parse(io.BytesIO(content), parser_context={'view': view})
+
+    def test_utf8(self):
+        content = '名称,备注\r\n主机,中文备注\r\n'.encode('utf-8')
+        self.assertEqual(self.parse(content), [{'name': '主机', 'comment': '中文备注'}])
+
+    def test_gbk_after_first_chunk(self):
+        # 开头的一块都是 ASCII, 中文在后面
+        count = JMSCSVParser.READ_CHUNK_SIZE // 10 + 10
+        lines = ['name,comment'] + ['host{},ascii'.format(i) for i in range(count)]
+        lines.append('主机,中文备注')
+        content = '\r\n'.join(lines).encode('gbk')
+        self.assertGreater(content.index('主机'.encode('gbk')), JMSCSVParser.READ_CHUNK_SIZE)
+
+        data = self.parse(content)
+        self.assertEqual(len(data), count + 1)
+        self.assertEqual(data[0], {'name': 'host0', 'comment': 'ascii'})
+        self.assertEqual(data[-1], {'name': '主机', 'comment': '中文备注'})
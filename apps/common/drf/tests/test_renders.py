@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+import csv
+import io
+from types import SimpleNamespace
+
+from django.test import TestCase
+from rest_framework import serializers
+
+from users.models import User
+from common.drf.renders.csv import JMSCSVRender
+
+
+class ExportUserSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = User
+        fields = ['id', 'name', 'username', 'email', 'groups']
+
+
+class FakeExportView:
+    serializer_class = ExportUserSerializer
+
+    def get_serializer(self, *args, **kwargs):
+        return self.serializer_class(*args, **kwargs)
+
+
+class FakeBrokenExportView:
+    def get_serializer(self, *args, **kwargs):
+        raise AttributeError('no serializer')
+
+
+class JMSCSVRenderTestCase(TestCase):
+    def setUp(self):
+        for i in range(5):
+            User.objects.create(
+                name='user-{}'.format(i), username='export-user-{}'.format(i),
+                email='export-user-{}@example.com'.format(i)
+            )
+        self.queryset = User.objects.filter(username__startswith='export-user-')\
+            .order_by('-username')
+        self.render = JMSCSVRender()
+
+    @staticmethod
+    def parse(content):
+        return list(csv.reader(io.StringIO(content.decode('utf-8-sig'))))
+
+    def test_streaming_same_as_buffered(self):
+        view = FakeExportView()
+        data = view.get_serializer(self.queryset, many=True).data
+        context = {'request': SimpleNamespace(query_params={}), 'view': view}
+        buffered = self.parse(self.render.render(data, renderer_context=context))
+
+        # 每批 2 行, 跨批次的顺序也要保持
+        response = self.render.render_streaming(view, self.queryset, chunk_size=2)
+        streaming = self.parse(b''.join(response.streaming_content))
+        self.assertEqual(len(streaming), 6)
+        self.assertEqual(streaming, buffered)
+        usernames = [row[2] for row in streaming[1:]]
+        self.assertEqual(usernames, ['export-user-{}'.format(i) for i in range(4, -1, -1)])
+
+    def test_streaming_pks_queryset_slice(self):
+        view = FakeExportView()
+        response = self.render.render_streaming(
+            view, self.queryset, pks_queryset=self.queryset[1:3], chunk_size=1
+        )
+        rows = self.parse(b''.join(response.streaming_content))
+        self.assertEqual([row[2] for row in rows[1:]], ['export-user-3', 'export-user-2'])
+
+    def test_streaming_not_support_export(self):
+        response = self.render.render_streaming(FakeBrokenExportView(), self.queryset)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'The resource not support export!')
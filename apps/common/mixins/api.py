@@ -6,6 +6,7 @@ from threading import Thread
 from collections import defaultdict
 from itertools import chain
 
+from django.db.models import QuerySet
 from django.db.models.signals import m2m_changed
 from django.core.cache import cache
 from django.http import JsonResponse
@@ -15,11 +16,13 @@ from rest_framework import status
 from rest_framework_bulk.drf3.mixins import BulkDestroyModelMixin
 
 from common.drf.filters import IDSpmFilter, CustomFilter, IDInFilter
+from common.drf.parsers import JMSCSVParser
 from ..utils import lazyproperty
 
 __all__ = [
     'JSONResponseMixin', 'CommonApiMixin', 'AsyncApiMixin', 'RelationMixin',
-    'SerializerMixin2', 'QuerySetMixin', 'ExtraFilterFieldsMixin'
+    'SerializerMixin2', 'QuerySetMixin', 'ExtraFilterFieldsMixin',
+    'StreamingExportMixin', 'BulkImportMixin',
 ]
 
 
@@ -84,6 +87,76 @@ class CommonApiMixin(SerializerMixin, ExtraFilterFieldsMixin):
     pass
 
 
+class StreamingExportMixin:
+    """
+    导出 CSV 时 (?format=csv, template 为 export) 流式输出, 不先把整个列表序列化到内存中
+    只能用在有 list 的视图上
+    """
+    export_chunk_size = 1000
+
+    def is_streaming_export(self):
+        renderer = getattr(self.request, 'accepted_renderer', None)
+        if not hasattr(renderer, 'render_streaming'):
+            return False
+        template = self.request.query_params.get('template', 'export')
+        return template == 'export'
+
+    def get_export_pks_queryset(self, queryset):
+        # 带了分页参数时只导出这一页, 和不流式导出时一致
+        paginator = self.paginator
+        if paginator is None:
+            return queryset
+        limit = paginator.get_limit(self.request)
+        if limit is None:
+            return queryset
+        offset = paginator.get_offset(self.request)
+        return queryset[offset:offset + limit]
+
+    def list(self, request, *args, **kwargs):
+        if not self.is_streaming_export():
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        if not isinstance(queryset, QuerySet):
+            return super().list(request, *args, **kwargs)
+        pks_queryset = self.get_export_pks_queryset(queryset)
+        return request.accepted_renderer.render_streaming(
+            self, queryset, pks_queryset=pks_queryset,
+            chunk_size=self.export_chunk_size
+        )
+
+
+class BulkImportMixin:
+    """
+    CSV 导入 (POST 创建, PUT/PATCH 批量更新) 时交给 bulk_importer_class 分批校验, 批量写入
+    返回创建和更新的数量, 不再把导入的数据逐个序列化返回
+    """
+    bulk_importer_class = None
+
+    def is_bulk_import(self):
+        if self.bulk_importer_class is None:
+            return False
+        if not isinstance(self.request.data, list):
+            return False
+        parser = getattr(self.request, 'accepted_parser', None)
+        return isinstance(parser, JMSCSVParser)
+
+    def perform_bulk_import(self, partial=False):
+        importer = self.bulk_importer_class(self, self.request.data, partial=partial)
+        return importer.run()
+
+    def create(self, request, *args, **kwargs):
+        if not self.is_bulk_import():
+            return super().create(request, *args, **kwargs)
+        summary = self.perform_bulk_import()
+        return Response(summary, status=status.HTTP_201_CREATED)
+
+    def bulk_update(self, request, *args, **kwargs):
+        if not self.is_bulk_import():
+            return super().bulk_update(request, *args, **kwargs)
+        summary = self.perform_bulk_import(partial=kwargs.pop('partial', False))
+        return Response(summary, status=status.HTTP_200_OK)
+
+
 class InterceptMixin:
     """
     Hack默认的dispatch, 让用户可以实现 self.do
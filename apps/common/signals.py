@@ -4,3 +4,5 @@
 from django.dispatch import Signal
 
 django_ready = Signal()
+# 批量导入不会触发每个对象的 post_save, 整次导入发送一次
+post_bulk_import = Signal(providing_args=('created', 'updated'))
@@ -1,24 +1,161 @@
 # -*- coding: utf-8 -*-
 #
 import os
+import mmap
+import json
+import ipaddress
+import threading
+from collections import OrderedDict
+
 from django.utils.translation import ugettext as _
 
-import ipdb
+__all__ = ['get_ip_city', 'get_ips_city', 'IPGeoService']
+
+
+class IPDBReader:
+    """
+    ipip.net ipdb 格式的数据库, 使用 mmap 只读映射, 不再每个进程把整个文件读到内存中,
+    多个 worker 进程共享同一份系统页缓存
+    查询时除了结果还返回命中的网段前缀长度, 同一网段的 IP 结果都一样
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        meta_length = int.from_bytes(self.data[:4], 'big')
+        self.meta = json.loads(self.data[4:4 + meta_length].decode('utf-8'))
+        self.node_count = self.meta['node_count']
+        self.fields = self.meta['fields']
+        self.offset = 4 + meta_length
+        self.v4_node = self._get_v4_node()
+
+    def _read_node(self, node, index):
+        off = self.offset + node * 8 + index * 4
+        return int.from_bytes(self.data[off:off + 4], 'big')
+
+    def _get_v4_node(self):
+        # IPv4 位于 ::ffff:0:0/96 下
+        node = 0
+        for i in range(96):
+            if node >= self.node_count:
+                break
+            node = self._read_node(node, 1 if i >= 80 else 0)
+        return node
+
+    def _find_node(self, ip_int):
+        node = self.v4_node
+        prefix = 0
+        while prefix < 32 and node < self.node_count:
+            bit = (ip_int >> (31 - prefix)) & 1
+            node = self._read_node(node, bit)
+            prefix += 1
+        if node <= self.node_count:
+            raise LookupError('IP not found')
+        return node, prefix
+
+    def _resolve(self, node):
+        off = self.offset + node - self.node_count + self.node_count * 8
+        size = int.from_bytes(self.data[off:off + 2], 'big')
+        return self.data[off + 2:off + 2 + size].decode('utf-8')
+
+    def find(self, ip_int, language='CN'):
+        node, prefix = self._find_node(ip_int)
+        values = self._resolve(node).split('\t')
+        start = self.meta['languages'][language]
+        return values[start:start + len(self.fields)], prefix
+
+
+class IPGeoService:
+    """
+    IP 归属地查询
+    - 最近查询的 IP 使用有上限的 LRU 缓存
+    - 查询结果按数据库中的网段 (CIDR) 缓存, 同一网段的其他 IP 不用再查数据库
+    """
+    ip_cache_size = 10000
+    network_cache_size = 50000
 
-__all__ = ['get_ip_city']
-ipip_db = None
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(os.path.dirname(__file__), 'ipipfree.ipdb')
+        self.reader = IPDBReader(path)
+        self.lock = threading.Lock()
+        self.ip_cache = OrderedDict()
+        # {(prefix, network): city}
+        self.network_cache = OrderedDict()
+        self.prefixes = set()
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    @staticmethod
+    def _cache_get(cache, key):
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+    @staticmethod
+    def _cache_set(cache, key, value, max_size):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+
+    def _get_network_city(self, ip_int):
+        for prefix in self.prefixes:
+            key = (prefix, ip_int >> (32 - prefix))
+            city = self._cache_get(self.network_cache, key)
+            if city is not None:
+                return city
+        return None
+
+    def _lookup(self, ip_int):
+        try:
+            info, prefix = self.reader.find(ip_int)
+        except (LookupError, ValueError):
+            return ''
+        city = ' '.join(OrderedDict.fromkeys(i for i in info if i))
+        key = (prefix, ip_int >> (32 - prefix))
+        self._cache_set(self.network_cache, key, city, self.network_cache_size)
+        self.prefixes.add(prefix)
+        return city
+
+    def get_city(self, ip):
+        if not ip or not isinstance(ip, str):
+            return _("Invalid ip")
+        if ':' in ip:
+            return 'IPv6'
+        with self.lock:
+            city = self._cache_get(self.ip_cache, ip)
+            if city is not None:
+                return city
+            try:
+                ip_int = int(ipaddress.IPv4Address(ip))
+            except ValueError:
+                return ''
+            city = self._get_network_city(ip_int)
+            if city is None:
+                city = self._lookup(ip_int)
+            self._cache_set(self.ip_cache, ip, city, self.ip_cache_size)
+        return city
+
+    def get_cities(self, ips):
+        """
+        批量查询, 返回 {ip: city}, 重复的 IP 只查一次
+        """
+        return {ip: self.get_city(ip) for ip in set(ips)}
 
 
 def get_ip_city(ip):
-    global ipip_db
-    if not ip or not isinstance(ip, str):
-        return _("Invalid ip")
-    if ':' in ip:
-        return 'IPv6'
-    if ipip_db is None:
-        ipip_db_path = os.path.join(os.path.dirname(__file__), 'ipipfree.ipdb')
-        ipip_db = ipdb.City(ipip_db_path)
-    info = list(set(ipip_db.find(ip, 'CN')))
-    if '' in info:
-        info.remove('')
-    return ' '.join(info)
+    return IPGeoService.get_instance().get_city(ip)
+
+
+def get_ips_city(ips):
+    return IPGeoService.get_instance().get_cities(ips)
@@ -1,14 +1,12 @@
-from django.core.cache import cache
 from django.utils import timezone
 from django.utils.timesince import timesince
-from django.db.models import Count, Max
+from django.db.models import Count, Max, Sum
 from django.http.response import JsonResponse
 from rest_framework.views import APIView
-from collections import Counter
 
 from users.models import User
 from assets.models import Asset
-from terminal.models import Session
+from terminal.models import Session, SessionDailyStat
 from orgs.utils import current_org
 from common.permissions import IsOrgAdmin, IsOrgAuditor
 from common.utils import lazyproperty
@@ -17,6 +15,9 @@ __all__ = ['IndexApi']
 
 
 class DatesLoginMetricMixin:
+    """
+    日期相关的统计都从会话日统计 SessionDailyStat 中计算, 查询量和会话数量无关
+    """
     @lazyproperty
     def days(self):
         query_params = self.request.query_params
@@ -32,99 +33,51 @@ class DatesLoginMetricMixin:
 
     @lazyproperty
     def session_dates_list(self):
-        now = timezone.now()
+        now = timezone.localtime(timezone.now())
         dates = [(now - timezone.timedelta(days=i)).date() for i in range(self.days)]
         dates.reverse()
-        # dates = self.sessions_queryset.dates('date_start', 'day')
         return dates
 
+    @lazyproperty
+    def stats_queryset(self):
+        return SessionDailyStat.objects.filter(date__gte=self.session_dates_list[0])
+
+    @lazyproperty
+    def users_stats_queryset(self):
+        return self.stats_queryset.filter(type=SessionDailyStat.TYPE_USER)
+
+    @lazyproperty
+    def assets_stats_queryset(self):
+        return self.stats_queryset.filter(type=SessionDailyStat.TYPE_ASSET)
+
     def get_dates_metrics_date(self):
         dates_metrics_date = [d.strftime('%m-%d') for d in self.session_dates_list] or ['0']
         return dates_metrics_date
 
-    @staticmethod
-    def get_cache_key(date, tp):
-        date_str = date.strftime("%Y%m%d")
-        key = "SESSION_DATE_{}_{}_{}".format(current_org.id, tp, date_str)
-        return key
-
-    def __get_data_from_cache(self, date, tp):
-        if date == timezone.now().date():
-            return None
-        cache_key = self.get_cache_key(date, tp)
-        count = cache.get(cache_key)
-        return count
-
-    def __set_data_to_cache(self, date, tp, count):
-        cache_key = self.get_cache_key(date, tp)
-        cache.set(cache_key, count, 3600*24*7)
-
-    @staticmethod
-    def get_date_start_2_end(d):
-        time_min = timezone.datetime.min.time()
-        time_max = timezone.datetime.max.time()
-        tz = timezone.get_current_timezone()
-        ds = timezone.datetime.combine(d, time_min).replace(tzinfo=tz)
-        de = timezone.datetime.combine(d, time_max).replace(tzinfo=tz)
-        return ds, de
-
-    def get_date_login_count(self, date):
-        tp = "LOGIN"
-        count = self.__get_data_from_cache(date, tp)
-        if count is not None:
-            return count
-        ds, de = self.get_date_start_2_end(date)
-        count = Session.objects.filter(date_start__range=(ds, de)).count()
-        self.__set_data_to_cache(date, tp, count)
-        return count
+    def get_dates_metrics(self, queryset, aggregate):
+        rows = queryset.values('date').order_by().annotate(total=aggregate)
+        data = {row['date']: row['total'] for row in rows}
+        return [data.get(d, 0) for d in self.session_dates_list]
 
     def get_dates_metrics_total_count_login(self):
-        data = []
-        for d in self.session_dates_list:
-            count = self.get_date_login_count(d)
-            data.append(count)
+        data = self.get_dates_metrics(self.users_stats_queryset, Sum('count'))
         if len(data) == 0:
             data = [0]
         return data
 
-    def get_date_user_count(self, date):
-        tp = "USER"
-        count = self.__get_data_from_cache(date, tp)
-        if count is not None:
-            return count
-        ds, de = self.get_date_start_2_end(date)
-        count = len(set(Session.objects.filter(date_start__range=(ds, de)).values_list('user', flat=True)))
-        self.__set_data_to_cache(date, tp, count)
-        return count
-
     def get_dates_metrics_total_count_active_users(self):
-        data = []
-        for d in self.session_dates_list:
-            count = self.get_date_user_count(d)
-            data.append(count)
-        return data
-
-    def get_date_asset_count(self, date):
-        tp = "ASSET"
-        count = self.__get_data_from_cache(date, tp)
-        if count is not None:
-            return count
-        ds, de = self.get_date_start_2_end(date)
-        count = len(set(Session.objects.filter(date_start__range=(ds, de)).values_list('asset', flat=True)))
-        self.__set_data_to_cache(date, tp, count)
-        return count
+        return self.get_dates_metrics(
+            self.users_stats_queryset, Count('value', distinct=True)
+        )
 
     def get_dates_metrics_total_count_active_assets(self):
-        data = []
-        for d in self.session_dates_list:
-            count = self.get_date_asset_count(d)
-            data.append(count)
-        return data
+        return self.get_dates_metrics(
+            self.assets_stats_queryset, Count('value', distinct=True)
+        )
 
     @lazyproperty
     def dates_total_count_active_users(self):
-        count = len(set(self.sessions_queryset.values_list('user', flat=True)))
-        return count
+        return self.users_stats_queryset.values('value').distinct().count()
 
     @lazyproperty
     def dates_total_count_inactive_users(self):
@@ -141,7 +94,7 @@ class DatesLoginMetricMixin:
 
     @lazyproperty
     def dates_total_count_active_assets(self):
-        return len(set(self.sessions_queryset.values_list('asset', flat=True)))
+        return self.assets_stats_queryset.values('value').distinct().count()
 
     @lazyproperty
     def dates_total_count_inactive_assets(self):
@@ -155,37 +108,36 @@ class DatesLoginMetricMixin:
     @lazyproperty
     def dates_total_count_disabled_assets(self):
         return Asset.objects.filter(is_active=False).count()
-    
+
+    @staticmethod
+    def get_stats_top(queryset, name, limit):
+        rows = queryset.values('value').order_by()\
+            .annotate(total=Sum('count'), last=Max('date_last'))\
+            .order_by('-total')[:limit]
+        return [
+            {name: row['value'], 'total': row['total'], 'last': str(row['last'])}
+            for row in rows
+        ]
+
     # 以下是从week中而来
     def get_dates_login_times_top5_users(self):
-        users = self.sessions_queryset.values_list('user', flat=True)
-        users = [
-            {'user': user, 'total': total}
-            for user, total in Counter(users).most_common(5)
-        ]
+        users = self.get_stats_top(self.users_stats_queryset, 'user', 5)
+        for user in users:
+            user.pop('last')
         return users
 
     def get_dates_total_count_login_users(self):
-        return len(set(self.sessions_queryset.values_list('user', flat=True)))
+        return self.dates_total_count_active_users
 
     def get_dates_total_count_login_times(self):
-        return self.sessions_queryset.count()
+        total = self.users_stats_queryset.aggregate(total=Sum('count'))['total']
+        return total or 0
 
     def get_dates_login_times_top10_assets(self):
-        assets = self.sessions_queryset.values("asset") \
-                     .annotate(total=Count("asset")) \
-                     .annotate(last=Max("date_start")).order_by("-total")[:10]
-        for asset in assets:
-            asset['last'] = str(asset['last'])
-        return list(assets)
+        return self.get_stats_top(self.assets_stats_queryset, 'asset', 10)
 
     def get_dates_login_times_top10_users(self):
-        users = self.sessions_queryset.values("user") \
-                    .annotate(total=Count("user")) \
-                    .annotate(last=Max("date_start")).order_by("-total")[:10]
-        for user in users:
-            user['last'] = str(user['last'])
-        return list(users)
+        return self.get_stats_top(self.users_stats_queryset, 'user', 10)
 
     def get_dates_login_record_top10_sessions(self):
         sessions = self.sessions_queryset.order_by('-date_start')[:10]
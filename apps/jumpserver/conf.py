@@ -168,6 +168,8 @@ class Config(dict):
         'AUTH_LDAP_SYNC_IS_PERIODIC': False,
         'AUTH_LDAP_SYNC_INTERVAL': None,
         'AUTH_LDAP_SYNC_CRONTAB': None,
+        'AUTH_LDAP_SYNC_CHANGE_ATTR': 'modifyTimestamp',
+        'AUTH_LDAP_SYNC_FULL_INTERVAL': 24,
         'AUTH_LDAP_USER_LOGIN_ONLY_IN_USERS': False,
         'AUTH_LDAP_OPTIONS_OPT_REFERRALS': -1,
 
@@ -227,6 +229,12 @@ class Config(dict):
         'TERMINAL_HOST_KEY': '',
         'TERMINAL_TELNET_REGEX': '',
         'TERMINAL_COMMAND_STORAGE': {},
+        'TERMINAL_COMMAND_BUFFER_ENABLED': False,
+        'TERMINAL_COMMAND_BUFFER_FLUSH_SIZE': 1000,
+        'TERMINAL_COMMAND_BUFFER_FLUSH_INTERVAL': 5,
+        'TERMINAL_COMMAND_BUFFER_MAX_LENGTH': 500000,
+        'ANSIBLE_TASK_FORKS': 10,
+        'ANSIBLE_TASK_SHARD_SIZE': 500,
 
         'SECURITY_MFA_AUTH': False,
         'SECURITY_COMMAND_EXECUTION': True,
@@ -252,6 +260,11 @@ class Config(dict):
         'ASSETS_PERM_CACHE_TIME': 3600 * 24,
         'SECURITY_MFA_VERIFY_TTL': 3600,
         'ASSETS_PERM_CACHE_ENABLE': HAS_XPACK,
+        'ASSETS_PERM_CACHE_WARM_UP_DAYS': 7,
+        'ASSETS_PERM_CACHE_WARM_UP_MAX_USERS': 1000,
+        'ASSETS_PERM_CACHE_WARM_UP_WORKERS': 4,
+        'ASSETS_PERM_CACHE_WARM_UP_DELAY': 30,
+        'ASSETS_TREE_ENGINE': 'treelib',
         'SYSLOG_ADDR': '',  # '192.168.0.1:514'
         'SYSLOG_FACILITY': 'user',
         'SYSLOG_SOCKTYPE': 2,
@@ -269,6 +282,8 @@ class Config(dict):
         'CHANGE_AUTH_PLAN_SECURE_MODE_ENABLED': True,
         'USER_LOGIN_SINGLE_MACHINE_ENABLED': False,
         'TICKETS_ENABLED': True,
+        'CSV_IMPORT_MAX_SIZE': 1024 * 1024 * 200,
+        'CSV_IMPORT_CHUNK_SIZE': 1000,
         'SEND_COMMAND_ALERT_EMAIL_ENABLED': True,
         'INSECURE_COMMAND_LEVEL': 5
     }
@@ -42,6 +42,10 @@ AUTH_LDAP_SEARCH_PAGED_SIZE = CONFIG.AUTH_LDAP_SEARCH_PAGED_SIZE
 AUTH_LDAP_SYNC_IS_PERIODIC = CONFIG.AUTH_LDAP_SYNC_IS_PERIODIC
 AUTH_LDAP_SYNC_INTERVAL = CONFIG.AUTH_LDAP_SYNC_INTERVAL
 AUTH_LDAP_SYNC_CRONTAB = CONFIG.AUTH_LDAP_SYNC_CRONTAB
+# Incremental sync fetches only entries whose change attr (modifyTimestamp or uSNChanged)
+# is newer than the last sync, a full sync runs every AUTH_LDAP_SYNC_FULL_INTERVAL hours
+AUTH_LDAP_SYNC_CHANGE_ATTR = CONFIG.AUTH_LDAP_SYNC_CHANGE_ATTR
+AUTH_LDAP_SYNC_FULL_INTERVAL = CONFIG.AUTH_LDAP_SYNC_FULL_INTERVAL
 AUTH_LDAP_USER_LOGIN_ONLY_IN_USERS = CONFIG.AUTH_LDAP_USER_LOGIN_ONLY_IN_USERS
 
 
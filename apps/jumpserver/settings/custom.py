@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 #
-from ..const import CONFIG, DYNAMIC
+import os
+
+from ..const import CONFIG, DYNAMIC, PROJECT_DIR
 
 # Storage settings
 COMMAND_STORAGE = {
@@ -55,10 +57,31 @@ TERMINAL_HOST_KEY = DYNAMIC.TERMINAL_HOST_KEY
 TERMINAL_HEADER_TITLE = DYNAMIC.TERMINAL_HEADER_TITLE
 TERMINAL_TELNET_REGEX = DYNAMIC.TERMINAL_TELNET_REGEX
 
+# Buffer commands reported by terminals in redis, then write them in batches
+TERMINAL_COMMAND_BUFFER_ENABLED = CONFIG.TERMINAL_COMMAND_BUFFER_ENABLED
+TERMINAL_COMMAND_BUFFER_FLUSH_SIZE = CONFIG.TERMINAL_COMMAND_BUFFER_FLUSH_SIZE
+TERMINAL_COMMAND_BUFFER_FLUSH_INTERVAL = CONFIG.TERMINAL_COMMAND_BUFFER_FLUSH_INTERVAL
+TERMINAL_COMMAND_BUFFER_MAX_LENGTH = CONFIG.TERMINAL_COMMAND_BUFFER_MAX_LENGTH
+
+# Ansible tasks on many hosts are split into shards which run in parallel
+ANSIBLE_TASK_FORKS = CONFIG.ANSIBLE_TASK_FORKS
+ANSIBLE_TASK_SHARD_SIZE = CONFIG.ANSIBLE_TASK_SHARD_SIZE
+
 # User or user group permission cache time, default 3600 seconds
 ASSETS_PERM_CACHE_ENABLE = CONFIG.ASSETS_PERM_CACHE_ENABLE
 ASSETS_PERM_CACHE_TIME = CONFIG.ASSETS_PERM_CACHE_TIME
 
+# Warm up permission tree cache of recently active users after permissions changed
+ASSETS_PERM_CACHE_WARM_UP_DAYS = CONFIG.ASSETS_PERM_CACHE_WARM_UP_DAYS
+ASSETS_PERM_CACHE_WARM_UP_MAX_USERS = CONFIG.ASSETS_PERM_CACHE_WARM_UP_MAX_USERS
+ASSETS_PERM_CACHE_WARM_UP_WORKERS = CONFIG.ASSETS_PERM_CACHE_WARM_UP_WORKERS
+ASSETS_PERM_CACHE_WARM_UP_DELAY = CONFIG.ASSETS_PERM_CACHE_WARM_UP_DELAY
+
+# Node tree engine, `treelib` or `compact` (array based, less memory)
+ASSETS_TREE_ENGINE = CONFIG.ASSETS_TREE_ENGINE
+# Compact tree snapshots are mapped from this dir, shared by all workers on the host
+ASSETS_TREE_SNAPSHOT_DIR = os.path.join(PROJECT_DIR, 'data', 'tree')
+
 # Asset user auth external backend, default AuthBook backend
 BACKEND_ASSET_USER_AUTH_VAULT = False
 
@@ -108,3 +131,7 @@ CHANGE_AUTH_PLAN_SECURE_MODE_ENABLED = CONFIG.CHANGE_AUTH_PLAN_SECURE_MODE_ENABL
 DATETIME_DISPLAY_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 TICKETS_ENABLED = CONFIG.TICKETS_ENABLED
+
+# CSV import, max upload size in bytes and rows validated and written per batch
+CSV_IMPORT_MAX_SIZE = CONFIG.CSV_IMPORT_MAX_SIZE
+CSV_IMPORT_CHUNK_SIZE = CONFIG.CSV_IMPORT_CHUNK_SIZE
@@ -1,3 +1,6 @@
+import os
+import queue
+import threading
 from logging import StreamHandler
 
 from django.conf import settings
@@ -6,10 +9,14 @@ from celery.signals import task_prerun, task_postrun
 from kombu import Connection, Exchange, Queue, Producer
 from kombu.mixins import ConsumerMixin
 
+from common.utils import get_logger
 from .utils import get_celery_task_log_path
 
+logger = get_logger(__file__)
+
 routing_key = 'celery_log'
-celery_log_exchange = Exchange('celery_log_exchange', type='direct')
+# fanout 在 redis 中使用 pub/sub 实现, 没有订阅者时日志直接丢弃, 不会在 broker 中堆积
+celery_log_exchange = Exchange('celery_log_exchange', type='fanout')
 celery_log_queue = [Queue('celery_log', celery_log_exchange, routing_key=routing_key)]
 
 
@@ -49,19 +56,27 @@ class CeleryLoggerProducer:
 
     def __init__(self):
         self.connection = Connection(settings.CELERY_LOG_BROKER_URL)
+        self._producer = None
+        self._lock = threading.Lock()
 
     @property
     def producer(self):
-        return Producer(self.connection)
+        if self._producer is None:
+            self._producer = Producer(self.connection)
+        return self._producer
 
     def publish(self, payload):
-        self.producer.publish(
-            payload, serializer='json', exchange=celery_log_exchange,
-            declare=[celery_log_exchange], routing_key=routing_key
-        )
-
-    def log(self, task_id, msg):
-        payload = {'task_id': task_id, 'msg': msg, 'action': self.ACTION_TASK_LOG}
+        with self._lock:
+            self.producer.publish(
+                payload, serializer='json', exchange=celery_log_exchange,
+                declare=[celery_log_exchange], routing_key=routing_key
+            )
+
+    def log(self, task_id, msg, offset=None):
+        payload = {
+            'task_id': task_id, 'msg': msg,
+            'offset': offset, 'action': self.ACTION_TASK_LOG
+        }
         return self.publish(payload)
 
     def read(self):
@@ -79,6 +94,97 @@ class CeleryLoggerProducer:
         return self.publish(payload)
 
 
+class CeleryLogPublisher:
+    """
+    任务日志推送, 每个进程一个
+    日志处理器只是把消息放到有上限的队列里, 后台线程用同一个连接批量发布,
+    同一任务在文件中首尾相接的日志合并成一条, 带上合并后的起止偏移; 队列满了丢弃推送, 文件中的日志不受影响
+    """
+    batch_size = 200
+    max_queue_size = 10000
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.queue = queue.Queue(maxsize=self.max_queue_size)
+        self.producer = CeleryLoggerProducer()
+        # 连续失败或丢弃时只记录第一次, 恢复后重新记录
+        self.publish_failed = False
+        self.dropping = False
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+
+    @classmethod
+    def get_instance(cls):
+        with cls._lock:
+            # fork 出来的 worker 子进程中没有父进程的后台线程, 重新创建
+            if cls._instance is None or cls._instance.pid != os.getpid():
+                cls._instance = cls()
+        return cls._instance
+
+    def put(self, payload):
+        try:
+            self.queue.put_nowait(payload)
+            self.dropping = False
+        except queue.Full:
+            if not self.dropping:
+                self.dropping = True
+                logger.warning('Celery task log queue is full, drop publishing')
+
+    def log(self, task_id, msg, offset=None, start=None):
+        self.put({
+            'task_id': task_id, 'msg': msg, 'offset': offset, 'start': start,
+            'action': CeleryLoggerProducer.ACTION_TASK_LOG
+        })
+
+    def task_start(self, task_id):
+        self.put({'task_id': task_id, 'action': CeleryLoggerProducer.ACTION_TASK_START})
+
+    def task_end(self, task_id):
+        self.put({'task_id': task_id, 'action': CeleryLoggerProducer.ACTION_TASK_END})
+
+    def get_payloads(self):
+        payloads = [self.queue.get()]
+        try:
+            while len(payloads) < self.batch_size:
+                payloads.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return payloads
+
+    @staticmethod
+    def merge(payloads):
+        merged = []
+        for payload in payloads:
+            last = merged[-1] if merged else None
+            # 同一任务的子任务可能在其他进程中写同一个文件, 中间有别人写入的不合并
+            if last and payload['action'] == last['action'] == CeleryLoggerProducer.ACTION_TASK_LOG \
+                    and payload['task_id'] == last['task_id'] \
+                    and payload['start'] is not None and payload['start'] == last['offset']:
+                last['msg'] += payload['msg']
+                last['offset'] = payload['offset']
+                continue
+            merged.append(dict(payload))
+        return merged
+
+    def run(self):
+        while True:
+            payloads = self.merge(self.get_payloads())
+            try:
+                for payload in payloads:
+                    self.producer.publish(payload)
+                self.publish_failed = False
+            except Exception as e:
+                if not self.publish_failed:
+                    self.publish_failed = True
+                    logger.error('Publish celery task log error: {}'.format(e))
+                # 连接可能已经断开, 下次重新建立
+                self.producer.connection.release()
+                self.producer = CeleryLoggerProducer()
+
+
 class CeleryTaskLoggerHandler(StreamHandler):
     terminator = '\r\n'
 
@@ -137,10 +243,19 @@ class CeleryTaskMQLoggerHandler(CeleryTaskLoggerHandler):
 
 
 class CeleryTaskFileHandler(CeleryTaskLoggerHandler):
+    """
+    任务日志写入文件, 同时把每行日志和它在文件中的起止偏移交给后台线程发布到 MQ,
+    查看日志的 websocket 据此实时推送, 偏移用来和回放的文件内容去重
+    """
     def __init__(self):
         self.f = None
+        self.task_id = None
         super().__init__(stream=None)
 
+    @property
+    def publisher(self):
+        return CeleryLogPublisher.get_instance()
+
     def emit(self, record):
         msg = self.format(record)
         if not self.f or self.f.closed:
@@ -148,13 +263,20 @@ class CeleryTaskFileHandler(CeleryTaskLoggerHandler):
         self.f.write(msg)
         self.f.write(self.terminator)
         self.flush()
+        msg += self.terminator
+        offset = self.f.tell()
+        start = offset - len(msg.encode(self.f.encoding, errors='replace'))
+        self.publisher.log(self.task_id, msg, offset, start)
 
     def flush(self):
         self.f and self.f.flush()
 
     def handle_task_start(self, task_id):
         log_path = get_celery_task_log_path(task_id)
-        self.f = open(log_path, 'a')
+        self.f = open(log_path, 'a', encoding='utf-8')
+        self.task_id = task_id
+        self.publisher.task_start(task_id)
 
     def handle_task_end(self, task_id):
         self.f and self.f.close()
+        self.publisher.task_end(self.task_id)
@@ -1,10 +1,20 @@
 # -*- coding: utf-8 -*-
 #
+import copy
+import json
+import random
+import time
+import threading
+from collections import defaultdict
+from hashlib import md5
 
+from celery import current_task
 from django.conf import settings
+from django.db.models import Prefetch, QuerySet
 from .ansible.inventory import BaseInventory
 
 from common.utils import get_logger
+from orgs.utils import tmp_to_root_org
 
 __all__ = [
     'JMSInventory', 'JMSCustomInventory',
@@ -14,10 +24,145 @@ __all__ = [
 logger = get_logger(__file__)
 
 
+class InventoryHostsCache:
+    """
+    构建好的 host 列表缓存, 只在当前 celery 任务内有效
+    同一个任务里多次用同样的资产和运行用户构建 inventory 时不再重复查询
+    host 里有密码等认证信息, 所以只缓存在进程内, 不写入 redis
+    """
+    ttl = 600
+    _local = threading.local()
+
+    @classmethod
+    def get_task_id(cls):
+        if not current_task:
+            return None
+        return current_task.request.id
+
+    @classmethod
+    def make_key(cls, assets_id, **kwargs):
+        assets_id = sorted(str(i) for i in assets_id)
+        data = json.dumps([assets_id, kwargs], sort_keys=True, default=str)
+        return md5(data.encode()).hexdigest()
+
+    @classmethod
+    def get_store(cls):
+        task_id = cls.get_task_id()
+        if task_id is None:
+            return None
+        store = getattr(cls._local, 'store', None)
+        # 换了任务就清空, 避免认证信息在 worker 进程里长期保留
+        if store is None or store['task_id'] != task_id:
+            store = {'task_id': task_id, 'items': {}}
+            cls._local.store = store
+        return store['items']
+
+    @classmethod
+    def get(cls, key):
+        store = cls.get_store()
+        if store is None or key not in store:
+            return None
+        expired_at, host_list = store[key]
+        if expired_at < time.time():
+            store.pop(key, None)
+            return None
+        return copy.deepcopy(host_list)
+
+    @classmethod
+    def set(cls, key, host_list):
+        store = cls.get_store()
+        if store is None:
+            return
+        store[key] = (time.time() + cls.ttl, copy.deepcopy(host_list))
+
+
 class JMSBaseInventory(BaseInventory):
     windows_ssh_default_shell = settings.WINDOWS_SSH_DEFAULT_SHELL
 
-    def convert_to_ansible(self, asset, run_as_admin=False):
+    @staticmethod
+    def prefetch_assets(assets):
+        """
+        批量加载资产相关的管理用户, 网域网关, 平台和标签, 避免构建每台主机时都查询
+        """
+        from assets.models import Asset, Gateway
+
+        if not isinstance(assets, QuerySet):
+            assets = list(assets)
+            if not assets:
+                return []
+            assets_id = [asset.id for asset in assets]
+            order = {str(i): index for index, i in enumerate(assets_id)}
+            # 传入的是资产实例, 不再按当前组织过滤
+            with tmp_to_root_org():
+                assets = Asset.objects.filter(id__in=assets_id)
+        else:
+            order = None
+
+        gateways = Gateway.objects.filter(is_active=True)
+        assets = assets.select_related('admin_user', 'domain', 'platform')\
+            .prefetch_related(
+                'labels',
+                Prefetch('domain__gateway_set', queryset=gateways, to_attr='active_gateways')
+            )
+        with tmp_to_root_org():
+            assets = list(assets)
+        if order is not None:
+            assets.sort(key=lambda a: order.get(str(a.id), 0))
+        return assets
+
+    @staticmethod
+    def get_assets_admin_auth_info(assets):
+        """
+        批量获取资产管理用户的认证信息, 和 asset.get_auth_info() 结果一样
+        每个管理用户只查一次资产上的特殊认证, 而不是每台资产都查一次
+        """
+        from assets.backends import AssetUserManager
+
+        assets_by_admin_user = defaultdict(list)
+        admin_users = {}
+        for asset in assets:
+            if not asset.admin_user:
+                continue
+            admin_users[asset.admin_user_id] = asset.admin_user
+            assets_by_admin_user[asset.admin_user_id].append(asset)
+
+        manager = AssetUserManager()
+        auth_info = {}
+        for admin_user_id, _assets in assets_by_admin_user.items():
+            admin_user = admin_users[admin_user_id]
+            try:
+                special_auths = manager.filter(
+                    username=admin_user.username, assets=_assets,
+                    prefer_id=admin_user.id, prefer=admin_user._prefer,
+                ).distinct()
+                special_auths = {
+                    str(item.asset_id): item for item in special_auths
+                }
+            except Exception as e:
+                logger.error(e, exc_info=True)
+                special_auths = {}
+
+            for asset in _assets:
+                user = admin_user
+                special_auth = special_auths.get(str(asset.id))
+                if special_auth:
+                    user = copy.copy(admin_user)
+                    user._merge_auth(special_auth)
+                auth_info[str(asset.id)] = {
+                    'username': user.username,
+                    'password': user.password,
+                    'private_key': user.private_key_file,
+                }
+        return auth_info
+
+    @staticmethod
+    def get_asset_gateways(asset):
+        gateways = getattr(asset.domain, 'active_gateways', None)
+        if gateways is None:
+            gateways = list(asset.domain.gateways)
+        return gateways
+
+    def convert_to_ansible(self, asset, run_as_admin=False, auth_info=None):
         info = {
             'id': asset.id,
             'hostname': asset.hostname,
@@ -26,10 +171,14 @@ class JMSBaseInventory(BaseInventory):
             'vars': dict(),
             'groups': [],
         }
-        if asset.domain and asset.domain.has_gateway():
-            info["vars"].update(self.make_proxy_command(asset))
+        if asset.domain:
+            gateways = self.get_asset_gateways(asset)
+            if gateways:
+                info["vars"].update(self.make_proxy_command(asset, gateways))
         if run_as_admin:
-            info.update(asset.get_auth_info())
+            if auth_info is None:
+                auth_info = asset.get_auth_info()
+            info.update(auth_info)
             if asset.is_unixlike():
                 info["become"] = asset.admin_user.become_info
         if asset.is_windows():
@@ -48,8 +197,11 @@ class JMSBaseInventory(BaseInventory):
         return info
 
     @staticmethod
-    def make_proxy_command(asset):
-        gateway = asset.domain.random_gateway()
+    def make_proxy_command(asset, gateways=None):
+        if gateways:
+            gateway = random.choice(gateways)
+        else:
+            gateway = asset.domain.random_gateway()
         proxy_command_list = [
             "ssh", "-o", "Port={}".format(gateway.port),
             "-o", "StrictHostKeyChecking=no",
@@ -88,18 +240,64 @@ class JMSInventory(JMSBaseInventory):
         self.run_as = run_as
         self.become_info = become_info
 
-        host_list = []
+        host_list = self.get_host_list()
+        super().__init__(host_list=host_list)
 
+    def get_host_list(self):
+        if isinstance(self.assets, QuerySet):
+            assets_id = self.assets.values_list('id', flat=True)
+        else:
+            assets_id = [asset.id for asset in self.assets]
+        cache_key = InventoryHostsCache.make_key(
+            assets_id, run_as_admin=self.using_admin,
+            run_as=self.run_as, become_info=self.become_info,
+        )
+        host_list = InventoryHostsCache.get(cache_key)
+        if host_list is not None:
+            return host_list
+        host_list = self.build_host_list()
+        InventoryHostsCache.set(cache_key, host_list)
+        return host_list
+
+    def build_host_list(self):
+        assets = self.prefetch_assets(self.assets)
+        admin_auth_info = {}
+        if self.using_admin:
+            admin_auth_info = self.get_assets_admin_auth_info(assets)
+        run_users_info = self.get_assets_run_user_info(assets)
+
+        host_list = []
         for asset in assets:
-            host = self.convert_to_ansible(asset, run_as_admin=run_as_admin)
-            if run_as is not None:
-                run_user_info = self.get_run_user_info(host)
-                host.update(run_user_info)
-            if become_info and asset.is_unixlike():
-                host.update(become_info)
+            host = self.convert_to_ansible(
+                asset, run_as_admin=self.using_admin,
+                auth_info=admin_auth_info.get(str(asset.id), {}),
+            )
+            if self.run_as is not None:
+                host.update(run_users_info.get(str(asset.id), {}))
+            if self.become_info and asset.is_unixlike():
+                host.update(self.become_info)
             host_list.append(host)
+        return host_list
 
-        super().__init__(host_list=host_list)
+    def get_assets_run_user_info(self, assets):
+        """
+        一次查出所有资产上 run_as 用户的最新认证信息
+        """
+        from assets.backends import AssetUserManager
+
+        if self.run_as is None or not assets:
+            return {}
+
+        try:
+            manager = AssetUserManager()
+            run_users = manager.filter(username=self.run_as, assets=assets).distinct()
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            return {}
+        return {
+            str(run_user.asset_id): run_user._to_secret_json()
+            for run_user in run_users
+        }
 
     def get_run_user_info(self, host):
         from assets.backends import AssetUserManager
@@ -135,7 +333,7 @@ class JMSCustomInventory(JMSBaseInventory):
 
         host_list = []
 
-        for asset in assets:
+        for asset in self.prefetch_assets(assets):
             host = self.convert_to_ansible(asset)
             run_user_info = self.get_run_user_info()
             host.update(run_user_info)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+#
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from ops.celery.logger import CeleryLogPublisher, CeleryLoggerProducer
+from ops.ws import CeleryLogWebsocket
+
+
+class CeleryLogMergeTestCase(SimpleTestCase):
+    def make_payloads(self, lines, start=0):
+        payloads = []
+        for line in lines:
+            size = len(line.encode())
+            payloads.append({
+                'task_id': 'task', 'msg': line, 'start': start, 'offset': start + size,
+                'action': CeleryLoggerProducer.ACTION_TASK_LOG,
+            })
+            start += size
+        return payloads
+
+    def receive(self, payloads, replayed):
+        ws = CeleryLogWebsocket.__new__(CeleryLogWebsocket)
+        ws.task_id = 'task'
+        ws.offset = replayed
+        sent = []
+        with mock.patch.object(ws, 'send_json', side_effect=lambda d: sent.append(d['message'])):
+            for payload in payloads:
+                ws.task_log(dict(payload, type='task.log'))
+        return ''.join(sent)
+
+    def test_merge_contiguous_lines(self):
+        lines = ['第一行\r\n', 'second\r\n', 'third\r\n']
+        merged = CeleryLogPublisher.merge(self.make_payloads(lines))
+        self.assertEqual(len(merged), 1)
+        self.assertEqual(merged[0]['msg'], ''.join(lines))
+        self.assertEqual(merged[0]['start'], 0)
+
+    def test_not_merge_gap(self):
+        payloads = self.make_payloads(['a\r\n']) + self.make_payloads(['b\r\n'], start=10)
+        self.assertEqual(len(CeleryLogPublisher.merge(payloads)), 2)
+
+    def test_replay_ends_inside_merged_batch(self):
+        lines = ['第一行\r\n', 'second\r\n', 'third\r\n']
+        merged = CeleryLogPublisher.merge(self.make_payloads(lines))
+        # 回放文件时已经读到了第一行
+        replayed = len(lines[0].encode())
+        self.assertEqual(
+            self.receive(merged, replayed), ''.join(lines[1:]).replace('\n', '\r\n')
+        )
+        self.assertEqual(self.receive(merged, merged[0]['offset']), '')
+        self.assertEqual(self.receive(merged, 0), ''.join(lines).replace('\n', '\r\n'))
@@ -1,18 +1,105 @@
-import time
 import os
 import threading
 import json
+import uuid
+from collections import Counter
+
+from asgiref.sync import async_to_sync
+from celery.result import AsyncResult
+from channels.generic.websocket import JsonWebsocketConsumer
+from channels.layers import get_channel_layer
+from kombu import Queue
 
 from common.utils import get_logger
 
 from .celery.utils import get_celery_task_log_path
-from channels.generic.websocket import JsonWebsocketConsumer
+from .celery.logger import CeleryLoggerConsumer, celery_log_exchange, routing_key
 
 logger = get_logger(__name__)
 
 
+class CeleryLogRelay(CeleryLoggerConsumer):
+    """
+    每个 websocket 进程一个, 在后台线程中订阅 worker 发布的任务日志,
+    只把有人在看的任务日志转发到 channel layer 的 group 中
+    group 名带上进程标识, 部署多个 websocket 进程时不会重复推送
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        super().__init__()
+        self.token = uuid.uuid4().hex[:12]
+        self.channel_layer = get_channel_layer()
+        self.watching = Counter()
+        self.watching_lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls):
+        with cls._lock:
+            if cls._instance is None:
+                instance = cls()
+                thread = threading.Thread(target=instance.run, daemon=True)
+                thread.start()
+                cls._instance = instance
+        return cls._instance
+
+    def get_consumers(self, Consumer, channel):
+        queue = Queue(
+            'celery_log_{}'.format(self.token), celery_log_exchange,
+            routing_key=routing_key, auto_delete=True,
+        )
+        return [Consumer(queues=[queue], accept=['json'], no_ack=True,
+                         callbacks=[self.process_task])]
+
+    def get_group_name(self, task_id):
+        return 'celery_log_{}_{}'.format(self.token, task_id)
+
+    def watch(self, task_id):
+        with self.watching_lock:
+            self.watching[task_id] += 1
+        return self.get_group_name(task_id)
+
+    def unwatch(self, task_id):
+        with self.watching_lock:
+            self.watching[task_id] -= 1
+            if self.watching[task_id] <= 0:
+                del self.watching[task_id]
+
+    def is_watching(self, task_id):
+        return task_id in self.watching
+
+    def send_to_group(self, task_id, event):
+        if not self.is_watching(task_id):
+            return
+        try:
+            group = self.get_group_name(task_id)
+            async_to_sync(self.channel_layer.group_send)(group, event)
+        except Exception as e:
+            logger.error("Relay task log error: {}".format(e))
+
+    def handle_task_start(self, task_id, message):
+        self.send_to_group(task_id, {'type': 'task.start'})
+
+    def handle_task_end(self, task_id, message):
+        self.send_to_group(task_id, {'type': 'task.end'})
+
+    def handle_task_log(self, task_id, msg, message):
+        payload = message.payload
+        self.send_to_group(task_id, {
+            'type': 'task.log', 'msg': msg,
+            'offset': payload.get('offset'), 'start': payload.get('start'),
+        })
+
+
 class CeleryLogWebsocket(JsonWebsocketConsumer):
-    disconnected = False
+    """
+    任务开始后 worker 推送日志, 不再每个连接起一个线程轮询日志文件
+    订阅后先回放文件中已有的日志, 推送过来的日志按文件偏移去掉已经回放过的部分
+    """
+    task_id = None
+    group_name = None
+    offset = 0
 
     def connect(self):
         self.accept()
@@ -23,52 +110,70 @@ class CeleryLogWebsocket(JsonWebsocketConsumer):
         if task_id:
             self.handle_task(task_id)
 
-    def wait_util_log_path_exist(self, task_id):
-        log_path = get_celery_task_log_path(task_id)
-        while not self.disconnected:
-            if not os.path.exists(log_path):
-                self.send_json({'message': '.', 'task': task_id})
-                time.sleep(0.5)
-                continue
-            self.send_json({'message': '\r\n'})
-            try:
-                logger.debug('Task log path: {}'.format(log_path))
-                task_log_f = open(log_path, 'rb')
-                return task_log_f
-            except OSError:
-                return None
-
-    def read_log_file(self, task_id):
-        task_log_f = self.wait_util_log_path_exist(task_id)
-        if not task_log_f:
-            logger.debug('Task log file is None: {}'.format(task_id))
-            return
+    def send_message(self, data):
+        if isinstance(data, bytes):
+            data = data.decode(errors='ignore')
+        data = data.replace('\n', '\r\n')
+        self.send_json({'message': data, 'task': self.task_id})
 
-        task_end_mark = []
-        while not self.disconnected:
-            data = task_log_f.read(4096)
-            if data:
-                data = data.replace(b'\n', b'\r\n')
-                self.send_json(
-                    {'message': data.decode(errors='ignore'), 'task': task_id}
-                )
-                if data.find(b'succeeded in') != -1:
-                    task_end_mark.append(1)
-                if data.find(bytes(task_id, 'utf8')) != -1:
-                    task_end_mark.append(1)
-            elif len(task_end_mark) == 2:
-                logger.debug('Task log end: {}'.format(task_id))
-                break
-            time.sleep(0.2)
-        task_log_f.close()
+    def replay_log_file(self, task_id):
+        log_path = get_celery_task_log_path(task_id)
+        if not os.path.exists(log_path):
+            return 0
+        offset = 0
+        try:
+            with open(log_path, 'rb') as f:
+                while True:
+                    data = f.read(4096)
+                    if not data:
+                        break
+                    offset += len(data)
+                    self.send_message(data)
+        except OSError as e:
+            logger.debug('Read task log error: {}'.format(e))
+        return offset
 
     def handle_task(self, task_id):
         logger.info("Task id: {}".format(task_id))
-        thread = threading.Thread(target=self.read_log_file, args=(task_id,))
-        thread.start()
+        self.leave_task()
+        relay = CeleryLogRelay.get_instance()
+        self.task_id = task_id
+        # 先加入 group 再回放文件, 回放期间产生的日志不会丢失
+        self.group_name = relay.watch(task_id)
+        async_to_sync(self.channel_layer.group_add)(self.group_name, self.channel_name)
+        self.send_json({'message': '\r\n'})
+        self.offset = self.replay_log_file(task_id)
+        if AsyncResult(task_id).ready():
+            logger.debug('Task log end: {}'.format(task_id))
+            self.leave_task()
 
-    def disconnect(self, close_code):
-        self.disconnected = True
-        self.close()
+    def leave_task(self):
+        if not self.group_name:
+            return
+        async_to_sync(self.channel_layer.group_discard)(self.group_name, self.channel_name)
+        CeleryLogRelay.get_instance().unwatch(self.task_id)
+        self.group_name = None
+
+    def task_start(self, event):
+        pass
 
+    def task_log(self, event):
+        msg = event['msg']
+        offset = event.get('offset')
+        if offset is not None:
+            if offset <= self.offset:
+                return
+            # 合并的多行日志, 前面一部分可能已经回放过了, 去掉重叠的字节
+            start = event.get('start')
+            if start is not None and start < self.offset:
+                msg = msg.encode()[self.offset - start:]
+            self.offset = offset
+        self.send_message(msg)
 
+    def task_end(self, event):
+        logger.debug('Task log end: {}'.format(self.task_id))
+        self.leave_task()
+
+    def disconnect(self, close_code):
+        self.leave_task()
+        self.close()
@@ -3,7 +3,7 @@
 from django.shortcuts import get_object_or_404
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
 from rest_framework_bulk import BulkModelViewSet
-from common.mixins import CommonApiMixin, RelationMixin
+from common.mixins import CommonApiMixin, RelationMixin, StreamingExportMixin
 from orgs.utils import current_org
 
 from ..utils import set_to_root_org
@@ -41,7 +41,7 @@ class OrgQuerySetMixin:
         return queryset
 
 
-class OrgModelViewSet(CommonApiMixin, OrgQuerySetMixin, ModelViewSet):
+class OrgModelViewSet(StreamingExportMixin, CommonApiMixin, OrgQuerySetMixin, ModelViewSet):
     pass
 
 
@@ -49,7 +49,7 @@ class OrgGenericViewSet(CommonApiMixin, OrgQuerySetMixin, GenericViewSet):
     pass
 
 
-class OrgBulkModelViewSet(CommonApiMixin, OrgQuerySetMixin, BulkModelViewSet):
+class OrgBulkModelViewSet(StreamingExportMixin, CommonApiMixin, OrgQuerySetMixin, BulkModelViewSet):
     def allow_bulk_destroy(self, qs, filtered):
         qs_count = qs.count()
         filtered_count = filtered.count()
@@ -23,6 +23,7 @@ logger = get_logger(__name__)
 __all__ = [
     'RefreshAssetPermissionCacheApi',
     'UserGrantedAssetSystemUsersApi',
+    'UserGrantedAssetsSystemUsersApi',
     'ValidateUserAssetPermissionApi',
     'GetUserAssetPermissionActionsApi',
     'UserAssetPermissionsCacheApi',
@@ -119,6 +120,42 @@ class UserGrantedAssetSystemUsersApi(UserAssetPermissionMixin, ListAPIView):
         return system_users
 
 
+class UserGrantedAssetsSystemUsersApi(UserAssetPermissionMixin, APIView):
+    """
+    批量获取多个资产授权的系统用户和动作, 终端可以一次校验一页资产
+    {"assets": [asset_id, ...]} => {asset_id: [system_user, ...]}
+    """
+    permission_classes = (IsOrgAdminOrAppUser,)
+    serializer_class = serializers.AssetSystemUserSerializer
+    only_fields = serializers.AssetSystemUserSerializer.Meta.only_fields
+
+    def post(self, request, *args, **kwargs):
+        query_serializer = serializers.AssetsSystemUsersQuerySerializer(data=request.data)
+        query_serializer.is_valid(raise_exception=True)
+        assets_id = query_serializer.validated_data['assets']
+
+        assets_system_users = self.util.get_assets_system_users_id_with_actions(assets_id)
+        system_users_id = set()
+        for system_users_actions in assets_system_users.values():
+            system_users_id.update(system_users_actions.keys())
+        system_users = SystemUser.objects.filter(id__in=system_users_id)\
+            .only(*self.only_fields) \
+            .order_by('priority')
+        system_users = list(system_users)
+
+        data = {}
+        for asset_id, system_users_actions in assets_system_users.items():
+            items = []
+            for system_user in system_users:
+                actions = system_users_actions.get(system_user.id)
+                if actions is None:
+                    continue
+                system_user.actions = actions
+                items.append(self.serializer_class(system_user).data)
+            data[str(asset_id)] = items
+        return Response(data)
+
+
 class UserAssetPermissionsCacheApi(UserAssetPermissionMixin, DestroyAPIView):
     permission_classes = (IsOrgAdmin,)
 
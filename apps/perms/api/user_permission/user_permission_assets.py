@@ -34,8 +34,8 @@ class UserGrantedAssetsApi(UserAssetPermissionMixin, ListAPIView):
         node = get_object_or_404(Node, pk=node_id)
         query_all = self.request.query_params.get("all", "0") in ["1", "true"]
         if query_all:
-            pattern = '^{0}$|^{0}:'.format(node.key)
-            queryset = queryset.filter(nodes__key__regex=pattern).distinct()
+            q = node.get_node_all_children_key_q(node.key, field='nodes__key')
+            queryset = queryset.filter(q).distinct()
         else:
             queryset = queryset.filter(nodes=node)
         return queryset
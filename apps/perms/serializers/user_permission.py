@@ -12,6 +12,7 @@ __all__ = [
     'NodeGrantedSerializer',
     'AssetGrantedSerializer',
     'ActionsSerializer', 'AssetSystemUserSerializer',
+    'AssetsSystemUsersQuerySerializer',
     'RemoteAppSystemUserSerializer',
     'DatabaseAppSystemUserSerializer',
     'K8sAppSystemUserSerializer',
@@ -103,3 +104,10 @@ class NodeGrantedSerializer(serializers.ModelSerializer):
 
 class ActionsSerializer(serializers.Serializer):
     actions = ActionsField(read_only=True)
+
+
+class AssetsSystemUsersQuerySerializer(serializers.Serializer):
+    assets = serializers.ListField(
+        child=serializers.UUIDField(), allow_empty=False, max_length=1000,
+        label=_('Assets')
+    )
@@ -1,22 +1,102 @@
 # -*- coding: utf-8 -*-
 #
-from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_delete
 from django.dispatch import receiver
 
 from common.utils import get_logger
 from common.decorator import on_transaction_commit
 from .models import AssetPermission, RemoteAppPermission
+from .hands import User
 from .utils.asset_permission import AssetPermissionUtil
 
 
 logger = get_logger(__file__)
 
 
-@receiver([post_save, post_delete], sender=AssetPermission)
+def expire_permission_users_tree_cache(permission):
+    users_id = permission.all_users.values_list('id', flat=True)
+    AssetPermissionUtil.expire_users_tree_cache(users_id)
+
+
+@receiver(post_save, sender=AssetPermission)
 @on_transaction_commit
-def on_permission_change(sender, action='', **kwargs):
+def on_permission_change(sender, instance=None, **kwargs):
     logger.debug('Asset permission changed, refresh user tree cache')
-    AssetPermissionUtil.expire_all_user_tree_cache()
+    expire_permission_users_tree_cache(instance)
+
+
+@receiver(pre_delete, sender=AssetPermission)
+def on_permission_pre_delete(sender, instance=None, **kwargs):
+    # 删除之后就查不到授权的用户了
+    instance._tree_users_id = list(instance.all_users.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=AssetPermission)
+def on_permission_delete(sender, instance=None, **kwargs):
+    logger.debug('Asset permission deleted, refresh user tree cache')
+    users_id = getattr(instance, '_tree_users_id', [])
+    AssetPermissionUtil.expire_users_tree_cache(users_id)
+
+
+@receiver(m2m_changed, sender=AssetPermission.users.through)
+def on_permission_users_change_expire_tree(sender, instance=None, action='', model=None,
+                                           pk_set=None, reverse=False, **kwargs):
+    if action == 'pre_clear':
+        if reverse:
+            instance._tree_users_id = [instance.id]
+        else:
+            instance._tree_users_id = list(instance.users.values_list('id', flat=True))
+        return
+    if action not in ['post_add', 'post_remove', 'post_clear']:
+        return
+    if action == 'post_clear':
+        users_id = getattr(instance, '_tree_users_id', [])
+    elif reverse:
+        users_id = [instance.id]
+    else:
+        users_id = pk_set
+    AssetPermissionUtil.expire_users_tree_cache(users_id)
+
+
+@receiver(m2m_changed, sender=AssetPermission.user_groups.through)
+def on_permission_user_groups_change_expire_tree(sender, instance=None, action='', model=None,
+                                                 pk_set=None, reverse=False, **kwargs):
+    if action == 'pre_clear':
+        if reverse:
+            groups_id = [instance.id]
+        else:
+            groups_id = instance.user_groups.values_list('id', flat=True)
+        instance._tree_users_id = list(
+            User.objects.filter(groups__id__in=groups_id).values_list('id', flat=True)
+        )
+        return
+    if action not in ['post_add', 'post_remove', 'post_clear']:
+        return
+    if action == 'post_clear':
+        users_id = getattr(instance, '_tree_users_id', [])
+    elif reverse:
+        users_id = instance.users.values_list('id', flat=True)
+    else:
+        users_id = User.objects.filter(groups__id__in=pk_set).values_list('id', flat=True)
+    AssetPermissionUtil.expire_users_tree_cache(users_id)
+
+
+@receiver(m2m_changed, sender=AssetPermission.nodes.through)
+@receiver(m2m_changed, sender=AssetPermission.assets.through)
+@receiver(m2m_changed, sender=AssetPermission.system_users.through)
+def on_permission_resources_change_expire_tree(sender, instance=None, action='', model=None,
+                                               pk_set=None, reverse=False, **kwargs):
+    if action not in ['post_add', 'post_remove', 'post_clear']:
+        return
+    if not reverse:
+        expire_permission_users_tree_cache(instance)
+        return
+    if action == 'post_clear':
+        # 反向清空拿不到授权规则，只能全部失效
+        AssetPermissionUtil.expire_all_user_tree_cache()
+        return
+    for permission in AssetPermission.objects.filter(pk__in=pk_set):
+        expire_permission_users_tree_cache(permission)
 
 # Todo: 检查授权规则到期，从而修改授权规则
 
@@ -1,10 +1,121 @@
 # ~*~ coding: utf-8 ~*~
 from __future__ import absolute_import, unicode_literals
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from celery import shared_task
-from common.utils import get_logger, encrypt_password
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from common.utils import get_logger
+from orgs.models import Organization
+from orgs.utils import tmp_to_org, tmp_to_root_org
 
 logger = get_logger(__file__)
 
 
+def get_recently_active_users_id(days, limit):
+    """
+    根据最近的会话和登录日志，返回活跃用户，按活跃程度排序
+    """
+    from terminal.models import Session
+    from audits.models import UserLoginLog
+    from users.models import User
+
+    date_from = timezone.now() - timezone.timedelta(days=days)
+    scores = Counter()
+    with tmp_to_root_org():
+        sessions = Session.objects.filter(date_start__gte=date_from) \
+            .exclude(user_id='') \
+            .values('user_id').annotate(count=Count('id'))
+        for item in sessions:
+            scores[item['user_id']] += item['count']
+
+    logins = UserLoginLog.objects.filter(datetime__gte=date_from, status=True) \
+        .values('username').annotate(count=Count('id'))
+    logins_map = {item['username']: item['count'] for item in logins}
+    users = User.objects.filter(username__in=logins_map.keys()) \
+        .values_list('id', 'username')
+    for user_id, username in users:
+        scores[str(user_id)] += logins_map[username]
+    return [user_id for user_id, __ in scores.most_common(limit)]
+
+
+def get_user_granted_orgs_id(user):
+    from .models import AssetPermission
+    with tmp_to_root_org():
+        q = Q(users=user) | Q(user_groups__in=user.groups.all())
+        orgs_id = AssetPermission.objects.valid().filter(q) \
+            .values_list('org_id', flat=True).distinct()
+        return set(orgs_id)
+
+
+def warm_up_user_tree_cache(user, org_id):
+    # 组织的节点树更新时是复制后整体替换的, 多个线程同时读同一棵树是安全的
+    from .utils import AssetPermissionUtil
+    try:
+        with tmp_to_org(Organization.get_instance(org_id)):
+            util = AssetPermissionUtil(user, cache_policy='1')
+            if util.get_user_tree_from_cache() is not None:
+                return False
+            util.get_user_tree()
+            return True
+    finally:
+        close_old_connections()
+
+
+@shared_task
+def warm_up_users_tree_cache(users_id=None):
+    """
+    预先构建活跃用户的授权树缓存，避免授权变化后用户第一次访问时卡顿
+    没有指定用户时, 全局或组织的授权变化预热所有活跃用户,
+    只有部分用户的授权变化时, 只预热其中活跃的用户
+    """
+    from users.models import User
+    from .utils import AssetPermissionUtil
+
+    if not settings.ASSETS_PERM_CACHE_ENABLE:
+        return
+    if users_id is None:
+        warm_up_all, changed_users_id = AssetPermissionUtil.pop_warm_up_scope()
+        users_id = get_recently_active_users_id(
+            settings.ASSETS_PERM_CACHE_WARM_UP_DAYS,
+            settings.ASSETS_PERM_CACHE_WARM_UP_MAX_USERS,
+        )
+        if not warm_up_all:
+            users_id = [i for i in users_id if i in changed_users_id]
+    users = User.objects.filter(id__in=users_id, is_active=True)
+    users_map = {str(u.id): u for u in users}
+    jobs = []
+    for user_id in users_id:
+        user = users_map.get(str(user_id))
+        if not user:
+            continue
+        orgs_id = get_user_granted_orgs_id(user)
+        if not orgs_id:
+            continue
+        # ROOT 组织下看到的是所有组织的授权
+        orgs_id.add(Organization.ROOT_ID)
+        jobs.extend((user, org_id) for org_id in orgs_id)
 
+    total = len(jobs)
+    print("Warm up user tree cache: {} users, {} trees".format(len(users_map), total))
+    built = finished = 0
+    workers = settings.ASSETS_PERM_CACHE_WARM_UP_WORKERS
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(warm_up_user_tree_cache, user, org_id)
+            for user, org_id in jobs
+        ]
+        for future in as_completed(futures):
+            finished += 1
+            try:
+                built += int(future.result())
+            except Exception as e:
+                logger.error("Warm up user tree cache error: {}".format(e))
+            if finished % 100 == 0 or finished == total:
+                print("Progress: {}/{}, built: {}".format(finished, total, built))
+    return {'total': total, 'built': built}
@@ -1,3 +1,79 @@
-from django.test import TestCase
+import uuid
+import struct
+
+from django.test import TestCase, SimpleTestCase, override_settings
 
 from django.contrib.sessions.backends import file, db, cache
+
+from assets.utils import TreeService, CompactTreeService
+from .utils.asset_permission import UserGrantedTree
+
+
+def build_full_tree(cls, nodes):
+    tree = cls()
+    tree.create_node(tag='', identifier='', data={"assets": set(), "all_assets": None})
+    for key, assets in nodes:
+        parent = ':'.join(key.split(':')[:-1])
+        tree.safe_create_node(
+            tag=key, identifier=key, parent=parent,
+            data={"assets": set(assets), "all_assets": None}
+        )
+    return tree
+
+
+@override_settings(PERM_SINGLE_ASSET_TO_UNGROUP_NODE=False)
+class UserGrantedTreeCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.assets = [uuid.uuid4() for _ in range(6)]
+        self.nodes = [
+            ('1', []), ('1:1', self.assets[:2]), ('1:1:1', self.assets[2:3]),
+            ('1:2', self.assets[3:4]), ('1:2:1', self.assets[4:5]), ('1:3', []),
+        ]
+
+    def read_tree(self, user_tree):
+        nodes = [n.identifier for n in user_tree.all_nodes()]
+        for key in nodes:
+            user_tree.children(key)
+            user_tree.all_assets(key)
+        return nodes
+
+    def check_deleted_granted_node(self, cls):
+        full_tree = build_full_tree(cls, self.nodes)
+        user_tree = UserGrantedTree(full_tree=full_tree)
+        user_tree.build(['1:1', '1:2:1'], {'1:3': {self.assets[5]}})
+        data = user_tree.dumps()
+
+        # 删除授权的节点和单独授权资产所在的节点, 用户树的缓存没有失效
+        full_tree = build_full_tree(cls, self.nodes)
+        full_tree.remove_node('1:2')
+        full_tree.remove_node('1:3')
+        user_tree = UserGrantedTree.loads(data, full_tree=full_tree)
+
+        nodes = self.read_tree(user_tree)
+        self.assertEqual(set(nodes), {'', '1', '1:1', '1:1:1'})
+        self.assertEqual(set(user_tree.all_assets('')), set(self.assets[:3]))
+        self.assertEqual([n.identifier for n in user_tree.children('1')], ['1:1'])
+        self.assertFalse(user_tree.contains('1:2:1'))
+
+    def test_deleted_granted_node(self):
+        self.check_deleted_granted_node(TreeService)
+
+    def test_compact_deleted_granted_node(self):
+        self.check_deleted_granted_node(CompactTreeService)
+
+    def test_old_cache_version_ignored(self):
+        full_tree = build_full_tree(TreeService, self.nodes)
+        user_tree = UserGrantedTree(full_tree=full_tree)
+        user_tree.build(['1:1'], {})
+        data = user_tree.dumps()
+        self.assertIsNotNone(UserGrantedTree.loads(data, full_tree=full_tree))
+
+        header_size = struct.calcsize(UserGrantedTree.cache_header_format)
+        magic, version, compressed = struct.unpack(
+            UserGrantedTree.cache_header_format, data[:header_size]
+        )
+        old_header = struct.pack(
+            UserGrantedTree.cache_header_format, magic, version - 1, compressed
+        )
+        data = old_header + data[header_size:]
+        self.assertIsNone(UserGrantedTree.loads(data, full_tree=full_tree))
@@ -51,6 +51,8 @@ user_permission_urlpatterns = [
     # Asset System users
     path('<uuid:pk>/assets/<uuid:asset_id>/system-users/', api.UserGrantedAssetSystemUsersApi.as_view(), name='user-asset-system-users'),
     path('assets/<uuid:asset_id>/system-users/', api.UserGrantedAssetSystemUsersApi.as_view(), name='my-asset-system-users'),
+    path('<uuid:pk>/assets/system-users/', api.UserGrantedAssetsSystemUsersApi.as_view(), name='user-assets-system-users'),
+    path('assets/system-users/', api.UserGrantedAssetsSystemUsersApi.as_view(), name='my-assets-system-users'),
 
     # Expire user permission cache
     path('<uuid:pk>/asset-permissions/cache/', api.UserAssetPermissionsCacheApi.as_view(),
@@ -1,17 +1,22 @@
 # coding: utf-8
-import time
-import pickle
+import json
+import uuid
+import zlib
+import struct
+from copy import copy
 from collections import defaultdict
 from functools import reduce
 
 from django.core.cache import cache
 from django.db.models import Q
 from django.conf import settings
+from django_redis import get_redis_connection
 
 from orgs.utils import current_org
 from common.utils import get_logger, timeit, lazyproperty
 from common.tree import TreeNode
-from assets.utils import TreeService
+from assets.utils import asset_id_to_bytes
+from treelib.node import Node as TreelibNode
 from ..models import AssetPermission
 from ..hands import Node, Asset, SystemUser, User, FavoriteAsset
 
@@ -19,7 +24,7 @@ logger = get_logger(__file__)
 
 
 __all__ = [
-    'ParserNode', 'AssetPermissionUtil',
+    'ParserNode', 'AssetPermissionUtil', 'UserGrantedTree',
 ]
 
 
@@ -58,7 +63,12 @@ def get_system_user_permissions(system_user):
 
 
 class AssetPermissionUtilCacheMixin:
-    user_tree_cache_key = 'USER_PERM_TREE_{}_{}_{}'
+    user_tree_cache_key = 'USER_PERM_TREE_V2_{}_{}_{}'
+    user_tree_version_cache_key = 'USER_PERM_TREE_VERSION_{}'
+    user_tree_warm_up_cache_key = 'USER_PERM_TREE_WARM_UP_SCHEDULED'
+    # 等待预热的范围: 所有活跃用户, 或者授权变化了的用户
+    user_tree_warm_up_all_cache_key = 'USER_PERM_TREE_WARM_UP_ALL'
+    user_tree_warm_up_users_key = 'USER_PERM_TREE_WARM_UP_USERS'
     user_tree_cache_ttl = settings.ASSETS_PERM_CACHE_TIME
     user_tree_cache_enable = settings.ASSETS_PERM_CACHE_ENABLE
     user_tree_map = {}
@@ -77,40 +87,100 @@ class AssetPermissionUtilCacheMixin:
         key = self.user_tree_cache_key.format(
             org_id, self.obj_id, self._filter_id
         )
-        return key
+        version = self.get_user_tree_cache_version(org_id, self.obj_id)
+        return '{}_{}'.format(key, version)
+
+    @classmethod
+    def get_version_cache_key(cls, scope):
+        return cls.user_tree_version_cache_key.format(scope)
+
+    @classmethod
+    def get_user_tree_cache_version(cls, org_id, user_id):
+        """
+        缓存 key 中带上 全局、组织、用户 三个版本号,
+        失效时只需要修改版本号, 旧的缓存自然过期, 不用 scan 整个 redis
+        """
+        scopes = ['ALL', 'ORG_{}'.format(org_id), 'USER_{}'.format(user_id)]
+        keys = [cls.get_version_cache_key(scope) for scope in scopes]
+        versions = cache.get_many(keys)
+        return '.'.join(str(versions.get(k, 0)) for k in keys)
+
+    @classmethod
+    def bump_user_tree_cache_version(cls, scopes, users_id=None):
+        """
+        :param users_id: 只失效了这些用户的缓存时, 只预热这些用户, 否则预热所有活跃用户
+        """
+        # 版本号的过期时间不能短于树缓存的过期时间
+        version = uuid.uuid4().hex[:8]
+        data = {cls.get_version_cache_key(scope): version for scope in scopes}
+        cache.set_many(data, cls.user_tree_cache_ttl)
+        cls.schedule_warm_up(users_id)
+
+    @classmethod
+    def schedule_warm_up(cls, users_id=None):
+        # 授权经常是批量变化的，延迟一段时间合并成一次预热
+        if not cls.user_tree_cache_enable:
+            return
+        delay = settings.ASSETS_PERM_CACHE_WARM_UP_DELAY
+        if users_id is None:
+            cache.set(cls.user_tree_warm_up_all_cache_key, 1, delay * 10)
+        else:
+            redis = get_redis_connection('default')
+            pipeline = redis.pipeline(transaction=False)
+            pipeline.sadd(cls.user_tree_warm_up_users_key, *[str(i) for i in users_id])
+            pipeline.expire(cls.user_tree_warm_up_users_key, delay * 10)
+            pipeline.execute()
+        if not cache.add(cls.user_tree_warm_up_cache_key, 1, delay):
+            return
+        from ..tasks import warm_up_users_tree_cache
+        warm_up_users_tree_cache.apply_async(countdown=delay)
+
+    @classmethod
+    def pop_warm_up_scope(cls):
+        """
+        取出等待预热的范围, 返回 (是否预热所有活跃用户, 授权变化了的用户)
+        """
+        warm_up_all = bool(cache.get(cls.user_tree_warm_up_all_cache_key))
+        cache.delete(cls.user_tree_warm_up_all_cache_key)
+        redis = get_redis_connection('default')
+        pipeline = redis.pipeline()
+        pipeline.smembers(cls.user_tree_warm_up_users_key)
+        pipeline.delete(cls.user_tree_warm_up_users_key)
+        users_id, __ = pipeline.execute()
+        return warm_up_all, {i.decode() for i in users_id}
 
     def expire_user_tree_cache(self):
         cache.delete(self.cache_key)
 
     @classmethod
     def expire_all_user_tree_cache(cls):
-        expire_cache_key = "USER_TREE_EXPIRED_AT"
-        latest_expired = cache.get(expire_cache_key, 0)
-        now = time.time()
-        if now - latest_expired < 60:
-            return
-        key = cls.user_tree_cache_key.format('*', '1', '1')
-        key = key.replace('_1', '')
-        cache.delete_pattern(key)
-        cache.set(expire_cache_key, now)
+        cls.bump_user_tree_cache_version(['ALL'])
 
     @classmethod
     def expire_org_tree_cache(cls, org_id=None):
         if org_id is None:
             org_id = current_org.org_id()
-        key = cls.user_tree_cache_key.format(org_id, '*', '1')
-        key = key.replace('_1', '')
-        cache.delete_pattern(key)
+        cls.bump_user_tree_cache_version(['ORG_{}'.format(org_id)])
+
+    @classmethod
+    def expire_users_tree_cache(cls, users_id):
+        users_id = set(users_id)
+        if not users_id:
+            return
+        logger.debug("Expire {} users tree cache".format(len(users_id)))
+        scopes = ['USER_{}'.format(user_id) for user_id in users_id]
+        cls.bump_user_tree_cache_version(scopes, users_id=users_id)
 
     def set_user_tree_to_cache(self, user_tree):
-        data = pickle.dumps(user_tree)
+        data = user_tree.dumps()
         cache.set(self.cache_key, data, self.user_tree_cache_ttl)
 
     def get_user_tree_from_cache(self):
         data = cache.get(self.cache_key)
         if not data:
             return None
-        user_tree = pickle.loads(data)
+        # 旧格式或者损坏的缓存返回 None, 会重新构建
+        user_tree = UserGrantedTree.loads(data)
         return user_tree
 
     @timeit
@@ -133,6 +203,300 @@ class AssetPermissionUtilCacheMixin:
         self.set_user_tree_to_cache(user_tree)
 
 
+class UserGrantedTree:
+    """
+    用户授权的节点树, 是完整节点树上的一个过滤视图, 不再从完整树上复制子树
+    - 直接授权的节点: 节点及其子孙节点、资产都直接使用完整树的
+    - 其他可见节点: 授权节点的祖先节点、单独授权资产所在的节点, 只记录父子关系和单独授权的资产
+    - 额外节点: 未分组、收藏夹, 不在完整树上
+    完整树按组织缓存并增量更新, 所以这里只需要保存授权相关的少量数据
+    """
+    root = ''
+    cache_magic = b'JUGT'
+    # 2: 加载时去掉完整树上已经不存在的节点, 之前写入的缓存不再使用
+    cache_version = 2
+    cache_header_format = '>4sBB'
+    cache_compress_min_size = 1024
+
+    def __init__(self, full_tree=None):
+        self._full_tree = full_tree
+        self.granted_keys = set()
+        self.nodes_assets = {}
+        self.nodes_children = defaultdict(list)
+        self.extra_nodes = {}
+        self._all_assets_cache = {}
+
+    def dumps(self):
+        """
+        导出成紧凑的格式放到缓存中, 不使用 pickle:
+        头部 (魔数, 版本, 是否压缩) + json 描述的节点结构 + 16 字节一个的资产 id
+        节点的资产用资产 id 数组中的 [起始, 结束) 下标表示
+        """
+        assets = []
+
+        def add_assets(_assets):
+            start = len(assets)
+            assets.extend(_assets)
+            return [start, len(assets)]
+
+        meta = {
+            'granted_keys': sorted(self.granted_keys),
+            'nodes_children': self.nodes_children,
+            'nodes_assets': {
+                key: add_assets(_assets)
+                for key, _assets in self.nodes_assets.items()
+            },
+            'extra_nodes': {
+                key: [str(node['tag']), *add_assets(node['assets'])]
+                for key, node in self.extra_nodes.items()
+            },
+        }
+        meta = json.dumps(meta, separators=(',', ':')).encode()
+        body = struct.pack('>I', len(meta)) + meta + \
+            b''.join(asset_id_to_bytes(i) for i in assets)
+        compressed = len(body) > self.cache_compress_min_size
+        if compressed:
+            body = zlib.compress(body)
+        header = struct.pack(
+            self.cache_header_format, self.cache_magic,
+            self.cache_version, int(compressed)
+        )
+        return header + body
+
+    @classmethod
+    def loads(cls, data, full_tree=None):
+        header_size = struct.calcsize(cls.cache_header_format)
+        if not isinstance(data, bytes) or len(data) < header_size:
+            return None
+        magic, version, compressed = struct.unpack(
+            cls.cache_header_format, data[:header_size]
+        )
+        if magic != cls.cache_magic or version != cls.cache_version:
+            return None
+        try:
+            body = data[header_size:]
+            if compressed:
+                body = zlib.decompress(body)
+            meta_size, = struct.unpack('>I', body[:4])
+            meta = json.loads(body[4:4 + meta_size].decode())
+            raw_assets = body[4 + meta_size:]
+        except (zlib.error, struct.error, ValueError) as e:
+            logger.error("Load user granted tree error: {}".format(e))
+            return None
+
+        assets = [
+            uuid.UUID(bytes=raw_assets[i:i + 16])
+            for i in range(0, len(raw_assets), 16)
+        ]
+        tree = cls(full_tree=full_tree)
+        tree.granted_keys = set(meta['granted_keys'])
+        tree.nodes_children.update(meta['nodes_children'])
+        tree.nodes_assets = {
+            key: set(assets[start:end])
+            for key, (start, end) in meta['nodes_assets'].items()
+        }
+        # 额外节点的名称需要跟随当前语言翻译
+        extra_tags = {
+            Node.ungrouped_key: Node.ungrouped_value,
+            Node.favorite_key: Node.favorite_value,
+        }
+        tree.extra_nodes = {
+            key: {'tag': extra_tags.get(key, tag), 'assets': set(assets[start:end])}
+            for key, (tag, start, end) in meta['extra_nodes'].items()
+        }
+        tree.prune()
+        return tree
+
+    def prune(self):
+        """
+        去掉完整树上已经不存在的节点
+        节点删除或移动时不会失效用户树的缓存, 缓存中可能还有旧的节点 key
+        """
+        full_tree = self.full_tree
+
+        def exists(key):
+            return key in self.extra_nodes or full_tree.contains(key)
+
+        self.granted_keys = {k for k in self.granted_keys if full_tree.contains(k)}
+        self.nodes_assets = {
+            k: assets for k, assets in self.nodes_assets.items() if full_tree.contains(k)
+        }
+        nodes_children = defaultdict(list)
+        for parent_key, children in self.nodes_children.items():
+            if parent_key != self.root and not full_tree.contains(parent_key):
+                continue
+            children = [k for k in children if exists(k)]
+            if children:
+                nodes_children[parent_key] = children
+        self.nodes_children = nodes_children
+
+    @property
+    def full_tree(self):
+        # 组织的树更新时是整体替换的, 这里持有的树不会再变化
+        if self._full_tree is None:
+            self._full_tree = Node.tree()
+        return self._full_tree
+
+    @staticmethod
+    def detach_node(node):
+        """
+        返回节点的副本, 不带 data, 调用者修改节点不会影响共用的完整树
+        """
+        if node is None:
+            return None
+        new_node = copy(node)
+        new_node.fpointer = list(node.fpointer)
+        new_node.data = None
+        return new_node
+
+    def build(self, granted_keys, single_assets_map, favorite_assets_id=None):
+        full_tree = self.full_tree
+        self.granted_keys = {k for k in granted_keys if full_tree.contains(k)}
+
+        # 节点已在授权的子树中, 资产已经包含了
+        single_assets_map = {
+            key: assets for key, assets in single_assets_map.items()
+            if not self.is_granted(key)
+        }
+        if settings.PERM_SINGLE_ASSET_TO_UNGROUP_NODE:
+            if single_assets_map:
+                assets = set()
+                for _assets in single_assets_map.values():
+                    assets.update(_assets)
+                self.add_extra_node(Node.ungrouped_key, Node.ungrouped_value, assets)
+        else:
+            self.nodes_assets = {
+                key: set(assets) for key, assets in single_assets_map.items()
+                if full_tree.contains(key)
+            }
+
+        visible_keys = set(self.granted_keys) | set(self.nodes_assets.keys())
+        for key in list(visible_keys):
+            ancestors = Node.get_node_ancestor_keys(key, with_self=False)
+            visible_keys.update(k for k in ancestors if full_tree.contains(k))
+
+        for key in sorted(visible_keys, key=lambda x: (len(x), x)):
+            parent = full_tree.parent(key)
+            parent_key = parent.identifier if parent else self.root
+            self.nodes_children[parent_key].append(key)
+
+        if favorite_assets_id is not None:
+            valid_assets = self.all_valid_assets(self.root)
+            assets = set(favorite_assets_id) & valid_assets
+            self.add_extra_node(Node.favorite_key, Node.favorite_value, assets)
+
+    def add_extra_node(self, key, value, assets):
+        self.extra_nodes[key] = {'tag': value, 'assets': set(assets)}
+        self.nodes_children[self.root].append(key)
+
+    def is_granted(self, key):
+        if key in self.extra_nodes:
+            return False
+        ancestor_keys = Node.get_node_ancestor_keys(key, with_self=True)
+        return not self.granted_keys.isdisjoint(ancestor_keys)
+
+    def contains(self, nid):
+        if nid == self.root or nid in self.extra_nodes:
+            return True
+        if self.is_granted(nid):
+            return self.full_tree.contains(nid)
+        parent_key = Node.compute_parent_key(nid)
+        return nid in self.nodes_children.get(parent_key, ()) or \
+            nid in self.nodes_children.get(self.root, ())
+
+    def get_node(self, nid, deep=False):
+        if nid in self.extra_nodes:
+            node = TreelibNode(tag=self.extra_nodes[nid]['tag'], identifier=nid)
+            node.bpointer = self.root
+            return node
+        if not self.contains(nid):
+            return None
+        return self.detach_node(self.full_tree.get_node(nid))
+
+    def root_node(self):
+        return self.detach_node(self.full_tree.root_node())
+
+    def children(self, nid):
+        if nid in self.extra_nodes:
+            return []
+        if nid != self.root and self.is_granted(nid):
+            return [self.detach_node(n) for n in self.full_tree.children(nid)]
+        nodes = (self.get_node(k) for k in self.nodes_children.get(nid, ()))
+        return [n for n in nodes if n is not None]
+
+    def all_nodes_itr(self):
+        yield self.root_node()
+        for key in self.extra_nodes:
+            yield self.get_node(key)
+        for children in self.nodes_children.values():
+            for key in children:
+                if key in self.extra_nodes or key in self.granted_keys:
+                    continue
+                node = self.get_node(key)
+                if node is not None:
+                    yield node
+        for key in self.granted_keys:
+            for node in self.full_tree.all_children(key, with_self=True):
+                yield self.detach_node(node)
+
+    def all_nodes(self):
+        return list(self.all_nodes_itr())
+
+    def assets(self, nid):
+        if nid in self.extra_nodes:
+            return self.extra_nodes[nid]['assets']
+        if nid != self.root and self.is_granted(nid):
+            return self.full_tree.assets(nid)
+        return self.nodes_assets.get(nid, set())
+
+    def valid_assets(self, nid):
+        return set(self.assets(nid)) - set(self.invalid_assets)
+
+    def all_assets(self, nid):
+        if nid in self.extra_nodes:
+            return self.extra_nodes[nid]['assets']
+        if nid != self.root and self.is_granted(nid):
+            return self.full_tree.all_assets(nid)
+        all_assets = self._all_assets_cache.get(nid)
+        if all_assets is not None:
+            return all_assets
+
+        # 子孙节点中授权的节点，资产用完整树的，再加上单独授权的资产
+        if nid == self.root:
+            granted_keys = self.granted_keys
+            nodes_assets = self.nodes_assets.values()
+        else:
+            prefix = nid + ':'
+            granted_keys = [k for k in self.granted_keys if k.startswith(prefix)]
+            nodes_assets = [
+                assets for k, assets in self.nodes_assets.items()
+                if k == nid or k.startswith(prefix)
+            ]
+        all_assets = set()
+        for key in granted_keys:
+            all_assets.update(self.full_tree.all_assets(key))
+        for assets in nodes_assets:
+            all_assets.update(assets)
+        if nid == self.root:
+            for node in self.extra_nodes.values():
+                all_assets.update(node['assets'])
+        self._all_assets_cache[nid] = all_assets
+        return all_assets
+
+    @property
+    def invalid_assets(self):
+        return self.full_tree.invalid_assets
+
+    def all_valid_assets(self, nid):
+        return set(self.all_assets(nid)) - set(self.invalid_assets)
+
+    def assets_amount(self, nid):
+        return len(self.all_assets(nid))
+
+    def valid_assets_amount(self, nid):
+        return len(self.all_valid_assets(nid))
+
+
 class AssetPermissionUtil(AssetPermissionUtilCacheMixin):
     get_permissions_map = {
         "User": get_user_permissions,
@@ -211,119 +575,31 @@ class AssetPermissionUtil(AssetPermissionUtilCacheMixin):
         return Node.objects.filter(id__in=nodes_ids)
 
     @timeit
-    def add_direct_nodes_to_user_tree(self, user_tree):
-        """
-        将授权规则的节点放到用户树上, 从full tree中粘贴子树
-        """
-        nodes_direct_keys = self.permissions \
+    def get_granted_nodes_keys(self):
+        nodes_keys = self.permissions \
             .exclude(nodes__isnull=True) \
             .values_list('nodes__key', flat=True) \
             .distinct()
-        nodes_direct_keys = list(nodes_direct_keys)
-        # 排序，保证从上层节点开始加
-        nodes_direct_keys.sort(key=lambda x: len(x))
-        for key in nodes_direct_keys:
-            # 如果树上已经有这个节点，代表子树已经存在
-            if user_tree.contains(key):
-                continue
-            # 找到这个节点的父节点，如果父节点不在树上，则挂到ROOT上
-            parent = self.full_tree.parent(key)
-            if not user_tree.contains(parent.identifier):
-                parent = user_tree.root_node()
-            subtree = self.full_tree.subtree(key)
-            user_tree.paste(parent.identifier, subtree, deep=True)
-
-        for node in user_tree.all_nodes_itr():
-            assets = list(self.full_tree.assets(node.identifier))
-            user_tree.set_assets(node.identifier, assets)
+        return Node.clean_children_keys(set(nodes_keys))
 
     @timeit
-    def add_single_assets_node_to_user_tree(self, user_tree):
+    def get_single_assets_nodes_map(self):
         """
-        将单独授权的资产放到树上，如果设置了单独资产到 未分组中，则放到未分组中
-        如果没有，则查询资产属于的资产组，放到树上
+        单独授权的资产, {node_key: {asset_id, }}
         """
-        # 添加单独授权资产的节点
         nodes_single_assets = defaultdict(set)
         queryset = self.permissions.exclude(assets__isnull=True) \
             .values_list('assets', 'assets__nodes__key') \
             .distinct()
-
-        for item in queryset:
-            nodes_single_assets[item[1]].add(item[0])
+        for asset_id, key in queryset:
+            nodes_single_assets[key].add(asset_id)
         nodes_single_assets.pop(None, None)
+        return nodes_single_assets
 
-        for key in tuple(nodes_single_assets.keys()):
-            if user_tree.contains(key):
-                nodes_single_assets.pop(key)
-
-        if not nodes_single_assets:
-            return
-
-        # 如果要设置到ungroup中
-        if settings.PERM_SINGLE_ASSET_TO_UNGROUP_NODE:
-            node_key = Node.ungrouped_key
-            node_value = Node.ungrouped_value
-            user_tree.create_node(
-                identifier=node_key, tag=node_value,
-                parent=user_tree.root,
-            )
-            assets = set()
-            for _assets in nodes_single_assets.values():
-                assets.update(set(_assets))
-            user_tree.set_assets(node_key, assets)
-            return
-
-        # 获取单独授权资产，并没有在授权的节点上
-        for key, assets in nodes_single_assets.items():
-            if not self.full_tree.contains(key):
-                continue
-            node = self.full_tree.get_node(key, deep=True)
-            parent_id = self.full_tree.parent(key).identifier
-            parent = user_tree.get_node(parent_id)
-            if not parent:
-                parent = user_tree.root_node()
-            user_tree.add_node(node, parent)
-            user_tree.set_assets(node.identifier, assets)
-
-    @timeit
-    def parse_user_tree_to_full_tree(self, user_tree):
-        """
-        经过前面两个动作，用户授权的节点已放到树上，但是树不是完整的，
-        这里要将树构造成一个完整的树
-        """
-        # 开始修正user_tree，保证父节点都在树上
-        root_children = user_tree.children('')
-        for child in root_children:
-            # print("child: {}".format(child.identifier))
-            if child.identifier.isdigit():
-                continue
-            if child.identifier.startswith('-'):
-                continue
-            ancestors = self.full_tree.ancestors(
-                child.identifier, with_self=False, deep=True,
-            )
-            # print("Get ancestors: {}".format(len(ancestors)))
-            if not ancestors:
-                continue
-            user_tree.safe_add_ancestors(child, ancestors)
-
-    def add_favorite_node_if_need(self, user_tree):
+    def get_favorite_assets_id(self):
         if not isinstance(self.object, User):
-            return
-        node_key = Node.favorite_key
-        node_value = Node.favorite_value
-        user_tree.create_node(
-            identifier=node_key, tag=node_value,
-            parent=user_tree.root,
-        )
-        node = user_tree.get_node(node_key)
-        assets_id = FavoriteAsset.get_user_favorite_assets_id(self.object)
-        all_valid_assets = user_tree.all_valid_assets(user_tree.root)
-        valid_assets_id = set(assets_id) & all_valid_assets
-        user_tree.set_assets(node_key, valid_assets_id)
-        # 必须设置这个，否则看不到个数
-        node.data['all_assets'] = None
+            return None
+        return FavoriteAsset.get_user_favorite_assets_id(self.object)
 
     def set_user_tree_to_local(self, user_tree):
         self._user_tree = user_tree
@@ -339,53 +615,73 @@ class AssetPermissionUtil(AssetPermissionUtilCacheMixin):
         user_tree = self.get_user_tree_from_cache_if_need()
         if user_tree:
             return user_tree
-        user_tree = TreeService()
-        full_tree_root = self.full_tree.root_node()
-        user_tree.create_node(
-            tag=full_tree_root.tag,
-            identifier=full_tree_root.identifier
+        user_tree = UserGrantedTree(full_tree=self.full_tree)
+        user_tree.build(
+            self.get_granted_nodes_keys(),
+            self.get_single_assets_nodes_map(),
+            favorite_assets_id=self.get_favorite_assets_id(),
         )
-        self.add_direct_nodes_to_user_tree(user_tree)
-        self.add_single_assets_node_to_user_tree(user_tree)
-        self.parse_user_tree_to_full_tree(user_tree)
-        self.add_favorite_node_if_need(user_tree)
         self.set_user_tree_to_cache_if_need(user_tree)
         self.set_user_tree_to_local(user_tree)
-        # print(user_tree)
         return user_tree
 
-    # Todo: 是否可以获取多个资产的系统用户
     def get_asset_system_users_id_with_actions(self, asset):
-        nodes = asset.get_nodes()
-        nodes_keys_related = set()
-        for node in nodes:
-            ancestor_keys = node.get_ancestor_keys(with_self=True)
-            nodes_keys_related.update(set(ancestor_keys))
-        kwargs = {"assets": asset}
+        assets_system_users = self.get_assets_system_users_id_with_actions([asset])
+        return assets_system_users.get(asset.id, defaultdict(int))
 
+    def get_assets_system_users_id_with_actions(self, assets):
+        """
+        批量获取多个资产授权的系统用户和动作, 查询数量固定, 和资产数量无关
+        :return: {asset_id: {system_user_id: actions}}
+        """
+        assets_id = {asset.id if isinstance(asset, Asset) else asset for asset in assets}
+        if not assets_id:
+            return {}
+        queryset = Asset.objects.filter(id__in=assets_id).only('id', 'protocols')
+        assets_protocols = {
+            asset.id: asset.protocols_as_dict.keys() for asset in queryset
+        }
+        assets_nodes_keys = defaultdict(set)
+        nodes_keys_related = set()
+        assets_nodes = Asset.nodes.through.objects.filter(asset_id__in=assets_id) \
+            .values_list('asset_id', 'node__key')
+        for asset_id, key in assets_nodes:
+            ancestor_keys = Node.get_node_ancestor_keys(key, with_self=True)
+            assets_nodes_keys[asset_id].update(ancestor_keys)
+            nodes_keys_related.update(ancestor_keys)
+        # 和 asset.get_nodes() 一致, 没有节点的资产属于组织的根节点
+        assets_without_nodes = set(assets_protocols) - set(assets_nodes_keys)
+        if assets_without_nodes:
+            root_key = Node.org_root().key
+            for asset_id in assets_without_nodes:
+                assets_nodes_keys[asset_id].add(root_key)
+            nodes_keys_related.add(root_key)
+
+        # 授权规则中, 资产/节点 -> [(系统用户, 协议, 动作)]
+        fields = ('system_users', 'system_users__protocol', 'actions')
+        related_perms = defaultdict(set)
+        values = self.permissions.filter(assets__in=assets_id) \
+            .values_list('assets', *fields).distinct()
+        for asset_id, *item in values:
+            related_perms[asset_id].add(tuple(item))
         if nodes_keys_related:
-            kwargs["nodes__key__in"] = nodes_keys_related
-
-        queryset = self.permissions
-        if kwargs == 1:
-            queryset = queryset.filter(**kwargs)
-        elif len(kwargs) > 1:
-            kwargs = [{k: v} for k, v in kwargs.items()]
-            args = [Q(**kw) for kw in kwargs]
-            args = reduce(lambda x, y: x | y, args)
-            queryset = queryset.filter(args)
-        else:
-            queryset = queryset.none()
-        asset_protocols = asset.protocols_as_dict.keys()
-        values = queryset.filter(system_users__protocol__in=asset_protocols).distinct()\
-            .values_list('system_users', 'actions')
-        system_users_actions = defaultdict(int)
-        for system_user_id, actions in values:
-            if None in (system_user_id, actions):
-                continue
-            for i, action in values:
-                system_users_actions[i] |= actions
-        return system_users_actions
+            values = self.permissions.filter(nodes__key__in=nodes_keys_related) \
+                .values_list('nodes__key', *fields).distinct()
+            for key, *item in values:
+                related_perms[key].add(tuple(item))
+
+        assets_system_users = {}
+        for asset_id, protocols in assets_protocols.items():
+            system_users_actions = defaultdict(int)
+            for related in (asset_id, *assets_nodes_keys[asset_id]):
+                for system_user_id, protocol, actions in related_perms.get(related, ()):
+                    if None in (system_user_id, actions):
+                        continue
+                    if protocol not in protocols:
+                        continue
+                    system_users_actions[system_user_id] |= actions
+            assets_system_users[asset_id] = system_users_actions
+        return assets_system_users
 
     def get_permissions_nodes_and_assets(self):
         from assets.models import Node
@@ -424,7 +720,7 @@ class AssetPermissionUtil(AssetPermissionUtilCacheMixin):
 
 
 class ParserNode:
-    nodes_only_fields = ("key", "value", "id")
+    nodes_only_fields = ("key", "parent_key", "value", "id")
     assets_only_fields = ("hostname", "id", "ip", "protocols", "domain", "org_id")
     system_users_only_fields = (
         "id", "name", "username", "protocol", "priority", "login_mode",
@@ -159,7 +159,7 @@ class LDAPUserListApi(generics.ListAPIView):
 
     @staticmethod
     def processing_queryset(queryset):
-        db_username_list = User.objects.all().values_list('username', flat=True)
+        db_username_list = set(User.objects.all().values_list('username', flat=True))
         for q in queryset:
             q['id'] = q['username']
             q['existing'] = q['username'] in db_username_list
@@ -243,12 +243,15 @@ class LDAPUserImportAPI(APIView):
         if users is None:
             return Response({'msg': _('Get ldap users is None')}, status=400)
 
-        errors = LDAPImportUtil().perform_import(users)
+        util = LDAPImportUtil()
+        errors = util.perform_import(users)
         if errors:
-            return Response({'errors': errors}, status=400)
+            return Response({'errors': errors, **util.summary}, status=400)
 
         count = users if users is None else len(users)
-        return Response({'msg': _('Imported {} users successfully').format(count)})
+        data = {'msg': _('Imported {} users successfully').format(count)}
+        data.update(util.summary)
+        return Response(data)
 
 
 class LDAPCacheRefreshAPI(generics.RetrieveAPIView):
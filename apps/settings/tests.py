@@ -1,3 +1,33 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase
+
+from users.models import User
+from .utils.ldap import LDAPImportUtil
 
 # Create your tests here.
+
+
+class LDAPImportUtilTestCase(SimpleTestCase):
+    def test_empty_value_not_changed(self):
+        util = LDAPImportUtil()
+        user = util.clean_users([{
+            'username': 'ldap-user', 'name': 'LDAP User',
+            'email': 'ldap-user@example.com', 'is_active': '',
+        }])[0]
+        self.assertNotIn('is_active', user)
+        obj = User(
+            username='ldap-user', name='LDAP User', email='ldap-user@example.com',
+            source=User.SOURCE_LDAP, is_active=False
+        )
+        self.assertEqual(util.diff_user(obj, user), [])
+
+    def test_admin_override_on_update(self):
+        util = LDAPImportUtil()
+        user = util.clean_users([{
+            'username': 'admin', 'name': 'Administrator',
+            'email': 'admin@example.com', 'is_active': False,
+        }])[0]
+        obj = User(username='admin', name='Administrator', email='admin@example.com',
+                   role='User', is_active=True)
+        self.assertEqual(util.diff_user(obj, user), ['role'])
+        self.assertEqual(obj.role, 'Admin')
+        self.assertTrue(obj.is_active)
@@ -2,6 +2,8 @@
 #
 
 import json
+import time
+import datetime
 from ldap3 import Server, Connection, SIMPLE
 from ldap3.core.exceptions import (
     LDAPSocketOpenError,
@@ -19,6 +21,9 @@ from ldap3.core.exceptions import (
 )
 from django.conf import settings
 from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django_redis import get_redis_connection
 from django.utils.translation import ugettext_lazy as _
 from copy import deepcopy
 
@@ -26,6 +31,7 @@ from common.const import LDAP_AD_ACCOUNT_DISABLE
 from common.utils import timeit, get_logger
 from users.utils import construct_user_email
 from users.models import User
+from users.signals import post_user_bulk_import
 from authentication.backends.ldap import LDAPAuthorizationBackend, LDAPUser
 
 logger = get_logger(__file__)
@@ -88,6 +94,9 @@ class LDAPServerUtil(object):
         self._paged_size = self.get_paged_size()
         self.search_users = None
         self.search_value = None
+        # 增量同步, 只查询变更标记 (modifyTimestamp/uSNChanged) 大于等于该值的条目
+        self.change_attr = None
+        self.changed_since = None
 
     @property
     def connection(self):
@@ -134,31 +143,63 @@ class LDAPServerUtil(object):
         search_filter_extra = self.get_search_filter_extra()
         if search_filter_extra:
             search_filter = '(&{}{})'.format(search_filter, search_filter_extra)
+        if self.change_attr and self.changed_since is not None:
+            search_filter = '(&{}({}>={}))'.format(
+                search_filter, self.change_attr, self.changed_since
+            )
         return search_filter
 
+    def get_search_attributes(self):
+        attributes = list(self.config.attr_map.values())
+        if self.change_attr and self.change_attr not in attributes:
+            attributes.append(self.change_attr)
+        return attributes
+
     def search_user_entries_ou(self, search_ou, paged_cookie=None):
         search_filter = self.get_search_filter()
-        attributes = list(self.config.attr_map.values())
+        attributes = self.get_search_attributes()
         self.connection.search(
             search_base=search_ou, search_filter=search_filter,
             attributes=attributes, paged_size=self._paged_size,
             paged_cookie=paged_cookie
         )
 
-    @timeit
-    def search_user_entries(self):
-        logger.info("Search user entries")
-        user_entries = list()
+    def iter_user_entries_pages(self):
+        """
+        按分页逐页返回查询结果, 调用方处理完一页再取下一页, 不用把所有条目放在内存里
+        """
         search_ous = str(self.config.search_ou).split('|')
         for search_ou in search_ous:
             logger.info("Search user entries ou: {}".format(search_ou))
             self.search_user_entries_ou(search_ou)
-            user_entries.extend(self.connection.entries)
+            yield self.connection.entries
             while self.paged_cookie():
                 self.search_user_entries_ou(search_ou, self.paged_cookie())
-                user_entries.extend(self.connection.entries)
+                yield self.connection.entries
+
+    @timeit
+    def search_user_entries(self):
+        logger.info("Search user entries")
+        user_entries = list()
+        for entries in self.iter_user_entries_pages():
+            user_entries.extend(entries)
         return user_entries
 
+    def get_entry_change_value(self, entry):
+        """
+        条目的变更标记, 时间转为 LDAP 的 GeneralizedTime 格式, 可以直接用在过滤条件里
+        """
+        if not self.change_attr or not hasattr(entry, self.change_attr):
+            return None
+        value = getattr(entry, self.change_attr).value
+        if isinstance(value, datetime.datetime):
+            if value.tzinfo is not None:
+                value = value.astimezone(datetime.timezone.utc)
+            value = value.strftime('%Y%m%d%H%M%SZ')
+        elif isinstance(value, str) and value.isdigit():
+            value = int(value)
+        return value
+
     def user_entry_to_dict(self, entry):
         user = {}
         attr_map = self.config.attr_map.items()
@@ -191,25 +232,86 @@ class LDAPServerUtil(object):
 
 
 class LDAPCacheUtil(object):
+    """
+    LDAP 用户缓存在 redis hash 中, field 是用户名, value 是用户信息的 json
+    按用户名查询直接 HMGET, 按关键字搜索用 HSCAN 分批过滤,
+    不用每次把所有用户作为一个大的缓存值取出来
+    """
     CACHE_KEY_USERS = 'CACHE_KEY_LDAP_USERS'
+    CACHE_KEY_USERS_HASH = 'CACHE_KEY_LDAP_USERS_HASH'
+    CACHE_KEY_USERS_HASH_SYNCING = 'CACHE_KEY_LDAP_USERS_HASH_SYNCING'
+    CACHE_KEY_SYNC_STATE = 'CACHE_KEY_LDAP_USERS_SYNC_STATE'
+    scan_count = 1000
 
     def __init__(self):
         self.search_users = None
         self.search_value = None
+        self.redis = get_redis_connection('default')
 
-    def set_users(self, users):
+    def set_users(self, users, key=None):
+        if not users:
+            return
+        key = key or self.CACHE_KEY_USERS_HASH
         logger.info('Set ldap users to cache, count: {}'.format(len(users)))
-        cache.set(self.CACHE_KEY_USERS, users, None)
+        mapping = {
+            user['username']: json.dumps(user, default=str)
+            for user in users if user.get('username')
+        }
+        if mapping:
+            self.redis.hmset(key, mapping)
+
+    def replace_users(self, key):
+        """
+        全量同步先写入临时的 hash, 完成后替换, 同步期间读到的还是完整的旧数据
+        """
+        if self.redis.exists(key):
+            self.redis.rename(key, self.CACHE_KEY_USERS_HASH)
+        else:
+            self.redis.delete(self.CACHE_KEY_USERS_HASH)
+
+    def get_sync_state(self):
+        return cache.get(self.CACHE_KEY_SYNC_STATE)
+
+    def set_sync_state(self, state):
+        cache.set(self.CACHE_KEY_SYNC_STATE, state, None)
+
+    def has_users(self):
+        return self.get_sync_state() is not None
+
+    def count(self):
+        return self.redis.hlen(self.CACHE_KEY_USERS_HASH)
+
+    def iter_users(self):
+        items = self.redis.hscan_iter(self.CACHE_KEY_USERS_HASH, count=self.scan_count)
+        for __, value in items:
+            yield json.loads(value)
+
+    def get_users_by_username(self, usernames):
+        usernames = list(usernames)
+        users = []
+        for i in range(0, len(usernames), self.scan_count):
+            values = self.redis.hmget(
+                self.CACHE_KEY_USERS_HASH, usernames[i:i + self.scan_count]
+            )
+            users.extend(json.loads(v) for v in values if v is not None)
+        return users
 
     def get_users(self):
-        users = cache.get(self.CACHE_KEY_USERS)
-        count = users if users is None else len(users)
-        logger.info('Get ldap users from cache, count: {}'.format(count))
+        if not self.has_users():
+            logger.info('Get ldap users from cache, count: None')
+            return None
+        users = list(self.iter_users())
+        logger.info('Get ldap users from cache, count: {}'.format(len(users)))
         return users
 
     def delete_users(self):
         logger.info('Delete ldap users from cache')
-        cache.delete(self.CACHE_KEY_USERS)
+        cache.delete_many([self.CACHE_KEY_USERS, self.CACHE_KEY_SYNC_STATE])
+        self.redis.delete(self.CACHE_KEY_USERS_HASH, self.CACHE_KEY_USERS_HASH_SYNCING)
+
+    def match_user(self, user):
+        values = ','.join(str(v) for v in user.values())
+        return self.search_value in values
 
     def filter_users(self, users):
         if users is None:
@@ -220,10 +322,7 @@ class LDAPCacheUtil(object):
                 if user['username'] in self.search_users
             ]
         elif self.search_value:
-            filter_users = [
-                user for user in users
-                if self.search_value in ','.join(user.values())
-            ]
+            filter_users = [user for user in users if self.match_user(user)]
         else:
             filter_users = users
         return filter_users
@@ -231,9 +330,13 @@ class LDAPCacheUtil(object):
     def search(self, search_users=None, search_value=None):
         self.search_users = search_users
         self.search_value = search_value
-        users = self.get_users()
-        users = self.filter_users(users)
-        return users
+        if not self.has_users():
+            return None
+        if search_users:
+            return self.get_users_by_username(search_users)
+        if search_value:
+            return [user for user in self.iter_users() if self.match_user(user)]
+        return self.get_users()
 
 
 class LDAPSyncUtil(object):
@@ -298,9 +401,56 @@ class LDAPSyncUtil(object):
     def pre_sync(self):
         self.set_task_status(self.TASK_STATUS_IS_RUNNING)
 
+    def is_incremental(self, state):
+        if not state or not settings.AUTH_LDAP_SYNC_CHANGE_ATTR:
+            return False
+        if state.get('change_attr') != settings.AUTH_LDAP_SYNC_CHANGE_ATTR:
+            return False
+        if state.get('changed_since') is None:
+            return False
+        # 增量同步发现不了被删除的条目, 定期做一次全量同步
+        interval = settings.AUTH_LDAP_SYNC_FULL_INTERVAL * 3600
+        return time.time() - state.get('date_full_sync', 0) < interval
+
     def sync(self):
-        users = self.server_util.search()
-        self.cache_util.set_users(users)
+        """
+        逐页同步到缓存, 返回本次同步到的用户名
+        有上次同步的变更标记时只查询之后变更过的条目
+        """
+        state = self.cache_util.get_sync_state()
+        incremental = self.is_incremental(state)
+        change_attr = settings.AUTH_LDAP_SYNC_CHANGE_ATTR
+        self.server_util.change_attr = change_attr
+        if incremental:
+            changed_since = state['changed_since']
+            self.server_util.changed_since = changed_since
+            key = self.cache_util.CACHE_KEY_USERS_HASH
+        else:
+            state = {'date_full_sync': time.time()}
+            changed_since = None
+            key = self.cache_util.CACHE_KEY_USERS_HASH_SYNCING
+            self.cache_util.redis.delete(key)
+        logger.info('Sync ldap users, incremental: {}, changed since: {}'.format(
+            incremental, changed_since
+        ))
+
+        usernames = []
+        for entries in self.server_util.iter_user_entries_pages():
+            users = self.server_util.user_entries_to_dict(entries)
+            self.cache_util.set_users(users, key=key)
+            usernames.extend(user['username'] for user in users if user.get('username'))
+            for entry in entries:
+                value = self.server_util.get_entry_change_value(entry)
+                if value is None:
+                    continue
+                if changed_since is None or value > changed_since:
+                    changed_since = value
+
+        if not incremental:
+            self.cache_util.replace_users(key)
+        state.update({'change_attr': change_attr, 'changed_since': changed_since})
+        self.cache_util.set_sync_state(state)
+        return usernames
 
     def post_sync(self):
         self.set_task_status(self.TASK_STATUS_IS_OVER)
@@ -319,9 +469,17 @@ class LDAPSyncUtil(object):
 
 
 class LDAPImportUtil(object):
+    """
+    批量导入 LDAP 用户
+    按用户名一次加载已有用户, 对比差异后批量创建新用户, 只批量更新有变化的字段,
+    不再对每个用户 update_or_create (每个用户两次查询加一次 post_save 和操作日志)
+    """
+    batch_size = 1000
 
     def __init__(self):
-        pass
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
 
     @staticmethod
     def get_user_email(user):
@@ -339,16 +497,147 @@ class LDAPImportUtil(object):
         )
         return obj, created
 
+    @property
+    def summary(self):
+        return {
+            'created': self.created,
+            'updated': self.updated,
+            'unchanged': self.unchanged,
+        }
+
+    # User.save() 中会修改的字段, bulk_update 不调用 save, 更新时也要对比这些字段
+    save_fields = ('name', 'email', 'role', 'is_active')
+
+    @staticmethod
+    def normalize_user(user, fields):
+        """
+        LDAP 中没有的属性是空字符串, 转换成字段的类型后再和数据库中的值对比,
+        无法转换的值 (如布尔字段的空字符串) 不修改这个字段, 不会每次同步都算作有变化
+        """
+        normalized = {}
+        for name, value in user.items():
+            field = fields[name]
+            try:
+                value = field.to_python(value)
+            except ValidationError:
+                continue
+            if value is None and not field.null:
+                continue
+            normalized[name] = value
+        return normalized
+
+    def clean_users(self, users):
+        fields = {f.attname: f for f in User._meta.concrete_fields}
+        cleaned = {}
+        for user in users:
+            user = {k: v for k, v in user.items() if k in fields}
+            if not user.get('username'):
+                continue
+            user['email'] = self.get_user_email(user)
+            if user['username'] not in ['admin']:
+                user['source'] = User.SOURCE_LDAP
+            user = self.normalize_user(user, fields)
+            # 同名的用户以最后一个为准, 和逐个 update_or_create 的结果一致
+            cleaned[user['username']] = user
+        return list(cleaned.values())
+
+    @staticmethod
+    def prepare_user(obj):
+        # 和 User.save() 中的处理一致
+        obj.set_unprovide_attr_if_need()
+        if obj.username == 'admin':
+            obj.role = 'Admin'
+            obj.is_active = True
+
+    @classmethod
+    def diff_user(cls, obj, user):
+        fields = set(user) | set(cls.save_fields)
+        before = {field: getattr(obj, field) for field in fields}
+        for field, value in user.items():
+            setattr(obj, field, value)
+        cls.prepare_user(obj)
+        return sorted(f for f in fields if getattr(obj, f) != before[f])
+
+    @classmethod
+    def new_user(cls, user):
+        obj = User(**user)
+        cls.prepare_user(obj)
+        return obj
+
+    def save_one(self, obj, fields, errors):
+        try:
+            if fields is None:
+                obj.save()
+            else:
+                obj.save(update_fields=fields)
+            return True
+        except Exception as e:
+            errors.append({obj.username: str(e)})
+            logger.error(e)
+            return False
+
+    def bulk_create(self, objs, errors):
+        try:
+            with transaction.atomic():
+                User.objects.bulk_create(objs)
+            self.created += len(objs)
+        except Exception as e:
+            # 有一个用户出错整批都会失败, 逐个创建找出出错的用户
+            logger.error('Bulk create ldap users error, retry one by one: {}'.format(e))
+            for obj in objs:
+                obj._state.adding = True
+                self.created += self.save_one(obj, None, errors)
+
+    def bulk_update(self, objs, fields, errors):
+        try:
+            with transaction.atomic():
+                User.objects.bulk_update(objs, fields)
+            self.updated += len(objs)
+        except Exception as e:
+            logger.error('Bulk update ldap users error, retry one by one: {}'.format(e))
+            for obj in objs:
+                self.updated += self.save_one(obj, obj._ldap_changed_fields, errors)
+
+    def import_batch(self, users, errors):
+        usernames = [user['username'] for user in users]
+        existing = {
+            u.username: u for u in User.objects.filter(username__in=usernames)
+        }
+        to_create, to_update = [], []
+        update_fields = set()
+        for user in users:
+            obj = existing.get(user['username'])
+            if obj is None:
+                to_create.append(self.new_user(user))
+                continue
+            changed = self.diff_user(obj, user)
+            if not changed:
+                self.unchanged += 1
+                continue
+            obj._ldap_changed_fields = changed
+            update_fields.update(changed)
+            to_update.append(obj)
+
+        if to_create:
+            self.bulk_create(to_create, errors)
+        if to_update:
+            self.bulk_update(to_update, sorted(update_fields), errors)
+
+    def import_users(self, users, errors):
+        users = self.clean_users(users)
+        for i in range(0, len(users), self.batch_size):
+            self.import_batch(users[i:i + self.batch_size], errors)
+
+    def send_import_signal(self):
+        if self.created or self.updated:
+            post_user_bulk_import.send(User, **self.summary)
+
     def perform_import(self, users):
         logger.info('Start perform import ldap users, count: {}'.format(len(users)))
         errors = []
-        for user in users:
-            try:
-                self.update_or_create(user)
-            except Exception as e:
-                errors.append({user['username']: str(e)})
-                logger.error(e)
-        logger.info('End perform import ldap users')
+        self.import_users(users, errors)
+        self.send_import_signal()
+        logger.info('End perform import ldap users: {}'.format(self.summary))
         return errors
 
 
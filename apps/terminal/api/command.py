@@ -1,28 +1,36 @@
 # -*- coding: utf-8 -*-
 #
+import csv
 import json
 import time
+import codecs
 
 from django.conf import settings
 from django.utils import timezone
 from django.shortcuts import HttpResponse
+from django.http import StreamingHttpResponse
+from django.utils.html import escape
+from django.utils.translation import ugettext_lazy as _
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework import viewsets
 from rest_framework import generics
 from rest_framework.fields import DateTimeField
 from rest_framework.response import Response
-from django.template import loader
 
 
 from orgs.utils import current_org
 from common.permissions import IsOrgAdminOrAppUser, IsOrgAuditor
 from common.utils import get_logger
+from common.drf.pagination import KeysetPagination
 from terminal.utils import send_command_alert_mail
 
 from ..backends import (
     get_command_storage, get_multi_command_storage,
     SessionCommandSerializer,
 )
+from ..backends.command.models import AbstractSessionCommand
+from ..backends.command.buffer import CommandBuffer
+from ..tasks import schedule_flush_command_buffer
 
 logger = get_logger(__name__)
 __all__ = ['CommandViewSet', 'CommandExportApi', 'insecure_command_alert_api']
@@ -107,10 +115,14 @@ class CommandViewSet(CommandQueryMixin, viewsets.ModelViewSet):
     """
     command_store = get_command_storage()
     serializer_class = SessionCommandSerializer
+    pagination_class = KeysetPagination
+    keyset_fields = ('timestamp', 'id')
 
     def create(self, request, *args, **kwargs):
         serializer = self.serializer_class(data=request.data, many=True)
         if serializer.is_valid():
+            if self.push_to_buffer(serializer.validated_data):
+                return Response("ok", status=201)
             ok = self.command_store.bulk_save(serializer.validated_data)
             if ok:
                 return Response("ok", status=201)
@@ -121,23 +133,101 @@ class CommandViewSet(CommandQueryMixin, viewsets.ModelViewSet):
             logger.error(msg)
             return Response({"msg": msg}, status=401)
 
+    @staticmethod
+    def push_to_buffer(commands):
+        """
+        开启缓冲后命令先写入缓冲区, 由后台批量写入存储
+        缓冲区满了 (写入跟不上) 就同步写, 让终端慢下来
+        """
+        if not CommandBuffer.is_enabled():
+            return False
+        try:
+            buffer = CommandBuffer()
+            if buffer.is_full():
+                return False
+            buffer.push(commands)
+        except Exception as e:
+            logger.error("Push commands to buffer error: {}".format(e))
+            return False
+        schedule_flush_command_buffer(buffer)
+        return True
+
+
+class Echo:
+    def write(self, value):
+        return value
+
 
 class CommandExportApi(CommandQueryMixin, generics.ListAPIView):
+    """
+    流式导出命令, 每个存储按页取数据, 边取边写, 不会把所有命令放到内存中
+    ?type=html|csv|ndjson, 默认 html
+    """
     serializer_class = SessionCommandSerializer
+    export_fields = (
+        ('input', _('Command')), ('risk_level_display', _('Risk level')),
+        ('user', _('User')), ('asset', _('Asset')),
+        ('system_user', _('System user')), ('session', _('Session')),
+        ('datetime', _('Datetime')),
+    )
+    content_types = {
+        'html': 'text/html; charset=utf-8',
+        'csv': 'text/csv; charset=utf-8',
+        'ndjson': 'application/x-ndjson',
+    }
+
+    def get_export_type(self):
+        tp = self.request.query_params.get('type', 'html')
+        if tp not in self.content_types:
+            tp = 'html'
+        return tp
+
+    def iter_rows(self, queryset):
+        for command in queryset:
+            dt = timezone.datetime.fromtimestamp(command.timestamp, tz=timezone.utc)
+            row = {
+                'input': command.input,
+                'risk_level_display': AbstractSessionCommand.get_risk_level_str(command.risk_level),
+                'user': command.user,
+                'asset': command.asset,
+                'system_user': command.system_user,
+                'session': command.session,
+                'datetime': timezone.localtime(dt).strftime('%Y-%m-%d %H:%M:%S'),
+            }
+            yield command, row
+
+    def stream_html(self, queryset):
+        yield '<!DOCTYPE html><html><head><meta charset="utf-8">' \
+              '<title>{}</title></head><body><table border="1">'.format(_('Command report'))
+        yield '<tr>{}</tr>\n'.format(
+            ''.join('<th>{}</th>'.format(escape(label)) for __, label in self.export_fields)
+        )
+        total = 0
+        for __, row in self.iter_rows(queryset):
+            total += 1
+            yield '<tr>{}</tr>\n'.format(
+                ''.join('<td>{}</td>'.format(escape(row[f])) for f, __ in self.export_fields)
+            )
+        yield '</table><p>{}: {}</p></body></html>'.format(_('Total'), total)
+
+    def stream_csv(self, queryset):
+        writer = csv.writer(Echo())
+        yield codecs.BOM_UTF8.decode('utf-8')
+        yield writer.writerow([str(label) for __, label in self.export_fields])
+        for __, row in self.iter_rows(queryset):
+            yield writer.writerow([row[f] for f, __ in self.export_fields])
+
+    def stream_ndjson(self, queryset):
+        for command, __ in self.iter_rows(queryset):
+            data = self.serializer_class(command).data
+            yield json.dumps(data, ensure_ascii=False) + '\n'
 
     def list(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
-
-        template = 'terminal/command_report.html'
-        context = {
-            'queryset': queryset,
-            'total_count': len(queryset),
-            'now': time.time(),
-        }
-        content = loader.render_to_string(template, context, request)
-        content_type = 'application/octet-stream'
-        response = HttpResponse(content, content_type)
-        filename = 'command-report-{}.html'.format(int(time.time()))
+        tp = self.get_export_type()
+        stream = getattr(self, 'stream_{}'.format(tp))(queryset)
+        response = StreamingHttpResponse(stream, content_type=self.content_types[tp])
+        filename = 'command-report-{}.{}'.format(int(time.time()), tp)
         response['Content-Disposition'] = 'attachment; filename="%s"' % filename
         return response
 
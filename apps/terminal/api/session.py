@@ -20,6 +20,7 @@ from common.mixins.api import AsyncApiMixin
 from common.permissions import IsOrgAdminOrAppUser, IsOrgAuditor, IsAppUser
 from common.drf.filters import DatetimeRangeFilter
 from common.drf.renders import PassthroughRenderer
+from common.drf.pagination import KeysetPagination
 from orgs.mixins.api import OrgBulkModelViewSet
 from orgs.utils import tmp_to_root_org, tmp_to_org
 from users.models import User
@@ -50,6 +51,8 @@ class SessionViewSet(OrgBulkModelViewSet):
         ('date_start', ('date_from', 'date_to'))
     ]
     extra_filter_backends = [DatetimeRangeFilter]
+    pagination_class = KeysetPagination
+    keyset_fields = ('date_start', 'id')
 
     @staticmethod
     def prepare_offline_file(session, local_path):
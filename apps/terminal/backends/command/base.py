@@ -2,6 +2,14 @@
 import abc
 
 
+def command_sort_key(command):
+    if isinstance(command, (list, tuple)):
+        timestamp, _id = command
+    else:
+        timestamp, _id = command.timestamp, command.id
+    return int(timestamp), str(_id)
+
+
 class CommandBase(object):
     __metaclass__ = abc.ABCMeta
 
@@ -22,6 +30,20 @@ class CommandBase(object):
     @abc.abstractmethod
     def count(self, date_from=None, date_to=None,
               user=None, asset=None, system_user=None,
-              input=None, session=None):
+              input=None, session=None, risk_level=None, org_id=None):
         pass
 
+    def filter_page(self, offset=0, limit=None, after=None, **kwargs):
+        """
+        按 (timestamp, id) 倒序返回一页命令, after 是上一页最后一条的 (timestamp, id)
+        存储支持的话应该把分页下推到后端
+        """
+        commands = sorted(
+            self.filter(**kwargs), key=command_sort_key, reverse=True
+        )
+        if after is not None:
+            after = command_sort_key(after)
+            commands = [c for c in commands if command_sort_key(c) < after]
+        if limit is None:
+            return commands[offset:]
+        return commands[offset:offset + limit]
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+import json
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from common.utils import get_logger
+
+logger = get_logger(__file__)
+
+
+class CommandBuffer:
+    """
+    命令写入缓冲区, 使用 redis stream 持久化
+    终端上报的命令先写入 stream 就返回, 由 celery 任务批量写入命令存储
+    消费者组保证写入失败或 worker 退出时, 未确认的消息可以被重新领取
+    多次投递仍然写入失败的消息移到死信 stream 中, 不会一直卡住后面的消息
+    """
+    stream_key = 'TERMINAL_COMMAND_STREAM'
+    dead_stream_key = 'TERMINAL_COMMAND_STREAM_DEAD'
+    dead_stream_max_length = 100000
+    group = 'command_writer'
+    claim_idle_ms = 60 * 1000
+    max_deliveries = 3
+
+    def __init__(self):
+        self.redis = get_redis_connection('default')
+        self._group_created = False
+
+    @staticmethod
+    def is_enabled():
+        return settings.TERMINAL_COMMAND_BUFFER_ENABLED
+
+    def ensure_group(self):
+        if self._group_created:
+            return
+        try:
+            self.redis.xgroup_create(self.stream_key, self.group, id='0', mkstream=True)
+        except Exception as e:
+            # BUSYGROUP, 已经创建过了
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self._group_created = True
+
+    def length(self):
+        return self.redis.xlen(self.stream_key)
+
+    def is_full(self):
+        return self.length() >= settings.TERMINAL_COMMAND_BUFFER_MAX_LENGTH
+
+    def push(self, commands):
+        if not commands:
+            return
+        self.ensure_group()
+        pipeline = self.redis.pipeline(transaction=False)
+        for command in commands:
+            data = json.dumps(command, ensure_ascii=False)
+            pipeline.xadd(self.stream_key, {'data': data})
+        pipeline.execute()
+
+    def claim_pending(self, consumer, count):
+        """
+        领取其他消费者超时未确认的消息, 写入失败的消息也会在这里重试
+        返回 (消息, 这批消息中最多的投递次数)
+        """
+        pending = self.redis.xpending_range(
+            self.stream_key, self.group, '-', '+', count
+        )
+        deliveries = {
+            item['message_id']: item['times_delivered'] for item in pending
+            if item['time_since_delivered'] >= self.claim_idle_ms
+        }
+        if not deliveries:
+            return [], 0
+        messages = self.redis.xclaim(
+            self.stream_key, self.group, consumer, self.claim_idle_ms,
+            list(deliveries.keys())
+        )
+        # xclaim 会把投递次数加 1
+        times = max(deliveries.values()) + 1
+        return messages, times
+
+    def read(self, consumer, count):
+        """
+        返回 (消息 id, 命令, 投递次数), 投递次数是这批消息中最多的投递次数
+        """
+        self.ensure_group()
+        messages, times = self.claim_pending(consumer, count)
+        if not messages:
+            streams = self.redis.xreadgroup(
+                self.group, consumer, {self.stream_key: '>'}, count=count
+            )
+            messages = streams[0][1] if streams else []
+            times = 1
+
+        ids, commands = [], []
+        for message_id, fields in messages:
+            ids.append(message_id)
+            try:
+                commands.append(json.loads(fields[b'data']))
+            except (KeyError, ValueError, TypeError) as e:
+                logger.error("Invalid command buffer message: {} {}".format(message_id, e))
+        return ids, commands, times
+
+    def move_to_dead(self, commands):
+        """
+        多次写入失败的命令移到死信 stream 中, 保留下来以便排查和手动恢复
+        """
+        if not commands:
+            return
+        pipeline = self.redis.pipeline(transaction=False)
+        for command in commands:
+            data = json.dumps(command, ensure_ascii=False)
+            pipeline.xadd(
+                self.dead_stream_key, {'data': data},
+                maxlen=self.dead_stream_max_length, approximate=True
+            )
+        pipeline.execute()
+
+    def ack(self, ids):
+        if not ids:
+            return
+        self.redis.xack(self.stream_key, self.group, *ids)
+        self.redis.xdel(self.stream_key, *ids)
@@ -2,10 +2,11 @@
 import datetime
 
 from django.db import transaction
+from django.db.models import Q
 from django.utils import timezone
 from django.db.utils import OperationalError
 
-from .base import CommandBase
+from .base import CommandBase, command_sort_key
 
 
 class CommandStore(CommandBase):
@@ -49,12 +50,24 @@ class CommandStore(CommandBase):
 
         if not error:
             return True
+        # 一般是输出中有数据库不支持的字符, 统一编码后再批量写一次, 不再逐条重试
+        for command in _commands:
+            command.output = str(command.output.encode())
+        try:
+            with transaction.atomic():
+                self.model.objects.bulk_create(_commands)
+            return True
+        except OperationalError:
+            pass
+        except:
+            return False
+        # 还有问题的只能是命令本身了
         for command in _commands:
             try:
                 with transaction.atomic():
                     command.save()
             except OperationalError:
-                command.output = str(command.output.encode())
+                command.input = str(command.input.encode())[:128]
                 command.save()
         return True
 
@@ -107,13 +120,24 @@ class CommandStore(CommandBase):
         queryset = self.model.objects.filter(**filter_kwargs)
         return queryset
 
+    def filter_page(self, offset=0, limit=None, after=None, **kwargs):
+        queryset = self.filter(**kwargs).order_by('-timestamp', '-id')
+        if after is not None:
+            timestamp, _id = command_sort_key(after)
+            queryset = queryset.filter(
+                Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=_id)
+            )
+        if limit is None:
+            return queryset[offset:]
+        return queryset[offset:offset + limit]
+
     def count(self, date_from=None, date_to=None,
               user=None, asset=None, system_user=None,
-              input=None, session=None):
+              input=None, session=None, risk_level=None, org_id=None):
         filter_kwargs = self.make_filter_kwargs(
             date_from=date_from, date_to=date_to, user=user,
             asset=asset, system_user=system_user, input=input,
-            session=session,
+            session=session, risk_level=risk_level, org_id=org_id,
         )
         count = self.model.objects.filter(**filter_kwargs).count()
         return count
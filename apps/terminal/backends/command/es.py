@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 #
 
+import uuid
 from datetime import datetime
 from jms_storage.es import ESStorage
-from common.utils import get_logger
-from .base import CommandBase
+from common.utils import get_logger, is_uuid
+from .base import CommandBase, command_sort_key
 from .models import AbstractSessionCommand
 
 
@@ -12,9 +13,25 @@ logger = get_logger(__file__)
 
 
 class CommandStore(ESStorage, CommandBase):
+    max_result_window = 10000
+    # 动态映射下字符串是 text 类型, 排序和 search_after 使用它的 keyword 子字段
+    id_sort_field = 'id.keyword'
+    # 以前保存的命令没有 id, 排序时当作空字符串, 排在同一时间戳的最后, 再按 _id 排序
+    id_missing_value = ''
+
     def __init__(self, params):
         super().__init__(params)
 
+    @staticmethod
+    def make_data(command):
+        """
+        保存命令 id 和组织, 用于稳定的 (timestamp, id) 游标翻页和组织过滤
+        """
+        data = ESStorage.make_data(command)
+        data['id'] = str(command.get('id') or uuid.uuid4())
+        data['org_id'] = command.get('org_id', '')
+        return data
+
     def filter(self, date_from=None, date_to=None,
                user=None, asset=None, system_user=None,
                input=None, session=None, risk_level=None, org_id=None):
@@ -39,15 +56,112 @@ class CommandStore(ESStorage, CommandBase):
                 [item["_source"] for item in data["hits"] if item]
             )
 
-    def count(self, date_from=None, date_to=None, user=None, asset=None,
-              system_user=None, input=None, session=None):
+    @staticmethod
+    def get_page_query(date_from=None, date_to=None,
+                       user=None, asset=None, system_user=None,
+                       input=None, session=None, risk_level=None, org_id=None):
+        """
+        分页查询使用的条件, 时间范围直接用命令的 timestamp (秒)
+        """
+        must = []
+        must_not = []
+        match = {
+            'user': user, 'asset': asset, 'system_user': system_user,
+            'input': input, 'session': session,
+        }
+        for field, value in match.items():
+            if value:
+                must.append({'match': {field: value}})
+        if risk_level is not None:
+            must.append({'term': {'risk_level': risk_level}})
+        if org_id is not None:
+            # 和 jms_storage 一致, 默认组织的 org_id 为 "", 没有保存 org_id 的也属于默认组织
+            # org_id 是分词的 text 字段, UUID 会被拆开, 使用 match_phrase
+            if org_id == '':
+                must_not.append({'wildcard': {'org_id': '*'}})
+            else:
+                must.append({'match_phrase': {'org_id': org_id}})
+
+        timestamp_range = {}
+        if isinstance(date_from, datetime):
+            date_from = date_from.timestamp()
+        if isinstance(date_to, datetime):
+            date_to = date_to.timestamp()
+        if date_from is not None:
+            timestamp_range['gte'] = int(date_from)
+        if date_to is not None:
+            timestamp_range['lte'] = int(date_to)
+        if timestamp_range:
+            must.append({'range': {'timestamp': timestamp_range}})
+        return {'bool': {'must': must, 'must_not': must_not}}
+
+    def filter_page(self, offset=0, limit=None, after=None, **kwargs):
+        """
+        把分页下推到 es, 不会一次取出所有命令
+        - offset: from/size, es 默认最多只能翻到 10000 条 (index.max_result_window)
+        - after: search_after, 按 (timestamp, id) 翻页, 没有深度限制
+        按 (timestamp, 保存的命令 id, _id) 排序, _id 保证每条命令的排序值都不同, 翻页不会重复
+        以前保存的没有 id 的命令, 返回的 id 是 _id
+        查询出错时抛出异常, 不当作没有更多的命令
+        """
+        if limit is None:
+            limit = self.max_result_window - offset
+        if limit <= 0:
+            return []
+        body = {
+            'query': self.get_page_query(**kwargs),
+            'sort': [
+                {'timestamp': {'order': 'desc'}},
+                {self.id_sort_field: {
+                    'order': 'desc', 'unmapped_type': 'keyword',
+                    'missing': self.id_missing_value,
+                }},
+                {'_id': {'order': 'desc'}},
+            ],
+            'size': limit,
+        }
+        if after is not None:
+            body['search_after'] = self.get_search_after(after)
+        else:
+            body['from'] = offset
         try:
-            count = super().count(
+            data = self.es.search(index=self.index, doc_type=self.doc_type, body=body)
+        except Exception as e:
+            logger.error('Search commands page error: {}'.format(e), exc_info=True)
+            raise
+        commands = []
+        for item in data["hits"]["hits"]:
+            if not item:
+                continue
+            command = AbstractSessionCommand.from_dict(item["_source"])
+            command.id = item["_source"].get("id") or item["_id"]
+            commands.append(command)
+        return commands
+
+    def get_search_after(self, after):
+        """
+        (timestamp, id) 转换成排序值, 没有保存 id 的命令 id 是 es 生成的 _id, 不是 UUID
+        """
+        timestamp, _id = command_sort_key(after)
+        if is_uuid(_id):
+            # 同一 (timestamp, id) 只有这一条, _id 取最小值跳过它
+            return [timestamp, _id, '']
+        return [timestamp, self.id_missing_value, _id]
+
+    def count(self, date_from=None, date_to=None, user=None, asset=None,
+              system_user=None, input=None, session=None,
+              risk_level=None, org_id=None):
+        body = {
+            'query': self.get_page_query(
                 date_from=date_from, date_to=date_to, user=user, asset=asset,
-                system_user=system_user, input=input, session=session
+                system_user=system_user, input=input, session=session,
+                risk_level=risk_level, org_id=org_id,
             )
+        }
+        try:
+            data = self.es.count(index=self.index, doc_type=self.doc_type, body=body)
         except Exception as e:
             logger.error(e, exc_info=True)
             return 0
         else:
-            return count
+            return data['count']
@@ -1,7 +1,89 @@
 # -*- coding: utf-8 -*-
 #
+import heapq
+from itertools import islice
 
-from .base import CommandBase
+from rest_framework.exceptions import NotFound
+
+from .base import CommandBase, command_sort_key
+
+
+class MergedCommands:
+    """
+    多个命令存储按 (timestamp, id) 倒序合并后的结果, 类似 QuerySet 是惰性的
+    每个存储按游标一页一页地取, 再用堆做多路归并,
+    切片时每个存储最多只取前 N 条, 不会把所有命令都取到内存里排序
+    """
+    page_size = 500
+
+    def __init__(self, storage_list, after=None, **kwargs):
+        self.storage_list = list(storage_list)
+        self.filter_kwargs = kwargs
+        self.cursor = after
+        self._count = None
+
+    def after(self, cursor):
+        """
+        游标 (timestamp, id) 之后的结果, 用于 keyset 分页
+        """
+        if cursor is not None:
+            try:
+                cursor = command_sort_key(cursor)
+            except (TypeError, ValueError):
+                raise NotFound('Invalid cursor')
+        return self.__class__(self.storage_list, after=cursor, **self.filter_kwargs)
+
+    def iter_storage(self, storage, limit=None):
+        after = self.cursor
+        fetched = 0
+        while limit is None or fetched < limit:
+            size = self.page_size
+            if limit is not None:
+                size = min(size, limit - fetched)
+            commands = list(storage.filter_page(
+                limit=size, after=after, **self.filter_kwargs
+            ))
+            yield from commands
+            if len(commands) < size:
+                break
+            fetched += len(commands)
+            after = command_sort_key(commands[-1])
+
+    def iter_merged(self, limit=None):
+        iterables = [
+            self.iter_storage(storage, limit=limit)
+            for storage in self.storage_list
+        ]
+        merged = heapq.merge(*iterables, key=command_sort_key, reverse=True)
+        return islice(merged, limit)
+
+    def count(self):
+        if self._count is None:
+            self._count = sum(
+                storage.count(**self.filter_kwargs)
+                for storage in self.storage_list
+            )
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return self.iter_merged()
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            if item.step not in (None, 1):
+                raise ValueError('Slice step not supported')
+            if (item.start or 0) < 0 or (item.stop or 0) < 0:
+                raise ValueError('Negative indexing is not supported')
+            return list(islice(self.iter_merged(item.stop), item.start, item.stop))
+        if item < 0:
+            raise ValueError('Negative indexing is not supported')
+        commands = self[item:item + 1]
+        if not commands:
+            raise IndexError('Command index out of range')
+        return commands[0]
 
 
 class CommandStore(CommandBase):
@@ -9,15 +91,7 @@ class CommandStore(CommandBase):
         self.storage_list = storage_list
 
     def filter(self, **kwargs):
-        if len(self.storage_list) == 1:
-            storage = list(self.storage_list)[0]
-            queryset = storage.filter(**kwargs)
-            return queryset
-
-        queryset = []
-        for storage in self.storage_list:
-            queryset.extend(storage.filter(**kwargs))
-        return sorted(queryset, key=lambda command: command.timestamp, reverse=True)
+        return MergedCommands(self.storage_list, **kwargs)
 
     def count(self, **kwargs):
         amount = 0
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.13 on 2020-08-24 10:21
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terminal', '0025_auto_20200810_1735'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionDailyStat',
+            fields=[
+                ('org_id', models.CharField(blank=True, db_index=True, default='', max_length=36, verbose_name='Organization')),
+                ('id', models.UUIDField(default=uuid.uuid4, primary_key=True, serialize=False)),
+                ('date', models.DateField(db_index=True, verbose_name='Date')),
+                ('type', models.CharField(choices=[('user', 'User'), ('asset', 'Asset')], max_length=8, verbose_name='Type')),
+                ('value', models.CharField(max_length=128, verbose_name='Value')),
+                ('count', models.IntegerField(default=0, verbose_name='Count')),
+                ('date_last', models.DateTimeField(null=True, verbose_name='Date last')),
+            ],
+            options={
+                'verbose_name': 'Session daily stat',
+                'db_table': 'terminal_session_daily_stat',
+                'unique_together': {('org_id', 'date', 'type', 'value')},
+            },
+        ),
+    ]
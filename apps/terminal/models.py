@@ -5,7 +5,8 @@ import uuid
 import jms_storage
 from assets.models import Asset
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Case, When, Value, Count, Max
 from django.db.models.signals import post_save
 from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
@@ -15,6 +16,7 @@ from django.core.cache import cache
 
 from users.models import User
 from orgs.mixins.models import OrgModelMixin
+from orgs.utils import tmp_to_root_org
 from common.mixins import CommonModelMixin
 from common.fields.model import EncryptJsonDictTextField
 from common.db.models import ChoiceSet
@@ -340,6 +342,92 @@ class Session(OrgModelMixin):
         return "{0.id} of {0.user} to {0.asset}".format(self)
 
 
+class SessionDailyStat(OrgModelMixin):
+    """
+    按天汇总的会话统计, 每个组织每天每个用户 (资产) 一行, 记录当天的会话数和最后登录时间
+    仪表盘的登录次数, 活跃用户 (资产) 数和排行都从这里统计, 不再扫描会话表
+    会话创建时增量更新, 每天夜里用会话表重新计算最近几天的数据
+    """
+    TYPE_USER = 'user'
+    TYPE_ASSET = 'asset'
+    TYPE_CHOICES = (
+        (TYPE_USER, _('User')),
+        (TYPE_ASSET, _('Asset')),
+    )
+
+    id = models.UUIDField(default=uuid.uuid4, primary_key=True)
+    date = models.DateField(db_index=True, verbose_name=_('Date'))
+    type = models.CharField(max_length=8, choices=TYPE_CHOICES, verbose_name=_('Type'))
+    value = models.CharField(max_length=128, verbose_name=_('Value'))
+    count = models.IntegerField(default=0, verbose_name=_('Count'))
+    date_last = models.DateTimeField(null=True, verbose_name=_('Date last'))
+
+    class Meta:
+        db_table = "terminal_session_daily_stat"
+        unique_together = [('org_id', 'date', 'type', 'value')]
+        verbose_name = _('Session daily stat')
+
+    def __str__(self):
+        return '{0.date} {0.type} {0.value}: {0.count}'.format(self)
+
+    @staticmethod
+    def get_local_date(dt):
+        return timezone.localtime(dt).date()
+
+    @staticmethod
+    def get_date_range(date):
+        tz = timezone.get_current_timezone()
+        ds = timezone.make_aware(timezone.datetime.combine(date, timezone.datetime.min.time()), tz)
+        return ds, ds + timezone.timedelta(days=1)
+
+    @classmethod
+    def incr(cls, org_id, date, tp, value, dt):
+        # 不能用 save(), OrgModelMixin 会把 org_id 改成当前组织
+        queryset = cls.objects.filter(org_id=org_id, date=date, type=tp, value=value)
+        date_last = Case(
+            When(date_last__lt=dt, then=Value(dt)),
+            default=F('date_last'), output_field=models.DateTimeField()
+        )
+        if queryset.update(count=F('count') + 1, date_last=date_last):
+            return
+        stat = cls(org_id=org_id, date=date, type=tp, value=value, count=1, date_last=dt)
+        try:
+            with transaction.atomic():
+                cls.objects.bulk_create([stat])
+        except IntegrityError:
+            # 并发时别的会话已经创建了这一行
+            queryset.update(count=F('count') + 1, date_last=date_last)
+
+    @classmethod
+    def record_session(cls, session):
+        date = cls.get_local_date(session.date_start)
+        with tmp_to_root_org():
+            cls.incr(session.org_id, date, cls.TYPE_USER, session.user, session.date_start)
+            cls.incr(session.org_id, date, cls.TYPE_ASSET, session.asset, session.date_start)
+
+    @classmethod
+    def rebuild(cls, date):
+        """
+        用会话表重新计算某一天的统计, 修正增量更新可能出现的偏差
+        """
+        ds, de = cls.get_date_range(date)
+        stats = []
+        with tmp_to_root_org():
+            sessions = Session.objects.filter(date_start__gte=ds, date_start__lt=de)
+            for tp in (cls.TYPE_USER, cls.TYPE_ASSET):
+                rows = sessions.values('org_id', tp).order_by()\
+                    .annotate(total=Count('id'), last=Max('date_start'))
+                stats.extend(
+                    cls(org_id=row['org_id'], date=date, type=tp, value=row[tp],
+                        count=row['total'], date_last=row['last'])
+                    for row in rows
+                )
+            with transaction.atomic():
+                cls.objects.filter(date=date).delete()
+                cls.objects.bulk_create(stats, batch_size=1000)
+        return len(stats)
+
+
 class Task(models.Model):
     NAME_CHOICES = (
         ("kill_session", "Kill Session"),
@@ -1,3 +1,20 @@
 # -*- coding: utf-8 -*-
 #
 
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from common.utils import get_logger
+from .models import Session, SessionDailyStat
+
+logger = get_logger(__file__)
+
+
+@receiver(post_save, sender=Session)
+def on_session_created(sender, instance=None, created=False, **kwargs):
+    if not created:
+        return
+    try:
+        SessionDailyStat.record_session(instance)
+    except Exception as e:
+        logger.error("Record session daily stat error: {}".format(e))
@@ -8,12 +8,16 @@ from celery.utils.log import get_task_logger
 from django.utils import timezone
 from django.conf import settings
 from django.core.files.storage import default_storage
+from django.core.cache import cache
 
 
+from orgs.utils import tmp_to_root_org
 from ops.celery.decorator import (
     register_as_period_task, after_app_ready_start, after_app_shutdown_clean_periodic
 )
-from .models import Status, Session, Command
+from .models import Status, Session, Command, SessionDailyStat
+from .backends import get_command_storage
+from .backends.command.buffer import CommandBuffer
 
 
 CACHE_REFRESH_INTERVAL = 10
@@ -68,3 +72,92 @@ def clean_expired_session_period():
         # 删除session记录
         session.delete()
 
+
+@shared_task
+@register_as_period_task(crontab='30 1 * * *')
+@after_app_ready_start
+@after_app_shutdown_clean_periodic
+def rebuild_session_daily_stats_period():
+    """
+    重新计算最近几天的会话日统计, 第一次运行时补齐仪表盘最多展示的 30 天
+    当天的数据还在增量更新, 不重新计算
+    """
+    with tmp_to_root_org():
+        has_stats = SessionDailyStat.objects.exists()
+        keep_days = settings.TERMINAL_SESSION_KEEP_DURATION
+        date_expired = timezone.now().date() - timezone.timedelta(days=keep_days)
+        SessionDailyStat.objects.filter(date__lt=date_expired).delete()
+    days = 2 if has_stats else 30
+    today = timezone.localtime(timezone.now()).date()
+    for i in range(days, 0, -1):
+        date = today - timezone.timedelta(days=i)
+        count = SessionDailyStat.rebuild(date)
+        print("Rebuild session daily stats: {}, rows: {}".format(date, count))
+
+
+
+@shared_task
+@register_as_period_task(interval=60)
+@after_app_ready_start
+@after_app_shutdown_clean_periodic
+def flush_command_buffer():
+    """
+    将缓冲区的命令批量写入命令存储, 同时只有一个任务在写
+    写入失败的批次不确认, 稍后会被重新领取重试,
+    投递多次仍然失败的批次逐条写入, 写不进去的移到死信 stream 后确认, 不再阻塞后面的命令
+    """
+    if not CommandBuffer.is_enabled():
+        return
+    lock_key = 'TERMINAL_COMMAND_BUFFER_FLUSHING'
+    if not cache.add(lock_key, 1, 600):
+        return
+    buffer = CommandBuffer()
+    command_store = get_command_storage()
+    flush_size = settings.TERMINAL_COMMAND_BUFFER_FLUSH_SIZE
+    consumer = 'flusher'
+    try:
+        while True:
+            ids, commands, times = buffer.read(consumer, count=flush_size)
+            if not ids:
+                break
+            if commands and not command_store.bulk_save(commands):
+                logger.error("Flush command buffer failed, {} commands, delivered {} times".format(
+                    len(commands), times
+                ))
+                if times < buffer.max_deliveries:
+                    break
+                failed = save_commands_one_by_one(command_store, commands)
+                buffer.move_to_dead(failed)
+            buffer.ack(ids)
+    finally:
+        cache.delete(lock_key)
+
+
+def save_commands_one_by_one(command_store, commands):
+    """
+    逐条写入命令, 返回写入失败的命令
+    """
+    failed = []
+    for command in commands:
+        try:
+            command_store.save(command)
+        except Exception as e:
+            logger.error("Save command failed: {}".format(e))
+            failed.append(command)
+    if failed:
+        logger.error("Move {} commands to dead letter stream".format(len(failed)))
+    return failed
+
+
+def schedule_flush_command_buffer(buffer):
+    """
+    缓冲区达到批量大小立即写入, 否则最多等待 flush 间隔
+    """
+    interval = settings.TERMINAL_COMMAND_BUFFER_FLUSH_INTERVAL
+    if buffer.length() >= settings.TERMINAL_COMMAND_BUFFER_FLUSH_SIZE:
+        countdown = 0
+    else:
+        countdown = interval
+    if not cache.add('TERMINAL_COMMAND_BUFFER_SCHEDULED', 1, max(countdown, 1)):
+        return
+    flush_command_buffer.apply_async(countdown=countdown)
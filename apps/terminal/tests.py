@@ -1,3 +1,204 @@
-from django.test import TestCase
+import uuid
+from collections import defaultdict, OrderedDict
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, override_settings
+
+from .backends.command.buffer import CommandBuffer
+from .backends.command.es import CommandStore as ESCommandStore
+from .backends.command.multi import MergedCommands
+from .tasks import flush_command_buffer
+
+
+class FakeStreamRedis:
+    """
+    只实现命令缓冲区用到的 redis stream 命令, 单个消费者组
+    """
+    def __init__(self):
+        self.streams = defaultdict(OrderedDict)
+        self.delivered = set()
+        # {message_id: times_delivered}
+        self.pending = OrderedDict()
+        self.seq = 0
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        pass
+
+    def xgroup_create(self, *args, **kwargs):
+        pass
+
+    def xadd(self, key, fields, maxlen=None, approximate=True):
+        self.seq += 1
+        message_id = '{}-0'.format(self.seq).encode()
+        self.streams[key][message_id] = {
+            k.encode(): v.encode() for k, v in fields.items()
+        }
+        return message_id
+
+    def xlen(self, key):
+        return len(self.streams[key])
+
+    def xreadgroup(self, group, consumer, streams, count=None):
+        key = list(streams.keys())[0]
+        messages = [
+            (message_id, fields) for message_id, fields in self.streams[key].items()
+            if message_id not in self.delivered
+        ][:count]
+        for message_id, __ in messages:
+            self.delivered.add(message_id)
+            self.pending[message_id] = 1
+        return [[key, messages]] if messages else []
+
+    def xpending_range(self, key, group, min, max, count):
+        return [
+            {'message_id': message_id, 'times_delivered': times,
+             'time_since_delivered': 0}
+            for message_id, times in list(self.pending.items())[:count]
+        ]
+
+    def xclaim(self, key, group, consumer, min_idle_time, message_ids):
+        for message_id in message_ids:
+            self.pending[message_id] += 1
+        return [(i, self.streams[key][i]) for i in message_ids]
+
+    def xack(self, key, group, *message_ids):
+        for message_id in message_ids:
+            self.pending.pop(message_id, None)
+
+    def xdel(self, key, *message_ids):
+        for message_id in message_ids:
+            self.streams[key].pop(message_id, None)
+
+
+class FakeCommandStore:
+    """
+    input 为 bad 的命令写不进去, 包含它的批次也写入失败
+    """
+    def __init__(self):
+        self.saved = []
+
+    def bulk_save(self, commands):
+        if any(c['input'] == 'bad' for c in commands):
+            return False
+        self.saved.extend(commands)
+        return True
+
+    def save(self, command):
+        if command['input'] == 'bad':
+            raise ValueError('bad command')
+        self.saved.append(command)
+
+
+@override_settings(
+    TERMINAL_COMMAND_BUFFER_ENABLED=True,
+    TERMINAL_COMMAND_BUFFER_FLUSH_SIZE=2,
+)
+class FlushCommandBufferTestCase(SimpleTestCase):
+    def setUp(self):
+        self.redis = FakeStreamRedis()
+        self.store = FakeCommandStore()
+        patchers = [
+            mock.patch('terminal.backends.command.buffer.get_redis_connection',
+                       return_value=self.redis),
+            mock.patch('terminal.tasks.get_command_storage', return_value=self.store),
+            mock.patch('terminal.tasks.cache'),
+            mock.patch.object(CommandBuffer, 'claim_idle_ms', 0),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_failed_batch_not_stall_buffer(self):
+        buffer = CommandBuffer()
+        buffer.push([{'input': 'ls'}, {'input': 'bad'}, {'input': 'pwd'}])
+
+        # 前几次投递失败, 批次不确认, 后面的命令也不读取
+        for i in range(CommandBuffer.max_deliveries - 1):
+            flush_command_buffer()
+            self.assertEqual(self.store.saved, [])
+            self.assertEqual(buffer.length(), 3)
+
+        # 投递次数达到上限, 逐条写入, 写不进去的移到死信 stream, 然后继续读后面的命令
+        flush_command_buffer()
+        self.assertEqual([c['input'] for c in self.store.saved], ['ls', 'pwd'])
+        self.assertEqual(buffer.length(), 0)
+        self.assertEqual(self.redis.pending, {})
+        dead = list(self.redis.streams[CommandBuffer.dead_stream_key].values())
+        self.assertEqual(len(dead), 1)
+        self.assertIn(b'bad', dead[0][b'data'])
+
+    def test_flush_in_order(self):
+        buffer = CommandBuffer()
+        buffer.push([{'input': str(i)} for i in range(5)])
+        flush_command_buffer()
+        self.assertEqual([c['input'] for c in self.store.saved], [str(i) for i in range(5)])
+        self.assertEqual(buffer.length(), 0)
+        self.assertEqual(self.redis.streams[CommandBuffer.dead_stream_key], {})
+
+
+class FakeES:
+    """
+    按 filter_page 的排序 (timestamp, id, _id) 倒序和 search_after 返回命令, 不处理查询条件
+    """
+    def __init__(self, docs):
+        self.docs = docs
+        self.error = None
+
+    @staticmethod
+    def sort_values(doc):
+        return [doc['_source']['timestamp'], doc['_source'].get('id', ''), doc['_id']]
+
+    def search(self, index=None, doc_type=None, body=None):
+        if self.error:
+            raise self.error
+        docs = sorted(self.docs, key=self.sort_values, reverse=True)
+        if 'search_after' in body:
+            after = body['search_after']
+            docs = [d for d in docs if self.sort_values(d) < after]
+        else:
+            docs = docs[body.get('from', 0):]
+        hits = [dict(d, sort=self.sort_values(d)) for d in docs[:body['size']]]
+        return {'hits': {'hits': hits}}
+
+    def count(self, index=None, doc_type=None, body=None):
+        return {'count': len(self.docs)}
+
+
+class ESCommandPageTestCase(SimpleTestCase):
+    def setUp(self):
+        docs = []
+        for i in range(7):
+            # 以前保存的命令没有 id, 都在同一时间戳
+            docs.append({'_id': 'legacy{:014d}'.format(i),
+                         '_source': {'input': 'legacy-{}'.format(i), 'timestamp': 100}})
+        for i in range(5):
+            docs.append({'_id': 'doc{:017d}'.format(i),
+                         '_source': {'input': 'new-{}'.format(i), 'timestamp': 100,
+                                     'id': str(uuid.uuid4())}})
+        self.es = FakeES(docs)
+        self.store = ESCommandStore.__new__(ESCommandStore)
+        self.store.es = self.es
+        self.store.index = 'jumpserver'
+        self.store.doc_type = 'command_store'
+
+    def test_iter_pages_without_duplicates(self):
+        commands = MergedCommands([self.store])
+        commands.page_size = 3
+        inputs = [c.input for c in commands]
+        self.assertEqual(len(inputs), 12)
+        self.assertEqual(len(set(inputs)), 12)
+        # 有 id 的排在前面
+        self.assertTrue(all(i.startswith('new-') for i in inputs[:5]))
+
+    def test_after_legacy_cursor(self):
+        commands = list(MergedCommands([self.store]))
+        after = MergedCommands([self.store]).after(commands[6])
+        self.assertEqual([c.input for c in after], [c.input for c in commands[7:]])
+
+    def test_search_error_raised(self):
+        self.es.error = ConnectionError('es down')
+        with self.assertRaises(ConnectionError):
+            list(MergedCommands([self.store]))
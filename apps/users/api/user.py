@@ -12,7 +12,7 @@ from common.permissions import (
     IsOrgAdmin, IsOrgAdminOrAppUser,
     CanUpdateDeleteUser, IsSuperUser
 )
-from common.mixins import CommonApiMixin
+from common.mixins import CommonApiMixin, StreamingExportMixin, BulkImportMixin
 from common.utils import get_logger
 from orgs.utils import current_org
 from orgs.models import ROLE as ORG_ROLE, OrganizationMember
@@ -22,6 +22,7 @@ from .mixins import UserQuerysetMixin
 from ..models import User
 from ..signals import post_user_create
 from ..filters import OrgRoleUserFilterBackend
+from ..importers import UserBulkImporter
 
 
 logger = get_logger(__name__)
@@ -31,7 +32,8 @@ __all__ = [
 ]
 
 
-class UserViewSet(CommonApiMixin, UserQuerysetMixin, BulkModelViewSet):
+class UserViewSet(BulkImportMixin, StreamingExportMixin, CommonApiMixin,
+                  UserQuerysetMixin, BulkModelViewSet):
     filter_fields = ('username', 'email', 'name', 'id', 'source')
     search_fields = filter_fields
     permission_classes = (IsOrgAdmin, CanUpdateDeleteUser)
@@ -40,6 +42,7 @@ class UserViewSet(CommonApiMixin, UserQuerysetMixin, BulkModelViewSet):
         'retrieve': UserRetrieveSerializer
     }
     extra_filter_backends = [OrgRoleUserFilterBackend]
+    bulk_importer_class = UserBulkImporter
 
     def get_queryset(self):
         return super().get_queryset().annotate(
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#
+import uuid
+
+from common.drf.importer import BulkImporter
+from common.utils import get_logger
+from orgs.utils import current_org
+from orgs.models import ROLE as ORG_ROLE, OrganizationMember, UserRoleMapper
+
+logger = get_logger(__file__)
+
+__all__ = ['UserBulkImporter']
+
+
+class UserBulkImporter(BulkImporter):
+    """
+    用户导入, 和 UserViewSet 创建更新时一致地设置组织角色
+    新建用户的组织角色一次批量添加, 用户组变化时授权树缓存只失效一次
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # {user_id: roles}, 没有的表示不修改
+        self.users_roles = {}
+
+    def prepare_data(self, serializer, data, instance=None):
+        roles = data.pop('org_roles', None)
+        if instance is None:
+            # 先生成 id, 写入后按 id 设置组织角色
+            data['id'] = uuid.uuid4()
+            # 当前组织创建的用户，至少是该组织的`User`
+            self.users_roles[data['id']] = roles or [ORG_ROLE.USER]
+        elif roles is not None:
+            self.users_roles[instance.id] = roles
+        return data
+
+    def prepare_instance(self, obj, created):
+        super().prepare_instance(obj, created)
+        # 和 User.save 中的处理一致
+        obj.set_unprovide_attr_if_need()
+        if obj.username == 'admin':
+            obj.role = 'Admin'
+            obj.is_active = True
+
+    def set_org_roles(self, created, updated):
+        # 只有真实存在的组织才真正关联用户
+        if not current_org or not current_org.is_real():
+            return
+        mapper = UserRoleMapper()
+        for user in created:
+            for role in self.users_roles.get(user.id, []):
+                if role in mapper:
+                    mapper[role].add(user.id)
+        OrganizationMember.objects.add_users_by_role(
+            current_org, mapper.users, mapper.admins, mapper.auditors
+        )
+        for user in updated:
+            roles = self.users_roles.get(user.id)
+            if roles is not None:
+                OrganizationMember.objects.set_user_roles(current_org, user, roles)
+
+    def save_chunk(self, serializer, items):
+        created_count, updated_count = len(self.created), len(self.updated)
+        super().save_chunk(serializer, items)
+        if self.has_errors():
+            return
+        self.set_org_roles(self.created[created_count:], self.updated[updated_count:])
+
+    def after_import(self):
+        from perms.utils import AssetPermissionUtil
+
+        users_id = {
+            user_id for changes in (self.m2m_added, self.m2m_removed)
+            for user_id, group_id in changes.get('groups', [])
+        }
+        AssetPermissionUtil.expire_users_tree_cache(users_id)
+        if self.created:
+            self.view.send_created_signal(self.created)
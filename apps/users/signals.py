@@ -3,3 +3,4 @@ from django.dispatch import Signal
 
 post_user_create = Signal(providing_args=('user',))
 post_user_change_password = Signal(providing_args=('user',))
+post_user_bulk_import = Signal(providing_args=('created', 'updated', 'unchanged'))
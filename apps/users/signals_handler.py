@@ -27,14 +27,25 @@ def on_user_create(sender, user=None, **kwargs):
 
 
 @receiver(m2m_changed, sender=User.groups.through)
-def on_user_groups_change(sender, instance=None, action='', **kwargs):
+def on_user_groups_change(sender, instance=None, action='', pk_set=None,
+                          reverse=False, **kwargs):
     """
-    资产节点发生变化时，刷新节点
+    用户组成员发生变化时，只让这些用户的授权树缓存失效
     """
-    if action.startswith('post'):
-        logger.debug("User group member change signal recv: {}".format(instance))
-        from perms.utils import AssetPermissionUtil
-        AssetPermissionUtil.expire_all_user_tree_cache()
+    if action == 'pre_clear' and reverse:
+        instance._tree_users_id = list(instance.users.values_list('id', flat=True))
+        return
+    if not action.startswith('post'):
+        return
+    logger.debug("User group member change signal recv: {}".format(instance))
+    from perms.utils import AssetPermissionUtil
+    if not reverse:
+        users_id = [instance.id]
+    elif action == 'post_clear':
+        users_id = getattr(instance, '_tree_users_id', [])
+    else:
+        users_id = pk_set
+    AssetPermissionUtil.expire_users_tree_cache(users_id)
 
 
 @receiver(cas_user_authenticated)
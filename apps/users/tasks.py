@@ -14,7 +14,7 @@ from .models import User
 from .utils import (
     send_password_expiration_reminder_mail, send_user_expiration_reminder_mail
 )
-from settings.utils import LDAPServerUtil, LDAPImportUtil
+from settings.utils import LDAPSyncUtil, LDAPCacheUtil, LDAPImportUtil
 
 
 logger = get_logger(__file__)
@@ -76,15 +76,25 @@ def check_user_expired_periodic():
 
 @shared_task
 def import_ldap_user():
+    """
+    先把 LDAP 用户 (增量) 同步到缓存, 再从缓存分批导入本次同步到的用户
+    """
     logger.info("Start import ldap user task")
-    util_server = LDAPServerUtil()
+    util_sync = LDAPSyncUtil()
+    util_cache = LDAPCacheUtil()
     util_import = LDAPImportUtil()
-    users = util_server.search()
-    errors = util_import.perform_import(users)
+    usernames = util_sync.sync()
+    errors = []
+    batch_size = util_import.batch_size
+    for i in range(0, len(usernames), batch_size):
+        users = util_cache.get_users_by_username(usernames[i:i + batch_size])
+        util_import.import_users(users, errors)
+    util_import.send_import_signal()
     if errors:
         logger.error("Imported LDAP users errors: {}".format(errors))
     else:
-        logger.info('Imported {} users successfully'.format(len(users)))
+        logger.info('Imported {} users successfully'.format(len(usernames)))
+    logger.info('Imported LDAP users: {}'.format(util_import.summary))
 
 
 @shared_task